@@ -0,0 +1,76 @@
+import torch
+from torch import nn
+
+# Batched version of the augmentation TextDataset does per sample, meant to run on the padded batch
+# from padded_sorted_collate on whatever device training happens on. Each image is resized along its
+# width by a random factor and shifted by a random whole number of pixels along its last dimension.
+# Note that images are stored width first, so the "horizontal" translate of the per sample
+# RandomAffine(translate=(0.1, 0.0)) acts on the 32 pixel axis, and the same is done here.
+#
+# The resize is separable (width only) and the shift is integral, so both are done as gathers with
+# per sample filter taps instead of a full grid_sample. That keeps Resize's antialiasing and its
+# handling of each image's own right edge, which a grid sample over the padded batch can't do.
+class BatchAugmentation(nn.Module):
+    def __init__(self, min_scale=0.85, max_scale=1.4, translate=0.1):
+        super(BatchAugmentation, self).__init__()
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.translate = translate
+
+    # Sizes are expected on the cpu (as they come from the collate fn), so no device sync is needed
+    # to find the output width
+    def forward(self, images, labels, image_sizes, label_sizes):
+        batch_size = images.size(0)
+        height = images.size(3)
+        widths = image_sizes[:, 1]
+
+        # Same parameter distributions as the per sample path
+        scales = self.min_scale + torch.rand(batch_size) * (self.max_scale - self.min_scale)
+        new_widths = (widths * scales + 0.5).long()
+        max_shift = self.translate * height
+        shifts = torch.empty(batch_size).uniform_(-max_shift, max_shift).round().long()
+
+        # Antialiased bilinear filter taps along the width, computed like Resize does for each image
+        # (a triangle filter stretched by the downscale factor, normalized over each image's pixels)
+        out_width = int(new_widths.max())
+        positions = torch.arange(out_width, dtype=torch.float32).unsqueeze(0)
+        scale = (widths / new_widths).unsqueeze(1)
+        support = scale.clamp(min=1.0)
+        center = scale * (positions + 0.5)
+        start = (center - support + 0.5).long().clamp(min=0)
+        end = torch.minimum((center + support + 0.5).long(), widths.unsqueeze(1))
+        num_taps = int(torch.ceil(2 * support.max())) + 1
+        taps = start.unsqueeze(2) + torch.arange(num_taps)
+        weights = (1 - ((taps - center.unsqueeze(2) + 0.5) / support.unsqueeze(2)).abs()).clamp(min=0)
+        weights = weights * (taps < end.unsqueeze(2))
+        weights = weights / weights.sum(dim=2, keepdim=True).clamp(min=1e-12)
+        taps = torch.minimum(taps, (widths - 1).view(-1, 1, 1))
+
+        # Source column for every output column after shifting, and which ones fall outside the image
+        columns = torch.arange(height).unsqueeze(0) - shifts.unsqueeze(1)
+        column_mask = (columns >= 0) & (columns < height)
+        columns = columns.clamp(0, height - 1)
+        row_mask = positions < new_widths.unsqueeze(1)
+
+        device = images.device
+        taps = taps.to(device)
+        weights = weights.to(device)
+        columns = columns.to(device).unsqueeze(1).expand(-1, out_width, -1)
+        mask = (row_mask.unsqueeze(2) & column_mask.unsqueeze(1)).to(device)
+
+        # Resize, shift and zero everything outside each image
+        x = images.squeeze(1)
+        out = 0
+        for i in range(num_taps):
+            index = taps[:, :, i].unsqueeze(2).expand(-1, -1, height)
+            out = out + x.gather(1, index) * weights[:, :, i].unsqueeze(2)
+        out = out.gather(2, columns) * mask
+        out = out.unsqueeze(1)
+
+        # Widths changed, so restore the descending width order that sequence packing relies on
+        order = torch.argsort(new_widths, descending=True, stable=True)
+        out_sizes = image_sizes.clone()
+        out_sizes[:, 1] = new_widths
+        device_order = order.to(device)
+
+        return out[device_order], labels[device_order], out_sizes[order], label_sizes[order]
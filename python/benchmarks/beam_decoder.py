@@ -0,0 +1,47 @@
+import argparse
+import torch
+
+from benchmarks.common import *
+from decoders import *
+
+# Checks that CTCVectorizedBeamDecoder gives exactly the same results as CTCBeamDecoder on a random
+# corpus and compares their speed.
+# Run from the python directory: python -m benchmarks.beam_decoder
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=20,
+                        help="The number of random batches in the test corpus.")
+    parser.add_argument("--batch_size", "-b", type=int, default=8,
+                        help="The batch size.")
+    parser.add_argument("--length", type=int, default=100,
+                        help="The maximum sequence length.")
+    parser.add_argument("--num_classes", type=int, default=80,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[1, 10, 50],
+                        help="The beam widths to test.")
+
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    corpus = []
+    for i in range(args.batches):
+        sharpness = 1.0 + 8.0 * i / max(args.batches - 1, 1)
+        corpus.append(synthetic_log_probs(args.batch_size, args.length, args.num_classes, sharpness, generator))
+
+    reference = CTCBeamDecoder()
+    vectorized = CTCVectorizedBeamDecoder()
+    for beam_width in args.beam_widths:
+        mismatches = 0
+        for probs, lengths in corpus:
+            expected, expected_lengths = reference(probs, lengths, beam_width=beam_width)
+            actual, actual_lengths = vectorized(probs, lengths, beam_width=beam_width)
+            if not torch.equal(expected, actual) or not torch.equal(expected_lengths, actual_lengths):
+                mismatches += 1
+
+        probs, lengths = corpus[-1]
+        reference_times = time_calls(lambda: reference(probs, lengths, beam_width=beam_width), repeat=3)
+        vectorized_times = time_calls(lambda: vectorized(probs, lengths, beam_width=beam_width), repeat=3)
+
+        print("Beam width {}: {} of {} batches differ".format(beam_width, mismatches, len(corpus)))
+        print("    CTCBeamDecoder:           " + summarize(reference_times))
+        print("    CTCVectorizedBeamDecoder: " + summarize(vectorized_times))
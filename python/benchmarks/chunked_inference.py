@@ -0,0 +1,124 @@
+import argparse
+import multiprocessing
+from pathlib import Path
+import time
+import torch
+
+from benchmarks.common import *
+from benchmarks.conv_bn_fusion import randomize_batchnorms
+from benchmarks.onnx_engine import synthetic_line_batch
+from data import *
+from decoders import *
+from instrumentation import *
+from metrics import *
+from model import *
+
+def load_benchmark_model(args):
+    generator = torch.Generator().manual_seed(0)
+    model = load_model(args.num_classes, args.weights)
+    if args.weights is None:
+        torch.manual_seed(0)
+        with torch.no_grad():
+            randomize_batchnorms(model, generator)
+    model.eval()
+    return fuse_conv_batchnorm(model)
+
+# Very wide lines made by joining the images of a dataset end to end (like merged subtitle lines),
+# widths long each (padded with the following images' columns, the last one cut off at the width)
+def joined_lines(dataset, width, num_lines):
+    lines = []
+    idx = 0
+    for _ in range(num_lines):
+        columns = []
+        total = 0
+        while total < width:
+            image, _ = dataset[idx % len(dataset)]
+            columns.append(image)
+            total += image.size(0)
+            idx += 1
+        lines.append(torch.cat(columns)[:width])
+    images = torch.stack(lines).unsqueeze(1)
+    sizes = torch.tensor([[1, width, images.size(3)]] * num_lines, dtype=torch.long)
+    return images, sizes
+
+def mode_name(chunk_width, sequence_overlap):
+    if chunk_width is None:
+        return "whole image"
+    if sequence_overlap is None:
+        return "chunks of {}".format(chunk_width)
+    return "chunks of {}, LSTM windows (overlap {})".format(chunk_width, sequence_overlap)
+
+# Runs in a fresh process and measures how far one forward pass raises the resident memory above what
+# it was before. Loading the model peaks higher than the forward pass, so the peak is reset first
+# (Linux only, otherwise the peak of the whole process is reported)
+def measure(args, width, chunk_width, sequence_overlap):
+    torch.set_num_threads(args.threads)
+    model = load_benchmark_model(args)
+    if not chunk_width is None:
+        model = ChunkedModel(model, chunk_width, sequence_overlap)
+    images, sizes = synthetic_line_batch(args.batch_size, width, torch.Generator().manual_seed(0))
+
+    before = reset_peak_rss()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model(images, sizes)
+    return peak_rss() - before, time.perf_counter() - start
+
+# Checks that chunked inference gives the same results as running whole images, and compares the peak
+# memory and latency of both for very wide images. Parity is checked on lines joined from the images
+# of --data_dir if given (random images otherwise). Run from the python directory:
+# python -m benchmarks.chunked_inference
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", "-w", type=Path, required=False,
+                        help="The weights to benchmark (random weights if not given).")
+    parser.add_argument("--num_classes", type=int, default=81,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--data_dir", "-d", type=Path, required=False,
+                        help="A dataset whose images are joined into wide lines for the parity check.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[2048, 8192, 16384],
+                        help="The image widths to measure.")
+    parser.add_argument("--chunk_widths", type=int, nargs="+", default=[512, 1024],
+                        help="The chunk widths to measure.")
+    parser.add_argument("--sequence_overlap", type=int, default=32,
+                        help="The overlap (in LSTM steps) of the windowed LSTM mode.")
+    parser.add_argument("--batch_size", "-b", type=int, default=1,
+                        help="The number of images per batch.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="The number of threads each measurement runs with.")
+
+    args = parser.parse_args()
+
+    # Parity with full width inference
+    model = load_benchmark_model(args)
+    decoder = CTCGreedyDecoder()
+    cer_metric = CharacterErrorRate()
+    dataset = TextDataset(args.data_dir) if not args.data_dir is None else None
+    for width in args.widths:
+        if dataset is None:
+            images, sizes = synthetic_line_batch(args.batch_size, width, torch.Generator().manual_seed(width))
+        else:
+            images, sizes = joined_lines(dataset, width, args.batch_size)
+        with torch.inference_mode():
+            expected, expected_sizes = model(images, sizes)
+            expected_text, expected_lens = decoder(expected, expected_sizes[:, 0])
+            for chunk_width in args.chunk_widths:
+                for sequence_overlap in [None, args.sequence_overlap]:
+                    probs, prob_sizes = ChunkedModel(model, chunk_width, sequence_overlap)(images, sizes)
+                    decoded, decoded_lens = decoder(probs, prob_sizes[:, 0])
+                    errors, chars = cer_metric.counts(decoded, decoded_lens, expected_text, expected_lens)
+                    print("Width {}, {}: max error {:.2e}, sizes {}, CER against whole image {:.4f}".format(
+                        width, mode_name(chunk_width, sequence_overlap), (probs - expected).abs().max().item(),
+                        "match" if torch.equal(prob_sizes, expected_sizes) else "DIFFER", float(errors) / max(float(chars), 1.0)))
+
+    # Peak memory and latency, every measurement in its own process
+    pool_context = multiprocessing.get_context("spawn")
+    for width in args.widths:
+        print("Width {}:".format(width))
+        modes = [(None, None)] + [(chunk_width, overlap) for chunk_width in args.chunk_widths for overlap in [None, args.sequence_overlap]]
+        for chunk_width, sequence_overlap in modes:
+            pool = pool_context.Pool(1)
+            memory, elapsed = pool.apply(measure, (args, width, chunk_width, sequence_overlap))
+            pool.close()
+            pool.join()
+            print("    {:44} peak memory +{:.0f}MB, {:.2f}s".format(mode_name(chunk_width, sequence_overlap) + ":", memory / 2**20, elapsed))
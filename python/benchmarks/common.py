@@ -0,0 +1,57 @@
+import os
+import time
+import numpy as np
+import torch
+
+from instrumentation import *
+
+# Times fn() after a few warmup calls, returning the duration of every timed call in seconds
+def time_calls(fn, repeat=10, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+def summarize(times):
+    times = np.array(times)
+    return "mean {:.4f}s, p50 {:.4f}s, min {:.4f}s".format(times.mean(), np.percentile(times, 50), times.min())
+
+# Random CTC network output: log probabilities of shape (batch, length, classes) and lengths. A higher
+# sharpness gives peakier (more confident, more realistic) distributions.
+def synthetic_log_probs(batch_size, length, num_classes, sharpness=4.0, generator=None):
+    logits = torch.randn((batch_size, length, num_classes), generator=generator) * sharpness
+    lengths = torch.randint(max(length // 2, 1), length + 1, (batch_size,), generator=generator)
+    lengths[0] = length
+    return torch.log_softmax(logits, dim=2), lengths
+
+# Resident memory in bytes from /proc/self/status (VmRSS for the current, VmHWM for the peak value)
+def _rss(field):
+    f = open("/proc/self/status", "r")
+    status = f.read()
+    f.close()
+    for line in status.splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+# Resets the peak resident memory of the process to its current value and returns it, so that
+# peak_rss() minus this is how far the code run in between raised it. Only Linux can reset the peak,
+# elsewhere this returns 0 and peak_rss() the peak of the whole process.
+def reset_peak_rss():
+    if not os.path.exists("/proc/self/clear_refs"):
+        return 0
+    f = open("/proc/self/clear_refs", "w")
+    f.write("5")
+    f.close()
+    return _rss("VmRSS")
+
+def peak_rss():
+    if os.path.exists("/proc/self/clear_refs"):
+        return _rss("VmHWM")
+    return peak_memory(torch.device("cpu"))
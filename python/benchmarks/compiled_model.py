@@ -0,0 +1,68 @@
+import argparse
+from pathlib import Path
+import torch
+
+from benchmarks.common import *
+from benchmarks.conv_bn_fusion import randomize_batchnorms
+from benchmarks.onnx_engine import synthetic_line_batch
+from model import *
+
+# Compares the cpu inference latency of the eval mode model from load_model with InferenceModel run
+# eagerly, scripted with TorchScript and compiled with torch.compile, and checks that they all give
+# the same outputs. Compiling only gains a little over the eager InferenceModel, and at batch sizes above
+# one all InferenceModel variants are slower than the packed eager model (its masked LSTM runs the two
+# directions separately). Run from the python directory: python -m benchmarks.compiled_model
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", "-w", type=Path, required=False,
+                        help="The weights to benchmark (random weights if not given).")
+    parser.add_argument("--num_classes", type=int, default=81,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--widths", type=int, nargs="+", default=[64, 256, 1024],
+                        help="The widths of the widest image in a batch.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8],
+                        help="The batch sizes to time.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="The number of timed calls per configuration.")
+
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    model = load_model(args.num_classes, args.weights)
+    if args.weights is None:
+        with torch.no_grad():
+            randomize_batchnorms(model, generator)
+    model.eval()
+    inference_model = InferenceModel(model)
+
+    variants = [("load_model (eager)", model), ("InferenceModel (eager)", inference_model)]
+    try:
+        variants.append(("InferenceModel (TorchScript)", torch.jit.script(inference_model)))
+    except Exception as e:
+        print("TorchScript failed: " + str(e))
+    # Dynamic shapes, so new widths and batch sizes don't trigger recompiles
+    variants.append(("InferenceModel (torch.compile)", torch.compile(inference_model, dynamic=True)))
+
+    with torch.inference_mode():
+        for batch_size in args.batch_sizes:
+            for width in args.widths:
+                images, sizes = synthetic_line_batch(batch_size, width, generator)
+                expected, expected_sizes = model(images, sizes)
+
+                print("Batch size {}, width {}:".format(batch_size, width))
+                for name, variant in variants:
+                    try:
+                        probs, prob_sizes = variant(images, sizes)
+                    except Exception as e:
+                        print("    {:32} failed ({})".format(name + ":", type(e).__name__))
+                        continue
+
+                    # Compare within each row's length (InferenceModel pads to the full input width)
+                    probs = probs[:, :expected.size(1)]
+                    mask = torch.arange(expected.size(1)).unsqueeze(0) < expected_sizes[:, :1]
+                    max_error = (probs - expected).abs()[mask].max().item()
+                    same_sizes = torch.equal(prob_sizes, expected_sizes)
+
+                    times = time_calls(lambda: variant(images, sizes), repeat=args.repeat, warmup=2)
+                    print("    {:32} {} (max error {:.2e}, sizes {})".format(name + ":", summarize(times), max_error,
+                                                                       "match" if same_sizes else "DIFFER"))
@@ -0,0 +1,66 @@
+import argparse
+from pathlib import Path
+import torch
+
+from benchmarks.common import *
+from benchmarks.onnx_engine import synthetic_line_batch
+from model import *
+from modules import *
+
+# Gives every batch norm random statistics and affine parameters, like a trained model would have
+# (fresh ones are the identity, which would make folding them trivially exact)
+def randomize_batchnorms(model, generator=None):
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            channels = module.num_features
+            module.running_mean.copy_(torch.randn(channels, generator=generator) * 0.5)
+            module.running_var.copy_(torch.rand(channels, generator=generator) * 2.0 + 0.1)
+            module.weight.data.copy_(torch.rand(channels, generator=generator) + 0.5)
+            module.bias.data.copy_(torch.randn(channels, generator=generator) * 0.2)
+
+# Checks that folding the batch norms into the convolutions gives the same outputs (log probabilities
+# and sizes) and compares the latency of the model before and after. Run from the python directory:
+# python -m benchmarks.conv_bn_fusion
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", "-w", type=Path, required=False,
+                        help="The weights to benchmark (random weights and statistics if not given).")
+    parser.add_argument("--num_classes", type=int, default=81,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--widths", type=int, nargs="+", default=[64, 256, 1024],
+                        help="The widths of the widest image in a batch.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8],
+                        help="The batch sizes to time.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="The number of timed calls per configuration.")
+
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    model = load_model(args.num_classes, args.weights)
+    if args.weights is None:
+        with torch.no_grad():
+            randomize_batchnorms(model, generator)
+    model.eval()
+    fused = fuse_conv_batchnorm(model)
+    print("Batch norms: {} -> {}".format(
+        sum(isinstance(x, SizeTrackingBatchNorm2d) for x in model), sum(isinstance(x, SizeTrackingBatchNorm2d) for x in fused)))
+
+    with torch.inference_mode():
+        for batch_size in args.batch_sizes:
+            for width in args.widths:
+                images, sizes = synthetic_line_batch(batch_size, width, generator)
+                expected, expected_sizes = model(images, sizes)
+                actual, actual_sizes = fused(images, sizes)
+
+                # Outputs past each row's length are padding
+                mask = torch.arange(expected.size(1)).unsqueeze(0) < expected_sizes[:, :1]
+                max_error = (actual - expected).abs()[mask].max().item()
+                same_sizes = torch.equal(actual_sizes, expected_sizes)
+
+                unfused_times = time_calls(lambda: model(images, sizes), repeat=args.repeat)
+                fused_times = time_calls(lambda: fused(images, sizes), repeat=args.repeat)
+                print("Batch size {}, width {}: max error {:.2e}, sizes {}".format(
+                    batch_size, width, max_error, "match" if same_sizes else "DIFFER"))
+                print("    Unfused: " + summarize(unfused_times))
+                print("    Fused:   " + summarize(fused_times))
@@ -0,0 +1,91 @@
+import argparse
+import os
+import time
+import torch
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+from distributed import *
+from model import *
+
+# Random batches shaped like the training data: width first images with a height of 32, sorted by
+# decreasing width, and labels about a tenth as long as the images are wide
+def synthetic_batches(num_batches, batch_size, num_classes, min_width=100, max_width=600, generator=None):
+    batches = []
+    for _ in range(num_batches):
+        widths = torch.randint(min_width, max_width + 1, (batch_size,), generator=generator).sort(descending=True)[0]
+        images = torch.rand((batch_size, 1, int(widths[0]), 32), generator=generator)
+        image_sizes = torch.stack((torch.ones_like(widths), widths, torch.full_like(widths, 32)), dim=1)
+        label_sizes = widths // 10
+        labels = torch.randint(1, num_classes, (batch_size, int(label_sizes.max())), generator=generator)
+        batches.append((images, labels, image_sizes, label_sizes))
+    return batches
+
+def _all_reduce_max(value):
+    value = torch.tensor([value], dtype=torch.float64)
+    torch.distributed.all_reduce(value, op=torch.distributed.ReduceOp.MAX)
+    return float(value[0])
+
+# Trains on the same number of samples per process, like train.py does with --num_processes
+def run(rank, world_size, args, results):
+    if world_size > 1:
+        init_distributed(rank, world_size, args.master_port)
+    torch.set_num_threads(max(os.cpu_count() // world_size, 1))
+    torch.manual_seed(0)
+
+    model = load_model(args.num_classes)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0001)
+    ctc_loss = nn.CTCLoss()
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
+
+    generator = torch.Generator().manual_seed(rank)
+    batches = synthetic_batches(args.batches + args.warmup, args.batch_size, args.num_classes, generator=generator)
+
+    for i, (images, labels, image_sizes, label_sizes) in enumerate(batches):
+        if i == args.warmup:
+            start = time.perf_counter()
+        probs, prob_sizes = train_model(images, image_sizes)
+        loss = ctc_loss(probs.transpose(0, 1), labels, prob_sizes[:, 0], label_sizes)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    elapsed = time.perf_counter() - start
+
+    # The slowest process decides the step time
+    if world_size > 1:
+        elapsed = _all_reduce_max(elapsed)
+    if rank == 0:
+        results[world_size] = world_size * args.batches * args.batch_size / elapsed
+
+    cleanup_distributed()
+
+# Measures cpu training throughput of data parallel training with different numbers of processes.
+# Run from the python directory: python -m benchmarks.distributed_training
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_processes", "-n", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="The numbers of processes to measure.")
+    parser.add_argument("--batches", type=int, default=10,
+                        help="The number of timed batches per process.")
+    parser.add_argument("--warmup", type=int, default=2,
+                        help="The number of untimed batches per process.")
+    parser.add_argument("--batch_size", "-b", type=int, default=8,
+                        help="The batch size of each process.")
+    parser.add_argument("--num_classes", type=int, default=81,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--master_port", type=int, default=29501,
+                        help="The local port processes use to coordinate.")
+
+    args = parser.parse_args()
+
+    manager = torch.multiprocessing.get_context("spawn").Manager()
+    results = manager.dict()
+    for world_size in args.num_processes:
+        if world_size > 1:
+            torch.multiprocessing.spawn(run, args=(world_size, args, results), nprocs=world_size)
+        else:
+            run(0, 1, args, results)
+
+        speedup = results[world_size] / results[args.num_processes[0]] * args.num_processes[0]
+        print("{} processes: {:.1f} samples/s ({:.2f}x, {:.0f}% scaling efficiency)".format(
+            world_size, results[world_size], speedup, 100 * speedup / world_size))
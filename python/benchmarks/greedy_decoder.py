@@ -0,0 +1,67 @@
+import argparse
+import torch
+from torch import nn
+
+from benchmarks.common import *
+from decoders import *
+
+# The previous CTCGreedyDecoder, which decodes each row in Python
+def reference_greedy_decode(probabilities, lengths):
+    out = torch.argmax(probabilities, dim=-1)
+    out = [torch.unique_consecutive(x[:y]) for x, y in zip(out, lengths)]
+    out = [probabilities.new_tensor([i for i in x.tolist() if i != 0], dtype=torch.long) for x in out]
+    out_lengths = lengths.new_tensor([x.size(0) for x in out])
+    out = nn.utils.rnn.pad_sequence(out, batch_first=True)
+    return out, out_lengths
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+# Checks that CTCGreedyDecoder gives exactly the same results as the per row reference decoder and
+# compares their speed at training batch sizes. Run from the python directory:
+# python -m benchmarks.greedy_decoder
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=20,
+                        help="The number of random batches in the test corpus.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 32, 128],
+                        help="The batch sizes to time.")
+    parser.add_argument("--length", type=int, default=100,
+                        help="The maximum sequence length.")
+    parser.add_argument("--num_classes", type=int, default=80,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="The device to decode on.")
+
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    decoder = CTCGreedyDecoder()
+    generator = torch.Generator().manual_seed(0)
+    for batch_size in args.batch_sizes:
+        corpus = []
+        for i in range(args.batches):
+            sharpness = 1.0 + 8.0 * i / max(args.batches - 1, 1)
+            probs, lengths = synthetic_log_probs(batch_size, args.length, args.num_classes, sharpness, generator)
+            corpus.append((probs.to(device), lengths.to(device)))
+
+        mismatches = 0
+        for probs, lengths in corpus:
+            expected, expected_lengths = reference_greedy_decode(probs, lengths)
+            actual, actual_lengths = decoder(probs, lengths)
+            if not torch.equal(expected, actual) or not torch.equal(expected_lengths, actual_lengths):
+                mismatches += 1
+
+        probs, lengths = corpus[-1]
+        def run(fn):
+            fn()
+            synchronize(device)
+        reference_times = time_calls(lambda: run(lambda: reference_greedy_decode(probs, lengths)), repeat=20)
+        trimmed_times = time_calls(lambda: run(lambda: decoder(probs, lengths)), repeat=20)
+        untrimmed_times = time_calls(lambda: run(lambda: decoder(probs, lengths, trim=False)), repeat=20)
+
+        print("Batch size {}: {} of {} batches differ".format(batch_size, mismatches, len(corpus)))
+        print("    Reference:                    " + summarize(reference_times))
+        print("    CTCGreedyDecoder:             " + summarize(trimmed_times))
+        print("    CTCGreedyDecoder(trim=False): " + summarize(untrimmed_times))
@@ -0,0 +1,76 @@
+import argparse
+from pathlib import Path
+import tempfile
+import torch
+
+from benchmarks.common import *
+from decoders import *
+from export import *
+from inference import *
+
+# A random batch of binarized line images, the widest width wide and sorted by decreasing width
+def synthetic_line_batch(batch_size, width, generator=None):
+    widths = torch.randint(max(width // 2, 1), width + 1, (batch_size,), generator=generator).sort(descending=True)[0]
+    widths[0] = width
+    images = (torch.rand((batch_size, 1, width, 32), generator=generator) > 0.7).float()
+    for i in range(batch_size):
+        images[i, :, widths[i]:] = 0
+    sizes = torch.stack((torch.ones_like(widths), widths, torch.full_like(widths, 32)), dim=1)
+    return images, sizes
+
+# Checks that an exported model run with OnnxEngine gives the same results as the PyTorch model and
+# compares the latency of both across image widths. Run from the python directory:
+# python -m benchmarks.onnx_engine
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", "-w", type=Path, required=False,
+                        help="The weights to benchmark (random weights if not given).")
+    parser.add_argument("--num_classes", type=int, default=81,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--widths", type=int, nargs="+", default=[64, 256, 1024, 2048],
+                        help="The widths of the widest image in a batch.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8],
+                        help="The batch sizes to time.")
+    parser.add_argument("--threads", type=int, required=False,
+                        help="The number of threads ONNX Runtime uses (default: number of cpus).")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="The number of timed calls per configuration.")
+
+    args = parser.parse_args()
+
+    torch_engine = TorchEngine(args.weights, args.num_classes)
+    tmp_dir = tempfile.TemporaryDirectory()
+    model_path = Path(tmp_dir.name) / "model.onnx"
+    export_onnx(torch_engine.model, model_path)
+
+    engines = [
+        ("PyTorch", torch_engine),
+        ("ONNX Runtime", OnnxEngine(model_path, args.threads)),
+        ("ONNX Runtime (IO binding)", OnnxEngine(model_path, args.threads, io_binding=True)),
+    ]
+    decoder = CTCGreedyDecoder()
+    generator = torch.Generator().manual_seed(0)
+
+    for batch_size in args.batch_sizes:
+        for width in args.widths:
+            images, sizes = synthetic_line_batch(batch_size, width, generator)
+            expected, expected_lens = torch_engine(images, sizes)
+            expected_decoded, _ = decoder(expected, expected_lens)
+
+            print("Batch size {}, width {}:".format(batch_size, width))
+            fastest = None
+            for name, engine in engines:
+                probs, prob_lens = engine(images, sizes)
+
+                # Compare log probabilities within each row's length, and the greedy decoded text
+                mask = torch.arange(probs.size(1)).unsqueeze(0) < prob_lens.unsqueeze(1)
+                max_error = (probs - expected).abs()[mask].max().item() if probs.shape == expected.shape else float("inf")
+                same_text = torch.equal(prob_lens, expected_lens) and torch.equal(decoder(probs, prob_lens)[0], expected_decoded)
+
+                times = time_calls(lambda: engine(images, sizes), repeat=args.repeat)
+                mean = sum(times) / len(times)
+                if fastest is None or mean < fastest[1]:
+                    fastest = (name, mean)
+                print("    {:26} {} (max error {:.2e}, {})".format(name + ":", summarize(times), max_error,
+                                                                 "same text" if same_text else "DIFFERENT TEXT"))
+            print("    Fastest: " + fastest[0])
@@ -0,0 +1,38 @@
+import argparse
+import torch
+
+from benchmarks.common import *
+from decoders import *
+
+# Measures how ParallelCTCBeamDecoder's throughput scales with the number of worker processes.
+# Run from the python directory: python -m benchmarks.parallel_decoder
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", "-b", type=int, default=64,
+                        help="The batch size.")
+    parser.add_argument("--length", type=int, default=200,
+                        help="The maximum sequence length.")
+    parser.add_argument("--num_classes", type=int, default=80,
+                        help="The number of classes (including blank).")
+    parser.add_argument("--beam_width", type=int, default=50,
+                        help="The beam width.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8],
+                        help="The worker counts to test (0 and 1 decode serially).")
+
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    probs, lengths = synthetic_log_probs(args.batch_size, args.length, args.num_classes, 4.0, generator)
+
+    expected = None
+    for num_workers in args.workers:
+        decoder = ParallelCTCBeamDecoder(num_workers)
+        times = time_calls(lambda: decoder(probs, lengths, beam_width=args.beam_width), repeat=3)
+        decoded, _ = decoder(probs, lengths, beam_width=args.beam_width)
+        decoder.close()
+
+        if expected is None:
+            expected = decoded
+        same = "same" if torch.equal(decoded, expected) else "DIFFERENT"
+        print("{} workers: {:.1f} sequences/s ({}, results {})".format(
+            num_workers, args.batch_size / min(times), summarize(times), same))
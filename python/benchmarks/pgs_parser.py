@@ -0,0 +1,203 @@
+import argparse
+from pathlib import Path
+import struct
+import tempfile
+import time
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from benchmarks.common import *
+from pgs import *
+
+FONTS_DIR = Path(__file__).parent.parent.parent / "fonts"
+WORDS = ["the", "spirit", "bath", "house", "river", "name", "remember", "train", "dragon", "paper", "where",
+         "are", "you", "going", "come", "back", "quickly", "Chihiro", "Haku", "don't", "look", "behind", "me"]
+
+# The per byte RLE decoder of the C# ODSegment, without end of line handling (well formed lines are
+# exactly the object's width, so the pixels just continue on the next row)
+def reference_decode_rle(data, width, height):
+    data = bytes(data)
+    pixels = []
+    i = 0
+    while i < len(data):
+        first = data[i]
+        i += 1
+        if first != 0:
+            pixels.append(first)
+            continue
+        second = data[i]
+        i += 1
+        if second == 0:
+            continue
+        mode = second & 0xC0
+        if mode == 0x00:
+            pixels.extend([0] * second)
+        elif mode == 0x40:
+            pixels.extend([0] * (((second & 0x3F) << 8) | data[i]))
+            i += 1
+        elif mode == 0x80:
+            pixels.extend([data[i]] * (second & 0x3F))
+            i += 1
+        else:
+            pixels.extend([data[i + 1]] * (((second & 0x3F) << 8) | data[i]))
+            i += 2
+    indices = np.full(width * height, TRANSPARENT_INDEX, dtype=np.uint16)
+    indices[:len(pixels)] = pixels
+    return indices.reshape((height, width))
+
+def encode_rle(indices):
+    out = bytearray()
+    for row in indices:
+        changes = np.flatnonzero(np.diff(row.astype(np.int16))) + 1
+        starts = np.concatenate(([0], changes))
+        counts = np.diff(np.concatenate((starts, [row.size])))
+        for color, count in zip(row[starts].tolist(), counts.tolist()):
+            if color == 0:
+                out += bytes([0, count]) if count < 64 else bytes([0, 0x40 | (count >> 8), count & 0xFF])
+            elif count <= 2:
+                out += bytes([color] * count)
+            elif count < 64:
+                out += bytes([0, 0x80 | count, color])
+            else:
+                out += bytes([0, 0xC0 | (count >> 8), count & 0xFF, color])
+        out += bytes([0, 0])
+    return bytes(out)
+
+# Palette index images of rendered subtitle lines: anti-aliased text, its coverage quantized to 16
+# levels, so the RLE data has the mix of long and short runs real subtitles have
+def render_lines(num_lines, seed=0):
+    rng = np.random.default_rng(seed)
+    fonts = sorted(FONTS_DIR.glob("*/static/*-Regular.ttf"))
+    images = []
+    for i in range(num_lines):
+        font = ImageFont.truetype(str(fonts[i % len(fonts)]), 48)
+        text = " ".join(rng.choice(WORDS, size=int(rng.integers(3, 9))))
+        left, top, right, bottom = font.getbbox(text)
+        image = Image.new("L", (right - left + 16, bottom - top + 16))
+        ImageDraw.Draw(image).text((8 - left, 8 - top), text, fill=255, font=font)
+        images.append((np.asarray(image) // 16).astype(np.uint8))
+    return images
+
+def _segment(segment_type, pts, body):
+    return struct.pack(">HIIBH", SEGMENT_MAGIC, pts, pts, segment_type, len(body)) + body
+
+# A display set showing one object at the bottom of a 1920x1080 screen, or clearing it
+def display_set(pts, indices=None, data=None):
+    if indices is None:
+        pcs = struct.pack(">HHBHBBBB", 1920, 1080, 0x10, 0, 0x00, 0, 0, 0)
+        return _segment(SEGMENT_PCS, pts, pcs) + _segment(SEGMENT_END, pts, b"")
+
+    height, width = indices.shape
+    x = (1920 - width) // 2
+    y = 1000 - height
+    pcs = struct.pack(">HHBHBBBB", 1920, 1080, 0x10, 0, COMPOSITION_EPOCH_START, 0, 0, 1) + struct.pack(">HBBHH", 0, 0, 0, x, y)
+    wds = struct.pack(">B", 1) + struct.pack(">BHHHH", 0, x, y, width, height)
+    pds = struct.pack(">BB", 0, 0) + b"".join(struct.pack(">BBBBB", i, 235, 128, 128, i * 17) for i in range(16))
+
+    # Object data is split over segments of at most 65535 bytes
+    segments = []
+    header = struct.pack(">HBB", 0, 0, ODS_FIRST_IN_SEQUENCE) + struct.pack(">I", len(data) + 4)[1:] + struct.pack(">HH", width, height)
+    chunk = 65535 - len(header)
+    segments.append(header + data[:chunk])
+    for start in range(chunk, len(data), 65531):
+        segments.append(struct.pack(">HBB", 0, 0, 0) + data[start:start + 65531])
+    last = bytearray(segments[-1])
+    last[3] |= 0x40
+    segments[-1] = bytes(last)
+
+    return (_segment(SEGMENT_PCS, pts, pcs) + _segment(SEGMENT_WDS, pts, wds) + _segment(SEGMENT_PDS, pts, pds) +
+            b"".join(_segment(SEGMENT_ODS, pts, x) for x in segments) + _segment(SEGMENT_END, pts, b""))
+
+# Writes a track of the given length with a subtitle shown for 3 seconds every 4 seconds, cycling
+# through the rendered lines
+def write_synthetic_track(path, hours, lines, encoded):
+    f = open(path, "wb")
+    num_subtitles = int(hours * 3600 / 4)
+    for i in range(num_subtitles):
+        pts = i * 4 * 90000
+        f.write(display_set(pts, lines[i % len(lines)], encoded[i % len(lines)]))
+        f.write(display_set(pts + 3 * 90000))
+    f.close()
+    return num_subtitles
+
+# Checks that the vectorized RLE decoder gives the same palette indices as the per byte reference and
+# the rendered lines, and measures how fast PGSReader gets through a multi hour track (or the .sup file
+# given with --sup). Run from the python directory: python -m benchmarks.pgs_parser
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sup", type=Path, required=False,
+                        help="A PGS file to measure (a synthetic track if not given).")
+    parser.add_argument("--hours", type=float, default=2.0,
+                        help="The length of the synthetic track.")
+    parser.add_argument("--lines", type=int, default=50,
+                        help="The number of different subtitle lines in the synthetic track.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="The number of timed passes over the track.")
+
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    if args.sup is None:
+        lines = render_lines(args.lines)
+        encoded = [encode_rle(x) for x in lines]
+
+        mismatches = 0
+        for indices, data in zip(lines, encoded):
+            height, width = indices.shape
+            decoded = decode_rle(data, width, height)
+            if not np.array_equal(decoded, indices) or not np.array_equal(decoded, reference_decode_rle(data, width, height)):
+                mismatches += 1
+        print("Decoded lines: {} of {} differ".format(mismatches, len(lines)))
+
+        reference_times = time_calls(lambda: [reference_decode_rle(x, y.shape[1], y.shape[0]) for x, y in zip(encoded, lines)], repeat=3)
+        vectorized_times = time_calls(lambda: [decode_rle(x, y.shape[1], y.shape[0]) for x, y in zip(encoded, lines)], repeat=3)
+        print("Decoding {} lines:".format(len(lines)))
+        print("    Reference:  " + summarize(reference_times))
+        print("    Vectorized: " + summarize(vectorized_times))
+
+        path = Path(tmp_dir.name) / "track.sup"
+        num_subtitles = write_synthetic_track(path, args.hours, lines, encoded)
+        print("Synthetic track: {:.1f} hours, {} subtitles, {:.1f}MB".format(args.hours, num_subtitles, path.stat().st_size / 2**20))
+
+        # Shown frames should have the lines with the palette's alpha (index * 17), cleared ones no images
+        mismatches = 0
+        reader = PGSReader(path)
+        for i, frame in enumerate(reader.frames()):
+            if i >= 2 * len(lines):
+                break
+            if i % 2 == 0:
+                indices = lines[i // 2 % len(lines)]
+                if len(frame.images) != 1 or not np.array_equal(frame.images[0].image[:, :, 3], indices * 17):
+                    mismatches += 1
+            elif len(frame.images) != 0:
+                mismatches += 1
+        reader.close()
+        print("Composed frames: {} of {} differ".format(mismatches, 2 * len(lines)))
+    else:
+        path = args.sup
+
+    reader = PGSReader(path)
+    size = path.stat().st_size
+    start = time.perf_counter()
+    timestamps = reader.timestamps()
+    timestamp_time = time.perf_counter() - start
+    print("Timestamps only: {} frames in {:.3f}s ({:.0f} frames/s, {:.1f}MB/s)".format(
+        len(timestamps), timestamp_time, len(timestamps) / timestamp_time, size / 2**20 / timestamp_time))
+
+    def read_all():
+        frames = 0
+        pixels = 0
+        for frame in reader.frames():
+            frames += 1
+            pixels += sum(x.image.shape[0] * x.image.shape[1] for x in frame.images)
+        return frames, pixels
+    before = reset_peak_rss()
+    frames, pixels = read_all()
+    memory = peak_rss() - before
+    times = time_calls(read_all, repeat=args.repeat, warmup=0)
+    seconds = min(times)
+    print("Frames: {} in {:.3f}s ({:.0f} frames/s, {:.1f}MB/s, {:.1f} megapixels/s)".format(
+        frames, seconds, frames / seconds, size / 2**20 / seconds, pixels / 1e6 / seconds))
+    print("Peak memory while reading frames: +{:.1f}MB".format(memory / 2**20))
+    reader.close()
+    tmp_dir.cleanup()
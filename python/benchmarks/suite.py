@@ -0,0 +1,281 @@
+import argparse
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import re
+import sys
+import tempfile
+import numpy as np
+import torch
+from torch import nn
+from PIL import Image
+
+from benchmarks.common import *
+from benchmarks.onnx_engine import synthetic_line_batch
+from data import *
+from decoders import *
+from metrics import *
+from model import *
+from shards import *
+
+CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,!?'\"-()"
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+# Writes a dataset of random line images (binarized noise in the alpha channel of RGBA PNGs, like the
+# rendered training data) with random labels roughly as long as the images allow
+def write_synthetic_dataset(path, num_samples, min_width=64, max_width=512, seed=0):
+    rng = np.random.default_rng(seed)
+
+    f = open(path / "codec.json", "w")
+    json.dump([{"Char": char, "Type": 0} for char in CHARACTERS], f)
+    f.close()
+
+    lines = []
+    for i in range(num_samples):
+        width = int(rng.integers(min_width, max_width + 1))
+        pixels = np.zeros((IMAGE_HEIGHT, width, 4), dtype=np.uint8)
+        pixels[:, :, 3] = (rng.random((IMAGE_HEIGHT, width)) > 0.7) * 255
+        Image.fromarray(pixels, "RGBA").save(path / (str(i) + ".png"))
+        text = "".join(rng.choice(list(CHARACTERS), size=max(width // 16, 1)))
+        lines.append({"Image": i, "Text": text})
+
+    f = open(path / "labels.json", "w")
+    json.dump({"ImageExtension": ".png", "Lines": lines}, f)
+    f.close()
+
+# Random label batch with lengths that fit the output lengths of images of the given widths
+def synthetic_labels(widths, num_classes, generator=None):
+    lengths = (widths // 16).clamp(min=1)
+    labels = torch.randint(1, num_classes, (widths.size(0), int(lengths.max())), generator=generator)
+    labels[torch.arange(labels.size(1)).unsqueeze(0) >= lengths.unsqueeze(1)] = 0
+    return labels, lengths
+
+# Every case is a name and a setup function, which returns the function to time, the number of items
+# (samples or batch rows) it processes per call and how many calls to time. Cases are set up in the
+# process that runs them.
+def benchmark_cases(args, dataset_dir):
+    num_classes = len(CHARACTERS) + 1
+    cases = []
+
+    def dataset_case(augmentation):
+        def setup():
+            dataset = TextDataset(dataset_dir, augmentation)
+            next_index = [0]
+            def run():
+                dataset[next_index[0] % len(dataset)]
+                next_index[0] += 1
+            return run, 1, 200
+        return setup
+    cases.append(("dataset_getitem", dataset_case(False)))
+    cases.append(("dataset_getitem_augmented", dataset_case(True)))
+
+    def collate_case(batch_size):
+        def setup():
+            dataset = TextDataset(dataset_dir)
+            samples = [dataset[i % len(dataset)] for i in range(batch_size)]
+            return lambda: padded_sorted_collate(list(samples)), batch_size, 100
+        return setup
+    for batch_size in args.batch_sizes:
+        cases.append(("collate_b{}".format(batch_size), collate_case(batch_size)))
+
+    def model_case(batch_size, width, backward):
+        def setup():
+            generator = torch.Generator().manual_seed(0)
+            torch.manual_seed(0)
+            model = load_model(num_classes)
+            images, sizes = synthetic_line_batch(batch_size, width, generator)
+            if not backward:
+                model.eval()
+                def run():
+                    with torch.inference_mode():
+                        model(images, sizes)
+                return run, batch_size, 10
+
+            # A training step without the optimizer: forward pass, CTC loss and backward pass
+            model.train()
+            ctc_loss = nn.CTCLoss()
+            labels, label_lengths = synthetic_labels(sizes[:, 1], num_classes, generator)
+            def run():
+                model.zero_grad()
+                probs, prob_lengths = model(images, sizes)
+                loss = ctc_loss(probs.transpose(0, 1), labels, prob_lengths[:, 0], label_lengths)
+                loss.backward()
+            return run, batch_size, 5
+        return setup
+    for batch_size in args.batch_sizes:
+        for width in args.widths:
+            cases.append(("model_forward_b{}_w{}".format(batch_size, width), model_case(batch_size, width, False)))
+            cases.append(("model_forward_backward_b{}_w{}".format(batch_size, width), model_case(batch_size, width, True)))
+
+    # Decoders and metrics run on a batch of validation size outputs
+    def decoder_case(beam_width):
+        def setup():
+            generator = torch.Generator().manual_seed(0)
+            probs, lengths = synthetic_log_probs(args.decode_batch_size, args.decode_length, num_classes, generator=generator)
+            if beam_width is None:
+                decoder = CTCGreedyDecoder()
+                return lambda: decoder(probs, lengths), args.decode_batch_size, 100
+            decoder = CTCBeamDecoder()
+            return lambda: decoder(probs, lengths, beam_width=beam_width), args.decode_batch_size, 3
+        return setup
+    cases.append(("greedy_decoder", decoder_case(None)))
+    for beam_width in args.beam_widths:
+        cases.append(("beam_decoder_k{}".format(beam_width), decoder_case(beam_width)))
+
+    def accuracy_setup():
+        generator = torch.Generator().manual_seed(0)
+        probs, lengths = synthetic_log_probs(args.decode_batch_size, args.decode_length, num_classes, generator=generator)
+        decoded, _ = CTCGreedyDecoder()(probs, lengths)
+        labels, label_lengths = synthetic_labels(lengths * 2, num_classes, generator)
+        metric = SequenceAccuracy()
+        return lambda: metric(decoded, labels, label_lengths), args.decode_batch_size, 100
+    cases.append(("sequence_accuracy", accuracy_setup))
+
+    return cases
+
+# Runs in a fresh process, so the peak memory of every case is measured on its own: how far the
+# warmup and timed calls raise the resident memory above what it was after the setup. The calls are
+# timed in several rounds, and the fastest round's median (latency_best_p50) is what gets compared
+# with the baseline, as it is far less noisy than a single median. How far the round medians spread
+# (latency_spread) is a measure of the case's noise.
+def run_case(args, dataset_dir, name):
+    torch.set_num_threads(args.threads)
+    setup = dict(benchmark_cases(args, dataset_dir))[name]
+    fn, items_per_call, calls = setup()
+    calls = max(int(calls * args.repeat_scale), 1)
+
+    before = reset_peak_rss()
+    fn()
+    rounds = [np.array(time_calls(fn, repeat=calls, warmup=0)) for _ in range(args.rounds)]
+    times = np.concatenate(rounds)
+    medians = [np.percentile(x, 50) for x in rounds]
+    return {
+        "items_per_call": items_per_call,
+        "calls": calls * args.rounds,
+        "throughput": items_per_call * times.size / max(times.sum(), 1e-9),
+        "latency_p50": float(np.percentile(times, 50)),
+        "latency_p99": float(np.percentile(times, 99)),
+        "latency_best_p50": float(min(medians)),
+        "latency_spread": float(max(medians) - min(medians)),
+        "peak_rss": max(peak_rss() - before, 0),
+    }
+
+# Compares results with a baseline, printing every case that both have, and returns the names of the
+# cases whose best round median latency or peak memory got worse by more than the tolerances. On top
+# of the tolerance, a case's latency may grow by noise_multiple times the spread of its baseline
+# rounds, so the floor scales with each case's own noise. The memory gets some absolute slack, as
+# the smallest cases barely raise the peak memory.
+def compare_results(results, baseline, tolerance, memory_tolerance, noise_multiple=3.0, memory_slack=16 * 2**20):
+    regressions = []
+    print("{:36} {:>12} {:>12} {:>8} {:>10} {:>10}".format(
+        "Case", "p50 (base)", "p50", "change", "RSS (base)", "RSS"), file=sys.stderr)
+    for name, result in results.items():
+        if not name in baseline or not "latency_best_p50" in baseline[name]:
+            continue
+        base = baseline[name]
+        change = result["latency_best_p50"] / max(base["latency_best_p50"], 1e-9) - 1.0
+        noise = noise_multiple * base.get("latency_spread", 0.0)
+        slower = result["latency_best_p50"] > base["latency_best_p50"] * (1.0 + tolerance) + noise
+        bigger = result["peak_rss"] > base["peak_rss"] * (1.0 + memory_tolerance) + memory_slack
+        if slower or bigger:
+            regressions.append(name)
+        print("{:36} {:>10.2f}ms {:>10.2f}ms {:>+7.1%} {:>8.1f}MB {:>8.1f}MB{}".format(
+            name, base["latency_best_p50"] * 1000.0, result["latency_best_p50"] * 1000.0, change,
+            base["peak_rss"] / 2**20, result["peak_rss"] / 2**20, "  REGRESSION" if slower or bigger else ""), file=sys.stderr)
+    return regressions
+
+# Times the hot paths of training and inference on synthetic data (no GPU, network or dataset needed)
+# and writes throughput, p50/p99 latency and peak resident memory per case as JSON. Results are
+# compared with a stored baseline (benchmarks/baseline.json unless --baseline is given) and the exit
+# status is 1 if any case regressed. Timings depend on the machine, so the stored baseline should be
+# regenerated with --update_baseline on the machine that compares against it (against a baseline made
+# with a different configuration, regressions are only reported). Run from the python
+# directory: python -m benchmarks.suite
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o", type=Path, required=False,
+                        help="Where to write the results (printed if not given).")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH,
+                        help="The results to compare with.")
+    parser.add_argument("--update_baseline", action="store_true",
+                        help="Write the results to the baseline file instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower (relative) a case's best round median latency may get.")
+    parser.add_argument("--noise_multiple", type=float, default=3.0,
+                        help="How many times the spread of its baseline rounds a case may get slower on top of the tolerance.")
+    parser.add_argument("--memory_tolerance", type=float, default=0.25,
+                        help="How much (relative) a case's peak memory may grow.")
+    parser.add_argument("--cases", type=str, default=".*",
+                        help="A regular expression the names of the cases to run have to match.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[128, 512],
+                        help="The image widths of the model cases.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8],
+                        help="The batch sizes of the collate and model cases.")
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[1, 10],
+                        help="The beam widths of the beam decoder cases.")
+    parser.add_argument("--decode_batch_size", type=int, default=32,
+                        help="The batch size of the decoder and metric cases.")
+    parser.add_argument("--decode_length", type=int, default=100,
+                        help="The sequence length of the decoder and metric cases.")
+    parser.add_argument("--num_samples", type=int, default=64,
+                        help="The number of images in the synthetic dataset.")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="The number of rounds the calls of every case are timed in.")
+    parser.add_argument("--repeat_scale", type=float, default=1.0,
+                        help="Scales the number of timed calls of every case.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="The number of threads every case runs with.")
+
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    dataset_dir = Path(tmp_dir.name)
+    write_synthetic_dataset(dataset_dir, args.num_samples)
+
+    pool_context = multiprocessing.get_context("spawn")
+    results = {}
+    for name, _ in benchmark_cases(args, dataset_dir):
+        if re.search(args.cases, name) is None:
+            continue
+        pool = pool_context.Pool(1)
+        results[name] = pool.apply(run_case, (args, dataset_dir, name))
+        pool.close()
+        pool.join()
+        print("{}: {:.1f} items/s, p50 {:.2f}ms, p99 {:.2f}ms, peak memory +{:.1f}MB".format(
+            name, results[name]["throughput"], results[name]["latency_p50"] * 1000.0,
+            results[name]["latency_p99"] * 1000.0, results[name]["peak_rss"] / 2**20), file=sys.stderr)
+    tmp_dir.cleanup()
+
+    report = {
+        "config": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "threads": args.threads,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.update_baseline:
+        args.output = args.baseline
+    if not args.output is None:
+        f = open(args.output, "w")
+        f.write(text + "\n")
+        f.close()
+    else:
+        print(text)
+
+    if not args.update_baseline and args.baseline.exists():
+        f = open(args.baseline, "r")
+        baseline = json.load(f)
+        f.close()
+        # Timings from another machine or library version aren't comparable, so only report those
+        same_config = baseline["config"] == report["config"]
+        regressions = compare_results(results, baseline["results"], args.tolerance, args.memory_tolerance, args.noise_multiple)
+        if not same_config:
+            print("The baseline was made with a different configuration ({}), not failing on regressions. Regenerate it "
+                  "with --update_baseline on this machine.".format(json.dumps(baseline["config"])), file=sys.stderr)
+        elif len(regressions) > 0:
+            print("Regressions: " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+import tempfile
+import weakref
+import numpy as np
+import torch
+
+# Counter slots at the start of the cache file
+HITS = 0
+MISSES = 1
+EVICTIONS = 2
+LRU_HEAD = 3 # Most recently used sample
+LRU_TAIL = 4 # Least recently used sample
+FREE_HEAD = 5
+FREE_COUNT = 6
+BYTES_USED = 7
+NUM_COUNTERS = 8
+
+# Per sample entry fields
+FIRST_BLOCK = 0
+WIDTH = 1 # -1 when the sample isn't cached
+LABEL_LENGTH = 2
+LRU_PREV = 3
+LRU_NEXT = 4
+NUM_ENTRY_FIELDS = 5
+
+def _remove_cache_file(path, owner_pid):
+    # Forked workers inherit the finalizer, only the process that created the file removes it
+    if os.getpid() == owner_pid and os.path.exists(path):
+        os.remove(path)
+
+# A cache of decoded images (uint8 alpha channel, width first) and encoded labels that is shared by
+# all DataLoader worker processes. Everything, including the bookkeeping, lives in one memory mapped
+# file, so the cache survives worker restarts and is never duplicated per worker.
+#
+# The data arena is split into fixed size blocks. A cached sample occupies a chain of blocks (linked
+# through a next block table like a FAT), which lets samples of any width be stored without
+# fragmenting the arena. Samples are evicted in least recently used order once the byte budget is
+# used up.
+class SharedSampleCache():
+    def __init__(self, num_samples, max_bytes, height=32, block_size=4096, cache_dir=None):
+        self.num_samples = num_samples
+        self.height = height
+        self.block_size = block_size
+        self.num_blocks = max(max_bytes // block_size, 1)
+
+        fd, self.path = tempfile.mkstemp(prefix="sample_cache_", suffix=".bin", dir=cache_dir)
+        os.close(fd)
+        weakref.finalize(self, _remove_cache_file, self.path, os.getpid())
+
+        self._layout()
+        f = open(self.path, "wb")
+        f.truncate(self.data_offset + self.num_blocks * self.block_size)
+        f.close()
+        self._open()
+
+        # Nothing is cached and every block is in the free list
+        self.counters[:] = 0
+        self.counters[LRU_HEAD] = -1
+        self.counters[LRU_TAIL] = -1
+        self.counters[FREE_HEAD] = 0
+        self.counters[FREE_COUNT] = self.num_blocks
+        self.entries[:, WIDTH] = -1
+        self.next_block[:] = np.arange(1, self.num_blocks + 1, dtype=np.int32)
+        self.next_block[-1] = -1
+
+        self.lock = multiprocessing.Lock()
+
+    def _layout(self):
+        self.entries_offset = NUM_COUNTERS * 8
+        self.blocks_offset = self.entries_offset + self.num_samples * NUM_ENTRY_FIELDS * 4
+        self.data_offset = self.blocks_offset + self.num_blocks * 4
+        self.data_offset += (-self.data_offset) % 64
+
+    def _open(self):
+        self.counters = np.memmap(self.path, dtype=np.int64, mode="r+", offset=0, shape=(NUM_COUNTERS,))
+        self.entries = np.memmap(self.path, dtype=np.int32, mode="r+", offset=self.entries_offset,
+                                 shape=(self.num_samples, NUM_ENTRY_FIELDS))
+        self.next_block = np.memmap(self.path, dtype=np.int32, mode="r+", offset=self.blocks_offset,
+                                    shape=(self.num_blocks,))
+        self.data = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=self.data_offset,
+                              shape=(self.num_blocks, self.block_size))
+
+    # Workers started with the spawn method reopen the file instead of copying the mappings
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ["counters", "entries", "next_block", "data"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _unlink(self, idx):
+        prev_idx = self.entries[idx, LRU_PREV]
+        next_idx = self.entries[idx, LRU_NEXT]
+        if prev_idx >= 0:
+            self.entries[prev_idx, LRU_NEXT] = next_idx
+        else:
+            self.counters[LRU_HEAD] = next_idx
+        if next_idx >= 0:
+            self.entries[next_idx, LRU_PREV] = prev_idx
+        else:
+            self.counters[LRU_TAIL] = prev_idx
+
+    def _push_front(self, idx):
+        head = self.counters[LRU_HEAD]
+        self.entries[idx, LRU_PREV] = -1
+        self.entries[idx, LRU_NEXT] = head
+        if head >= 0:
+            self.entries[head, LRU_PREV] = idx
+        else:
+            self.counters[LRU_TAIL] = idx
+        self.counters[LRU_HEAD] = idx
+
+    def _num_bytes(self, width, label_length):
+        return width * self.height + label_length * 8
+
+    def _num_blocks(self, num_bytes):
+        return max((num_bytes + self.block_size - 1) // self.block_size, 1)
+
+    def _evict_lru(self):
+        idx = int(self.counters[LRU_TAIL])
+        self._unlink(idx)
+
+        # Return the sample's block chain to the free list
+        num_bytes = self._num_bytes(int(self.entries[idx, WIDTH]), int(self.entries[idx, LABEL_LENGTH]))
+        first = int(self.entries[idx, FIRST_BLOCK])
+        last = first
+        while self.next_block[last] >= 0:
+            last = int(self.next_block[last])
+        self.next_block[last] = self.counters[FREE_HEAD]
+        self.counters[FREE_HEAD] = first
+        self.counters[FREE_COUNT] += self._num_blocks(num_bytes)
+        self.counters[BYTES_USED] -= num_bytes
+
+        self.entries[idx, WIDTH] = -1
+        self.counters[EVICTIONS] += 1
+
+    def get(self, idx):
+        with self.lock:
+            width = int(self.entries[idx, WIDTH])
+            if width < 0:
+                self.counters[MISSES] += 1
+                return None
+
+            self.counters[HITS] += 1
+            self._unlink(idx)
+            self._push_front(idx)
+
+            label_length = int(self.entries[idx, LABEL_LENGTH])
+            buffer = np.empty(self._num_bytes(width, label_length), dtype=np.uint8)
+            block = int(self.entries[idx, FIRST_BLOCK])
+            for start in range(0, max(buffer.size, 1), self.block_size):
+                end = min(start + self.block_size, buffer.size)
+                buffer[start:end] = self.data[block, :end - start]
+                block = int(self.next_block[block])
+
+        image = buffer[:width * self.height].reshape((width, self.height))
+        label = buffer[width * self.height:].view(np.int64)
+        return torch.from_numpy(image), torch.from_numpy(label)
+
+    def put(self, idx, image, label):
+        # Image is a uint8 tensor of shape (width, height), label is a long tensor
+        buffer = np.concatenate((image.numpy().reshape(-1), label.numpy().view(np.uint8)))
+        num_blocks = self._num_blocks(buffer.size)
+        if num_blocks > self.num_blocks:
+            return
+
+        with self.lock:
+            # Another worker may have cached the sample in the meantime
+            if self.entries[idx, WIDTH] >= 0:
+                return
+
+            while self.counters[FREE_COUNT] < num_blocks:
+                self._evict_lru()
+
+            # Take blocks off the free list, copying the data in as we go
+            first = int(self.counters[FREE_HEAD])
+            block = first
+            for start in range(0, max(buffer.size, 1), self.block_size):
+                end = min(start + self.block_size, buffer.size)
+                self.data[block, :end - start] = buffer[start:end]
+                last = block
+                block = int(self.next_block[block])
+            self.next_block[last] = -1
+            self.counters[FREE_HEAD] = block
+            self.counters[FREE_COUNT] -= num_blocks
+            self.counters[BYTES_USED] += buffer.size
+
+            self.entries[idx, FIRST_BLOCK] = first
+            self.entries[idx, WIDTH] = image.size(0)
+            self.entries[idx, LABEL_LENGTH] = label.size(0)
+            self._push_front(idx)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": int(self.counters[HITS]),
+                "misses": int(self.counters[MISSES]),
+                "evictions": int(self.counters[EVICTIONS]),
+                "bytes_used": int(self.counters[BYTES_USED]),
+            }
@@ -0,0 +1,155 @@
+import atexit
+import os
+from pathlib import Path
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+# Copies every tensor in a (nested) state dict to the cpu. Tensors already on the cpu are cloned since
+# training keeps updating them in place.
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [_to_cpu(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_to_cpu(v) for v in obj)
+    return obj
+
+# The random number generator states, as tensors and plain numbers only so checkpoints can be loaded
+# with weights_only (the python and numpy states are tuples holding ints and a numpy array)
+def rng_state():
+    python_version, python_keys, python_gauss = random.getstate()
+    numpy_name, numpy_keys, numpy_pos, numpy_has_gauss, numpy_gauss = np.random.get_state()
+    state = {
+        "python": {"version": python_version, "keys": torch.tensor(python_keys, dtype=torch.int64), "gauss": python_gauss},
+        "numpy": {"name": numpy_name, "keys": torch.from_numpy(numpy_keys.astype(np.int64)), "pos": int(numpy_pos),
+                  "has_gauss": int(numpy_has_gauss), "gauss": float(numpy_gauss)},
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    python = state["python"]
+    random.setstate((python["version"], tuple(python["keys"].tolist()), python["gauss"]))
+    numpy = state["numpy"]
+    np.random.set_state((numpy["name"], numpy["keys"].numpy().astype(np.uint32), numpy["pos"], numpy["has_gauss"], numpy["gauss"]))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+# Everything needed to pick training back up where it left off. epoch is the last completed epoch and
+# step the number of optimizer steps taken so far. rng_states holds the RNG state of every training
+# process in rank order (just this process's if not given).
+def training_state(model, optimizer, lr_scheduler, scaler, epoch, step, rng_states=None):
+    return {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "scaler": scaler.state_dict(),
+        "epoch": epoch,
+        "step": step,
+        "rng": rng_states if not rng_states is None else [rng_state()],
+    }
+
+# Finds the checkpoint with the highest epoch in a directory
+def latest_checkpoint(directory):
+    checkpoints = list(Path(directory).glob("checkpoint_*.pt"))
+    if len(checkpoints) == 0:
+        raise FileNotFoundError("No checkpoints found in " + str(directory))
+    return max(checkpoints, key=lambda p: int(p.stem.split("_")[1]))
+
+# Restores a checkpoint saved with CheckpointWriter, returning the epoch and step it was saved at.
+# path may also be a training output directory, in which case the latest checkpoint in it is used.
+# Each process gets back the RNG state of the process with its rank. Processes the checkpoint has no
+# state for (resuming with more processes than it was saved with) keep their own fresh state.
+def load_checkpoint(path, model, optimizer, lr_scheduler, scaler, rank=0):
+    path = Path(path)
+    if path.is_dir():
+        path = latest_checkpoint(path)
+
+    checkpoint = torch.load(path, map_location=torch.device("cpu"), weights_only=True)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+    # A disabled scaler saves an empty state, which an enabled one can't load (and doesn't need)
+    if scaler.is_enabled() and len(checkpoint["scaler"]) > 0:
+        scaler.load_state_dict(checkpoint["scaler"])
+    rng_states = checkpoint["rng"]
+    if isinstance(rng_states, dict):
+        rng_states = [rng_states]
+    if rank < len(rng_states):
+        set_rng_state(rng_states[rank])
+
+    return checkpoint["epoch"], checkpoint["step"]
+
+# Saves checkpoints from a background thread, so the training loop only pays for copying the state to
+# the cpu. Full training state goes to checkpoint_<epoch>.pt, of which only the last keep_last are
+# kept (all of them if keep_last is None), and the model weights alone to epoch_<epoch>.pt as before.
+# Files are written under a temporary name and renamed, so an interrupted write never leaves a
+# truncated checkpoint behind.
+class CheckpointWriter():
+    def __init__(self, out_dir, keep_last=None):
+        self.out_dir = Path(out_dir)
+        self.keep_last = keep_last
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        # Finish queued writes when training is stopped (e.g. with ctrl-c)
+        atexit.register(self.close)
+
+    def _write(self, obj, path):
+        tmp_path = path.with_name(path.name + ".tmp")
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _rotate(self):
+        if self.keep_last is None:
+            return
+        checkpoints = sorted(self.out_dir.glob("checkpoint_*.pt"), key=lambda p: int(p.stem.split("_")[1]))
+        for path in checkpoints[:max(len(checkpoints) - self.keep_last, 0)]:
+            path.unlink()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, state = item
+                self._write(state["model"], self.out_dir / ("epoch_" + str(epoch) + ".pt"))
+                self._write(state, self.out_dir / ("checkpoint_" + str(epoch) + ".pt"))
+                self._rotate()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if not self.error is None:
+            error = self.error
+            self.error = None
+            raise RuntimeError("Writing checkpoint failed") from error
+
+    def save(self, epoch, state):
+        self._check_error()
+        self.queue.put((epoch, _to_cpu(state)))
+
+    # Blocks until all queued checkpoints are written
+    def flush(self):
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check_error()
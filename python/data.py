@@ -1,25 +1,31 @@
 import json
+import math
+import os
+import queue
+import threading
+import time
 import numpy as np
 import torch
 import torchvision
 from torch import nn
 from PIL import Image
 
+from cache import *
+from shards import *
+
+# Image widths of PNG datasets are cached next to labels.json, as reading them means opening every
+# image. The cache is tied to the size and modification time of labels.json.
+WIDTHS_MANIFEST = "widths.json"
+
 class TextDataset(torch.utils.data.Dataset):
-    def __init__(self, data_dir, augmentation=False):
+    def __init__(self, data_dir, augmentation=False, cache_size=0, cache_dir=None):
         self.data_dir = data_dir
         self.augmentation = augmentation
 
-        f = open(data_dir / "labels.json", "r")
-        data = json.load(f)
-        f.close()
-
         f = open(data_dir / "codec.json", "r")
         codec = json.load(f)
         f.close()
 
-        self.image_extension = data["ImageExtension"]
-
         self.classes = ['<BLNK>']
         for char in codec:
             self.classes.append(char["Char"])
@@ -27,52 +33,112 @@ class TextDataset(torch.utils.data.Dataset):
         for char in self.classes:
             self.class_map[char] = len(self.class_map)
 
-        self.image_labels = data["Lines"]
+        # Packed datasets (see pack.py) are read straight from memory mapped shards
+        if (data_dir / SHARD_MANIFEST).exists():
+            self.shards = ShardedData(data_dir)
+            self.image_labels = None
+        else:
+            f = open(data_dir / "labels.json", "r")
+            data = json.load(f)
+            f.close()
+
+            self.shards = None
+            self.image_extension = data["ImageExtension"]
+            self.image_labels = data["Lines"]
+
+        # Decoded PNGs are kept in a cache shared by all worker processes (shards don't need one)
+        if self.shards is None and cache_size > 0:
+            self.cache = SharedSampleCache(len(self.image_labels), cache_size, cache_dir=cache_dir)
+        else:
+            self.cache = None
 
         if self.augmentation:
             self.rand_translate = torchvision.transforms.RandomAffine(degrees=0, translate=(0.1, 0.0))
 
     def __len__(self):
+        if not self.shards is None:
+            return len(self.shards)
         return len(self.image_labels)
 
-    def __getitem__(self, idx):
+    def widths(self):
+        # Un-augmented image widths of all samples (only the PNG headers are read, the first time)
+        if not self.shards is None:
+            return self.shards.widths()
+
+        stat = os.stat(self.data_dir / "labels.json")
+        labels_key = [stat.st_size, stat.st_mtime_ns]
+        path = self.data_dir / WIDTHS_MANIFEST
+        if path.exists():
+            f = open(path, "r")
+            manifest = json.load(f)
+            f.close()
+            if manifest["Labels"] == labels_key and len(manifest["Widths"]) == len(self.image_labels):
+                return np.asarray(manifest["Widths"], dtype=np.int64)
+
+        widths = np.zeros(len(self.image_labels), dtype=np.int64)
+        for i, annotation in enumerate(self.image_labels):
+            img = Image.open(str(self.data_dir / str(annotation["Image"])) + self.image_extension, "r")
+            widths[i] = img.width
+            img.close()
+
+        # Written to a temporary file first, as other processes may be reading it. Read only datasets
+        # just aren't cached
+        tmp_path = path.with_name(path.name + "." + str(os.getpid()) + ".tmp")
+        try:
+            f = open(tmp_path, "w")
+            json.dump({"Labels": labels_key, "Widths": widths.tolist()}, f)
+            f.close()
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+        return widths
+
+    def _load(self, idx):
+        # Returns the image as a uint8 tensor (width first) and the encoded label
+        if not self.shards is None:
+            return self.shards[idx]
+
+        if not self.cache is None:
+            cached = self.cache.get(idx)
+            if not cached is None:
+                return cached
+
         annotation = self.image_labels[idx]
         path = str(self.data_dir / str(annotation["Image"])) + self.image_extension
 
-        # Load an convert image to torch tensor
-        if not "LoadedImage" in annotation:
-            img = Image.open(path, "r")
-            assert img.height == 32
-            img_data = np.asarray(img)
-            img_data = img_data[:, :, -1] # use only alpha channel
-            img_data = img_data.astype(np.float32) / 255.0
-            img_tensor = torch.from_numpy(img_data)
-            img_tensor = img_tensor.transpose(0, 1) # Make width come first
-            img_tensor = img_tensor.unsqueeze(0) # Add one channel
-            annotation["LoadedImage"] = img_tensor
-
-        # Load and encode label
-        if not "EncodedLabel" in annotation:
-            label = torch.zeros(len(annotation["Text"]), dtype=torch.long)
-            for i in range(len(annotation["Text"])):
-                label[i] = self.class_map[annotation["Text"][i]]
-            annotation["EncodedLabel"] = label
+        # Load image and encode label
+        image = torch.from_numpy(load_alpha_image(path))
+        label = torch.zeros(len(annotation["Text"]), dtype=torch.long)
+        for i in range(len(annotation["Text"])):
+            label[i] = self.class_map[annotation["Text"][i]]
 
+        if not self.cache is None:
+            self.cache.put(idx, image, label)
+
+        return image, label
+
+    def __getitem__(self, idx):
+        image, label = self._load(idx)
+
+        # Convert image to float and add one channel
+        img_tensor = image.float() / 255.0
+        img_tensor = img_tensor.unsqueeze(0)
+
+        return self._augment(img_tensor), label
+
+    def _augment(self, img):
         # Do augmentation
         if self.augmentation:
-            img = annotation["LoadedImage"]
             size = img.size()
             rand_resize = 0.85 + torch.rand(1) * 0.55
             width = int(size[1] * rand_resize + 0.5)
             out_img = torchvision.transforms.Resize((width, size[2]))(img)
             out_img = self.rand_translate(out_img)
         else:
-            out_img = annotation["LoadedImage"]
+            out_img = img
 
         # Remove channel dimension (because pad_sequence in the batch collate fn needs it gone anyways)
-        out_img = out_img.squeeze(0)
-
-        return out_img, annotation["EncodedLabel"]
+        return out_img.squeeze(0)
 
 def padded_sorted_collate(batch):
     # Reverse sort by image width
@@ -92,3 +158,287 @@ def padded_sorted_collate(batch):
     padded_labels = nn.utils.rnn.pad_sequence(labels, batch_first=True)
 
     return [padded_images, padded_labels, image_sizes, label_sizes]
+
+# Batches samples of similar width together so little compute is spent on padding. Every epoch the
+# dataset is shuffled and cut into pools of bucket_size batches, each pool is sorted by width and
+# split into batches, and finally the order of all batches is shuffled. Batches either hold a fixed
+# number of samples, or (if max_batch_width is given) as many samples as fit in a padded width budget
+# of batch size * widest image.
+class WidthBucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, widths, batch_size=8, max_batch_width=None, bucket_size=100, shuffle=True, drop_last=False,
+                 num_replicas=1, rank=0, seed=0):
+        self.widths = np.asarray(widths)
+        self.batch_size = batch_size
+        self.max_batch_width = max_batch_width
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.next_batches = None
+
+    # Like DistributedSampler, all replicas must plan the same epoch to get disjoint batches
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.next_batches = None
+
+    def _split(self, indices):
+        # Split width sorted indices into batches
+        if self.max_batch_width is None:
+            batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+            if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            return batches
+
+        batches = []
+        start = 0
+        for i in range(1, len(indices) + 1):
+            # Sorted ascending, so the widest image of a batch is always its last one
+            if i == len(indices) or (i - start + 1) * self.widths[indices[i]] > self.max_batch_width:
+                batches.append(indices[start:i])
+                start = i
+        return batches
+
+    def _plan(self):
+        if not self.shuffle:
+            # Deterministic order, just sort the whole dataset by width
+            order = np.argsort(self.widths, kind="stable")
+            return self._distribute([x.tolist() for x in self._split(order)])
+
+        # Replicas share a seeded generator so they all plan the same batches
+        rng = np.random if self.num_replicas == 1 else np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.widths))
+        pool_size = self.bucket_size * (self.batch_size if self.max_batch_width is None else 1)
+        if self.max_batch_width is not None:
+            # Pools hold roughly bucket_size batches worth of padded width
+            mean_width = self.widths.mean() if len(self.widths) > 0 else 1
+            pool_size = max(int(self.bucket_size * self.max_batch_width / max(mean_width, 1)), 1)
+
+        batches = []
+        for i in range(0, len(order), pool_size):
+            pool = order[i:i + pool_size]
+            pool = pool[np.argsort(self.widths[pool], kind="stable")]
+            batches.extend(self._split(pool))
+
+        return self._distribute([batches[i].tolist() for i in rng.permutation(len(batches))])
+
+    # Deal the batches out to the replicas, repeating some so every replica gets the same number of
+    # batches (otherwise replicas would wait on each other's gradients at the end of an epoch)
+    def _distribute(self, batches):
+        if self.num_replicas == 1 or len(batches) == 0:
+            return batches
+        # Repeat cyclically, as there may be fewer batches than replicas
+        total = len(batches) + -len(batches) % self.num_replicas
+        batches = (batches * math.ceil(total / len(batches)))[:total]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        batches = self.next_batches if not self.next_batches is None else self._plan()
+        self.next_batches = None
+        return iter(batches)
+
+    def __len__(self):
+        # With a width budget the number of batches depends on the shuffle, so plan the next epoch now
+        if self.next_batches is None:
+            self.next_batches = self._plan()
+        return len(self.next_batches)
+
+# Wraps a DataLoader (of padded_sorted_collate batches) and moves the next depth batches to the device
+# in a background thread while the current step computes. On CUDA the copies are non-blocking copies
+# from pinned memory issued on a side stream, which the consuming stream waits on without blocking the
+# host. transform (e.g. BatchAugmentation) runs in the background too, after the images and labels
+# are on the device but while the sizes are still on the cpu. Image sizes stay on the cpu, where the
+# model computes sequence lengths from them without waiting for the device, and so do label lengths,
+# as the CTC loss reads its lengths on the cpu (from the device, that's a sync). wait_time is how long the
+# last epoch spent waiting for data, and copy_time how long the background thread spent moving (and
+# transforming) batches.
+class DevicePrefetcher():
+    def __init__(self, dataloader, device, depth=2, transform=None):
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.transform = transform
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.wait_time = 0.0
+        self._copy_time = 0.0
+        self.copy_events = []
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        imgs, lbls, img_lens, lbl_lens = batch
+        imgs = imgs.to(self.device, non_blocking=True)
+        lbls = lbls.to(self.device, non_blocking=True)
+        if not self.transform is None:
+            imgs, lbls, img_lens, lbl_lens = self.transform(imgs, lbls, img_lens, lbl_lens)
+        return [imgs, lbls, img_lens, lbl_lens]
+
+    # Time spent copying (and transforming) batches. On CUDA the copies run asynchronously on the side
+    # stream, so they're timed with events around them on that stream, which are read back here (after
+    # waiting for the last ones) or while iterating once they've completed
+    @property
+    def copy_time(self):
+        self._collect(wait=True)
+        return self._copy_time
+
+    def _collect(self, wait=False):
+        if wait and len(self.copy_events) > 0:
+            self.copy_events[-1][1].synchronize()
+        while len(self.copy_events) > 0 and self.copy_events[0][1].query():
+            start, end = self.copy_events.pop(0)
+            self._copy_time += start.elapsed_time(end) / 1000.0
+
+    # Puts an item on the queue unless the consumer has stopped. Returns whether it was put
+    def _put(self, batches, stop, item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterator, batches, stop):
+        try:
+            for batch in iterator:
+                if self.stream is None:
+                    start = time.perf_counter()
+                    batch, events = self._to_device(batch), None
+                    self._copy_time += time.perf_counter() - start
+                else:
+                    with torch.cuda.stream(self.stream):
+                        start = torch.cuda.Event(enable_timing=True)
+                        ready = torch.cuda.Event(enable_timing=True)
+                        start.record(self.stream)
+                        batch = self._to_device(batch)
+                        ready.record(self.stream)
+                    events = (start, ready)
+                if not self._put(batches, stop, (batch, events)):
+                    return
+            self._put(batches, stop, None)
+        except Exception as e:
+            self._put(batches, stop, e)
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self._copy_time = 0.0
+        self.copy_events = []
+        batches = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._run, args=(iter(self.dataloader), batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                batch, events = item
+                if not events is None:
+                    self._collect()
+                    self.copy_events.append(events)
+
+                    # Make the compute stream wait for the copies, and keep the memory from being reused
+                    # by the side stream until the compute stream is done with it
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(events[1])
+                    for x in batch:
+                        if x.device.type == "cuda":
+                            x.record_stream(stream)
+                yield batch
+        finally:
+            # Stop the thread if iteration ended early (an exception, a break) and wait for it, so it
+            # doesn't keep the DataLoader iterator and its workers alive
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+# Decodes a whole (un-augmented) dataset once and keeps it on the device as fixed, width sorted,
+# pre-collated batches, so iterating over it needs no DataLoader, no worker processes and no padding.
+# Meant for validation sets and small training sets. Images are packed into one uint8 tensor with a
+# width/offset index, from which each batch is gathered with a single indexing operation at startup.
+# Batches hold uint8 images and are converted to float when iterated. Like DevicePrefetcher, image
+# sizes and label lengths are kept on the cpu.
+#
+# indices restricts the batches to a subset of the dataset. With num_replicas > 1 the batches are
+# dealt out to replicas like WidthBucketBatchSampler does, so each gets the same number. shuffle only
+# shuffles the order of the (fixed) batches every epoch.
+class DeviceResidentBatches():
+    def __init__(self, dataset, device, batch_size=8, max_batch_width=None, shuffle=False, indices=None, num_replicas=1, rank=0):
+        self.device = device
+        self.shuffle = shuffle
+        # Nothing to wait for, kept for parity with DevicePrefetcher
+        self.wait_time = 0.0
+        self.copy_time = 0.0
+
+        indices = np.arange(len(dataset)) if indices is None else np.asarray(indices, dtype=np.int64)
+
+        # A replica can get no validation samples at all (fewer samples than replicas)
+        self.batches = []
+        if len(indices) == 0:
+            return
+
+        widths = np.asarray(dataset.widths())[indices]
+        sampler = WidthBucketBatchSampler(widths, batch_size, max_batch_width, shuffle=False, num_replicas=num_replicas, rank=rank)
+        batches = list(sampler)
+
+        # Decode every sample once and pack them on the device
+        images = []
+        labels = []
+        for idx in indices:
+            image, label = dataset._load(int(idx))
+            images.append(image)
+            labels.append(label)
+        pixels = torch.cat(images).to(device)
+        packed_labels = torch.cat(labels).to(device)
+        image_widths = torch.tensor([x.size(0) for x in images], dtype=torch.long)
+        label_lengths = torch.tensor([x.size(0) for x in labels], dtype=torch.long)
+        image_offsets = torch.cumsum(image_widths, 0) - image_widths
+        label_offsets = torch.cumsum(label_lengths, 0) - label_lengths
+
+        # Gather each batch (sorted by decreasing width like padded_sorted_collate) out of the pack
+        for batch in batches:
+            batch = torch.tensor(batch, dtype=torch.long)
+            batch = batch[torch.argsort(image_widths[batch], descending=True, stable=True)]
+            self.batches.append(self._collate(pixels, image_offsets[batch], image_widths[batch],
+                                              packed_labels, label_offsets[batch], label_lengths[batch]))
+
+    def _collate(self, pixels, image_offsets, image_widths, labels, label_offsets, label_lengths):
+        height = pixels.size(1)
+
+        columns = torch.arange(int(image_widths.max()))
+        mask = columns < image_widths.unsqueeze(1)
+        source = torch.where(mask, image_offsets.unsqueeze(1) + columns, 0).to(self.device)
+        images = pixels[source] * mask.to(self.device).unsqueeze(2)
+
+        positions = torch.arange(int(label_lengths.max()) if label_lengths.size(0) > 0 else 0)
+        mask = positions < label_lengths.unsqueeze(1)
+        source = torch.where(mask, label_offsets.unsqueeze(1) + positions, 0).to(self.device)
+        batch_labels = labels[source] * mask.to(self.device)
+
+        image_sizes = torch.stack((torch.ones_like(image_widths), image_widths, torch.full_like(image_widths, height)), dim=1)
+        return [images.unsqueeze(1), batch_labels, image_sizes, label_lengths]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = torch.randperm(len(self.batches)).tolist() if self.shuffle else range(len(self.batches))
+        for i in order:
+            images, labels, image_sizes, label_sizes = self.batches[i]
+            yield [images.float() / 255.0, labels, image_sizes, label_sizes]
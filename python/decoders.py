@@ -256,31 +256,49 @@
 # license and copyright terms herein.
 
 import bisect
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import multiprocessing
+import os
 import numpy as np
 import torch
 from torch import nn
-
+import torch.multiprocessing # Registers the reductions that send tensors between processes as shared memory handles
+
+# Greedy decoding done entirely with whole batch tensor operations on the input's device, so it
+# doesn't force a sync with the host. A prediction is kept if it isn't blank, isn't a repeat of the
+# previous prediction and is within the row's length. Kept predictions are then scattered to the
+# front of their row at the position given by a cumulative sum of the keep mask.
+#
+# Trimming the output to the longest decoded row needs its length on the host, so trim=False skips
+# it and returns the output padded to the input length instead (extra columns are zero).
 class CTCGreedyDecoder(nn.Module):
     def __init__(self):
         super(CTCGreedyDecoder, self).__init__()
 
-    def forward(self, probabilities, lengths):
+    def forward(self, probabilities, lengths, trim=True):
         # Reduce to max class at each prediction
         out = torch.argmax(probabilities, dim=-1)
+        batch_size, max_length = out.shape
 
-        # Squash adjacent duplicates
-        out = [torch.unique_consecutive(x[:y]) for x, y in zip(out, lengths)]
+        # Drop blanks, adjacent duplicates and predictions past each row's length
+        steps = torch.arange(max_length, device=out.device)
+        keep = (out != 0) & (steps.unsqueeze(0) < lengths.to(out.device, non_blocking=True).unsqueeze(1))
+        keep[:, 1:] &= out[:, 1:] != out[:, :-1]
+
+        # Compact kept predictions to the front of each row. Dropped ones go to an extra column
+        positions = torch.where(keep, torch.cumsum(keep, dim=1) - 1, max_length)
+        decoded = out.new_zeros((batch_size, max_length + 1))
+        decoded.scatter_(1, positions, out)
+        decoded = decoded[:, :max_length]
 
-        # Remove blank predictions
-        out = [probabilities.new_tensor([i for i in x.tolist() if i != 0], dtype=torch.long) for x in out]
-        
         # Calculate output lengths
-        out_lengths = lengths.new_tensor([x.size(0) for x in out])
+        out_lengths = keep.sum(dim=1).to(lengths.dtype)
 
-        # Pack into one tensor
-        out = nn.utils.rnn.pad_sequence(out, batch_first=True)
+        if trim:
+            decoded = decoded[:, :int(out_lengths.max()) if batch_size > 0 else 0]
 
-        return out, out_lengths
+        return decoded, out_lengths
 
 with np.errstate(divide='ignore'):
     def logaddexp(x, y):
@@ -341,8 +359,9 @@ class BeamEntry():
         return seq
 
 class CTCBeamDecoder(nn.Module):
-    def __init__(self):
+    def __init__(self, language_model=None):
         super(CTCBeamDecoder, self).__init__()
+        self.language_model = language_model
 
     def forward(self, probabilities, lengths, beam_width=1, blank_index=0):
         device = probabilities.device
@@ -352,6 +371,7 @@ class CTCBeamDecoder(nn.Module):
 
         batch_size = probabilities.shape[0]
         num_labels = probabilities.shape[2]
+        lm_scores = None if self.language_model is None else self.language_model.scores
 
         decoded = []
         for i in range(batch_size):
@@ -381,7 +401,8 @@ class CTCBeamDecoder(nn.Module):
                             #   Plabel(l=abc @ t=6) = (Plabel(l=abc @ t=5)
                             #                          + P(l=ab @ t=5))
                             prev = b.parent.oldp.blank if b.label == b.parent.label else b.parent.oldp.total
-                            # TODO: Apply language model here (add to prev)
+                            if not lm_scores is None:
+                                prev += lm_scores[b.parent.label, b.label]
                             b.newp.label = logaddexp(b.newp.label, prev)
                         
                         # Plabel(l=abc @ t=6) *= P(c @ 6)
@@ -424,9 +445,9 @@ class CTCBeamDecoder(nn.Module):
                             #   Plabel(l=abcc @ t=6) = Pblank(l=abc @ t=5) * P(c @ 6)
                             # Otherwise:
                             #   Plabel(l=abcd @ t=6) = P(l=abc @ t=5) * P(d @ 6)
-                            # TODO: Language model here?
                             prev = b.oldp.blank if c.label == b.label else b.oldp.total
-                            # TODO: And also LM here (add to prev)
+                            if not lm_scores is None:
+                                prev += lm_scores[b.label, c.label]
                             c.newp.label = logit + prev
 
                             # P(l=abcd @ t=6) = Plabel(l=abcd @ t=6)
@@ -458,3 +479,311 @@ class CTCBeamDecoder(nn.Module):
         decoded = nn.utils.rnn.pad_sequence(decoded, batch_first=True)
 
         return decoded, decoded_lengths
+
+# Picks the next beam the slow way, replaying CTCBeamDecoder's insertions one candidate at a time.
+# This is needed when a beam whose parent is also a beam might be evicted, or when a prefix that has
+# been in the beam before might be rejected as an extension: CTCBeamDecoder offers such a beam again
+# when extending its parent, and rejecting a prefix resets its old probability. For a beam, that
+# stops it from being extended itself later in the same step. Only candidates that can still beat the
+# beam's minimum (and those two kinds of prefixes) are visited. Returns the chosen candidates, the
+# extensions, their scores and the beams and dormant prefixes whose old probabilities were reset.
+def _select_sequential(beam_width, scores, old_total, extended, valid, child_index, dormant_child):
+    size = old_total.shape[0]
+    heap = [(scores[i], -i, i) for i in range(size)] # (total, -insertion order, candidate)
+    heapq.heapify(heap)
+    evicted = np.zeros(size, dtype=bool)
+    killed = np.zeros(size, dtype=bool)
+    reset = []
+    ext_beam = []
+    ext_label = []
+    order = size
+
+    for b in range(size):
+        full = len(heap) >= beam_width
+        if killed[b] or not old_total[b] > LOG_0 or (full and not old_total[b] > heap[0][0]):
+            continue
+
+        minimum = heap[0][0] if full else LOG_0
+        for label in np.flatnonzero(valid[b] & ((extended[b] > minimum) | (child_index[b] >= 0) | (dormant_child[b] >= 0))):
+            child = child_index[b, label]
+            if child >= 0 and not evicted[child]:
+                continue
+
+            score = extended[b, label]
+            if score > LOG_0 and (len(heap) < beam_width or score > heap[0][0]):
+                ext_beam.append(b)
+                ext_label.append(label)
+                heapq.heappush(heap, (score, -order, order))
+                order += 1
+                if len(heap) > beam_width:
+                    removed = heapq.heappop(heap)[2]
+                    if removed < size:
+                        evicted[removed] = True
+            elif child >= 0:
+                killed[child] = True
+            elif dormant_child[b, label] >= 0:
+                reset.append(dormant_child[b, label])
+
+    chosen = np.array(sorted(x[2] for x in heap), dtype=np.int64)
+    ext_beam = np.array(ext_beam, dtype=np.int64)
+    ext_label = np.array(ext_label, dtype=np.int64)
+    scores = np.concatenate((scores[:size], extended[ext_beam, ext_label]))
+    return chosen, ext_beam, ext_label, scores, np.flatnonzero(killed), np.array(reset, dtype=np.int64)
+
+# Array based CTC prefix beam search over one sequence of log probabilities (shape (time, labels)).
+# It runs the same algorithm as CTCBeamDecoder, but the beam is kept as flat arrays (prefix id,
+# parent prefix id, last label and blank/label/total log probabilities) instead of a tree of
+# BeamEntry objects, and each time step is a handful of whole-array operations:
+#   1. Existing beams are moved forward, adding in the old probability of their parent prefix.
+#   2. All (beam, label) extensions are scored at once as a (beam width, labels) matrix.
+#   3. The best beam_width candidates out of both are picked with argpartition.
+# Prefixes are interned in a dict keyed by (parent prefix id, label), so a prefix that comes back
+# into the beam keeps its id. Candidates are ranked in the same order CTCBeamDecoder inserts them
+# into its beam, so ties are broken the same way and both decoders give identical results.
+#
+# CTCBeamDecoder adds in the parent's old probability whether or not the parent is still in the beam
+# (its parent check is always true), so every prefix also keeps the probabilities it had when it was
+# last in the beam. Prefixes that have left the beam without being reset ("dormant" ones) can still
+# be used that way, until they're rejected as an extension, which resets them.
+#
+# lm_scores is an optional (labels, labels) table of language model scores (see LanguageModel)
+# added whenever a prefix is extended by a character, indexed by the prefix's last label.
+def ctc_beam_search(log_probs, beam_width, blank_index=0, lm_scores=None):
+    num_labels = log_probs.shape[1]
+    labels = np.arange(num_labels)
+
+    # Interned prefixes, id 0 is the empty (root) prefix, with their old blank and total probability
+    num_prefixes = 1
+    prefix_parents = np.full(64, -1, dtype=np.int64)
+    prefix_labels = np.full(64, blank_index, dtype=np.int64)
+    old_blank = np.full(64, LOG_0)
+    old_total = np.full(64, LOG_0)
+    is_dormant = np.zeros(64, dtype=bool)
+    prefix_ids = {}
+
+    # The beam, sorted by decreasing total probability
+    ids = np.zeros(1, dtype=np.int64)
+    parents = np.full(1, -1, dtype=np.int64)
+    last = np.full(1, blank_index, dtype=np.int64)
+    blank = np.full(1, LOG_1)
+    label = np.full(1, LOG_0)
+    total = np.full(1, LOG_1)
+
+    for t in range(log_probs.shape[0]):
+        probs = log_probs[t].astype(np.float64)
+        size = ids.shape[0]
+
+        # Move beam probabilities forward a time step
+        old_blank[ids] = blank
+        old_total[ids] = total
+
+        # Locate each beam's parent prefix within the beam (if it's there)
+        sorter = np.argsort(ids)
+        parent_index = sorter[np.minimum(np.searchsorted(ids, parents, sorter=sorter), size - 1)]
+        has_parent = (parents >= 0) & (ids[parent_index] == parents)
+
+        # If last two sequence characters are identical:
+        #   Plabel(l=acc @ t=6) = (Plabel(l=acc @ t=5) + Pblank(l=ac @ t=5)) * P(c @ 6)
+        # else:
+        #   Plabel(l=abc @ t=6) = (Plabel(l=abc @ t=5) + P(l=ab @ t=5)) * P(c @ 6)
+        parent_last = prefix_labels[parents]
+        prev = np.where(last == parent_last, old_blank[parents], old_total[parents])
+        if not lm_scores is None:
+            prev = prev + lm_scores[parent_last, last]
+        new_label = logaddexp(label, prev) + probs[last]
+        new_label = np.where(parents >= 0, new_label, label) # The root has no label probability
+        # Pblank(l=abc @ t=6) = P(l=abc @ t=5) * P(- @ 6)
+        new_blank = total + probs[blank_index]
+        # P(l=abc @ t=6) = Plabel(l=abc @ t=6) + Pblank(l=abc @ t=6)
+        new_total = logaddexp(new_blank, new_label)
+
+        # If new child label is identical to beam label:
+        #   Plabel(l=abcc @ t=6) = Pblank(l=abc @ t=5) * P(c @ 6)
+        # Otherwise:
+        #   Plabel(l=abcd @ t=6) = P(l=abc @ t=5) * P(d @ 6)
+        extended = np.where(labels[None, :] == last[:, None], blank[:, None], total[:, None]) + probs[None, :]
+        if not lm_scores is None:
+            extended = extended + lm_scores[last]
+        valid = np.logical_and.outer(np.ones(size, dtype=bool), (labels != blank_index) & (probs > -9))
+
+        # Extensions that already are beams were handled above
+        child_index = np.full((size, num_labels), -1, dtype=np.int64)
+        child_index[parent_index[has_parent], last[has_parent]] = np.flatnonzero(has_parent)
+        candidate = valid & (child_index < 0) & (total > LOG_0)[:, None]
+        ext_beam, ext_label = np.nonzero(candidate)
+
+        # Dormant prefixes that are extensions of a beam (only those with an old probability matter)
+        dormant = np.flatnonzero(is_dormant[:num_prefixes])
+        dormant_child = np.full((size, num_labels), -1, dtype=np.int64)
+        dormant_parents = prefix_parents[dormant]
+        dormant_index = sorter[np.minimum(np.searchsorted(ids, dormant_parents, sorter=sorter), size - 1)]
+        in_beam = (ids[dormant_index] == dormant_parents) & (old_total[dormant] > LOG_0)
+        dormant_child[dormant_index[in_beam], prefix_labels[dormant[in_beam]]] = dormant[in_beam]
+
+        # Candidates: the existing beams followed by the extensions (beam major, label minor)
+        scores = np.concatenate((new_total, extended[ext_beam, ext_label]))
+        if scores.shape[0] > beam_width:
+            # Keep the best beam_width, letting earlier candidates win ties
+            threshold = -np.partition(-scores, beam_width - 1)[beam_width - 1]
+            above = np.flatnonzero(scores > threshold)
+            equal = np.flatnonzero(scores == threshold)[:beam_width - above.shape[0]]
+            chosen = np.sort(np.concatenate((above, equal)))
+        else:
+            chosen = np.arange(scores.shape[0])
+
+        # Losing a beam that has its parent in the beam affects which candidates there are at all,
+        # and a dormant prefix that isn't chosen may have been rejected (and reset) or only evicted
+        kept = np.zeros(size, dtype=bool)
+        kept[chosen[chosen < size]] = True
+        chosen_ext = np.zeros((size, num_labels), dtype=bool)
+        chosen_ext[ext_beam[chosen[chosen >= size] - size], ext_label[chosen[chosen >= size] - size]] = True
+        killed = reset = np.zeros(0, dtype=np.int64)
+        if np.any(has_parent & ~kept) or np.any((dormant_child >= 0) & candidate & ~chosen_ext):
+            chosen, ext_beam, ext_label, scores, killed, reset = _select_sequential(
+                beam_width, new_total, total, extended, valid, child_index, dormant_child)
+        chosen = chosen[np.argsort(-scores[chosen], kind="stable")]
+
+        # Intern the prefixes of chosen extensions
+        candidate_ids = np.concatenate((ids, np.zeros(ext_beam.shape[0], dtype=np.int64)))
+        for i in chosen[chosen >= size]:
+            key = (int(ids[ext_beam[i - size]]), int(ext_label[i - size]))
+            prefix = prefix_ids.get(key)
+            if prefix is None:
+                if num_prefixes == prefix_parents.shape[0]:
+                    prefix_parents = np.concatenate((prefix_parents, np.full(num_prefixes, -1, dtype=np.int64)))
+                    prefix_labels = np.concatenate((prefix_labels, np.full(num_prefixes, blank_index, dtype=np.int64)))
+                    old_blank = np.concatenate((old_blank, np.full(num_prefixes, LOG_0)))
+                    old_total = np.concatenate((old_total, np.full(num_prefixes, LOG_0)))
+                    is_dormant = np.concatenate((is_dormant, np.zeros(num_prefixes, dtype=bool)))
+                prefix = num_prefixes
+                num_prefixes += 1
+                prefix_ids[key] = prefix
+                prefix_parents[prefix] = key[0]
+                prefix_labels[prefix] = key[1]
+            candidate_ids[i] = prefix
+
+        # Rejected prefixes lose their old probability, beams that left otherwise become dormant
+        reset = np.concatenate((ids[killed], reset))
+        old_blank[reset] = LOG_0
+        old_total[reset] = LOG_0
+        new_ids = candidate_ids[chosen]
+        is_dormant[ids] = True
+        is_dormant[reset] = False
+        is_dormant[new_ids] = False
+
+        # Pblank(l=abcd @ t=6) = 0 and P(l=abcd @ t=6) = Plabel(l=abcd @ t=6) for extensions
+        parents = np.concatenate((parents, ids[ext_beam]))[chosen]
+        last = np.concatenate((last, ext_label))[chosen]
+        blank = np.concatenate((new_blank, np.full(ext_beam.shape[0], LOG_0)))[chosen]
+        label = np.concatenate((new_label, scores[size:]))[chosen]
+        total = scores[chosen]
+        ids = new_ids
+
+    # Follow the best prefix back to the root
+    seq = []
+    prefix = int(ids[0])
+    while prefix != 0:
+        seq.append(int(prefix_labels[prefix]))
+        prefix = int(prefix_parents[prefix])
+    seq.reverse()
+
+    return seq
+
+class CTCVectorizedBeamDecoder(nn.Module):
+    def __init__(self, language_model=None):
+        super(CTCVectorizedBeamDecoder, self).__init__()
+        self.language_model = language_model
+
+    def forward(self, probabilities, lengths, beam_width=1, blank_index=0):
+        device = probabilities.device
+
+        probabilities = probabilities.detach().cpu().numpy()
+        lengths = lengths.detach().cpu().numpy()
+
+        lm_scores = None if self.language_model is None else self.language_model.scores
+
+        decoded = []
+        for i in range(probabilities.shape[0]):
+            seq = ctc_beam_search(probabilities[i, :lengths[i]], beam_width, blank_index, lm_scores)
+            decoded.append(torch.as_tensor(seq, device=device, dtype=torch.long))
+
+        # Calculate output lengths
+        decoded_lengths = torch.as_tensor([x.size(0) for x in decoded], device=device, dtype=torch.long)
+
+        # Pack into one tensor
+        decoded = nn.utils.rnn.pad_sequence(decoded, batch_first=True)
+
+        return decoded, decoded_lengths
+
+# Runs in the worker processes of ParallelCTCBeamDecoder. probabilities is a view of the decoder's
+# shared memory buffer, so only a handle to it was sent over.
+def _decode_rows(probabilities, rows, lengths, beam_width, blank_index, lm_scores=None):
+    probabilities = probabilities.numpy()
+    return [ctc_beam_search(probabilities[row, :length], beam_width, blank_index, lm_scores) for row, length in zip(rows, lengths)]
+
+# Decodes the rows of a batch in parallel on a persistent pool of worker processes, using the
+# vectorized beam search. Rows are dealt out to the workers longest first, so each worker gets
+# about the same number of time steps to decode. The log probabilities are copied once into a
+# shared memory buffer that is reused between calls. With num_workers <= 1 rows are decoded serially
+# in this process.
+class ParallelCTCBeamDecoder(nn.Module):
+    def __init__(self, num_workers=None, language_model=None):
+        super(ParallelCTCBeamDecoder, self).__init__()
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.language_model = language_model
+        self.pool = None
+        self.buffer = None
+
+    def _decode_parallel(self, probabilities, lengths, beam_width, blank_index, lm_scores):
+        if self.pool is None:
+            # Spawned workers don't inherit the training process's CUDA state
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        # Grow the shared buffer if needed and copy the batch in
+        if self.buffer is None or self.buffer.numel() < probabilities.numel():
+            self.buffer = torch.empty(probabilities.numel(), dtype=torch.float32).share_memory_()
+        shared = self.buffer[:probabilities.numel()].view(probabilities.shape)
+        shared.copy_(probabilities)
+
+        # Longest rows first, each to the worker with the least work so far
+        order = np.argsort(-lengths, kind="stable")
+        chunks = [[] for _ in range(min(self.num_workers, len(order)))]
+        work = np.zeros(len(chunks), dtype=np.int64)
+        for row in order:
+            chunk = int(np.argmin(work))
+            chunks[chunk].append(int(row))
+            work[chunk] += lengths[row]
+
+        futures = [self.pool.submit(_decode_rows, shared, rows, lengths[rows].tolist(), beam_width, blank_index, lm_scores) for rows in chunks]
+
+        decoded = [None] * len(order)
+        for rows, future in zip(chunks, futures):
+            for row, seq in zip(rows, future.result()):
+                decoded[row] = seq
+        return decoded
+
+    def forward(self, probabilities, lengths, beam_width=1, blank_index=0):
+        device = probabilities.device
+
+        probabilities = probabilities.detach().float().cpu()
+        lengths = lengths.detach().cpu().numpy()
+        lm_scores = None if self.language_model is None else self.language_model.scores
+
+        if self.num_workers > 1 and probabilities.size(0) > 1:
+            decoded = self._decode_parallel(probabilities, lengths, beam_width, blank_index, lm_scores)
+        else:
+            decoded = _decode_rows(probabilities, range(probabilities.size(0)), lengths, beam_width, blank_index, lm_scores)
+        decoded = [torch.as_tensor(x, device=device, dtype=torch.long) for x in decoded]
+
+        # Calculate output lengths
+        decoded_lengths = torch.as_tensor([x.size(0) for x in decoded], device=device, dtype=torch.long)
+
+        # Pack into one tensor
+        decoded = nn.utils.rnn.pad_sequence(decoded, batch_first=True)
+
+        return decoded, decoded_lengths
+
+    def close(self):
+        if not self.pool is None:
+            self.pool.shutdown()
+            self.pool = None
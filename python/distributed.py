@@ -0,0 +1,33 @@
+import os
+import torch
+import torch.distributed as dist
+
+# Joins the process group of a data parallel training run. Processes training on GPUs use NCCL, cpu
+# processes use gloo.
+def init_distributed(rank, world_size, port=29500, device_type="cpu"):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(port))
+    backend = "nccl" if device_type == "cuda" else "gloo"
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+# Sums a list of numbers (python numbers or scalar tensors) over all processes, returning floats
+def all_reduce_sum(values, device):
+    totals = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    if is_distributed():
+        dist.all_reduce(totals)
+    return totals.tolist()
+
+# Gathers a picklable object from every process, returning them in rank order
+def all_gather_objects(obj):
+    if not is_distributed():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
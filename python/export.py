@@ -2,10 +2,25 @@ import argparse
 import json
 from pathlib import Path
 import shutil
+import tempfile
 import torch
 
 from model import *
 
+# Exports a model (in eval mode) to ONNX with a dynamic batch size and image width. Uses the
+# TorchScript based exporter, which still supports opset 9
+def export_onnx(model, path, opset_version=9):
+    x = torch.ones((1, 1, 4, 32))
+    l = torch.tensor([[1, 4, 32]])
+
+    torch.onnx.export(model, (x, l), path,
+                    input_names=["images", "sizes"],
+                    output_names=["predictions", "sizes_out"],
+                    dynamic_axes={
+                        "images": {0: "batch_size", 2: "img_width"},
+                        "sizes": {0: "batch_size"},
+                    }, opset_version=opset_version, dynamo=False)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_dir", "-m", type=Path, required=True,
@@ -14,9 +29,19 @@ if __name__ == '__main__':
                         help="The epoch of the saved weights.")
     parser.add_argument("--out_dir", "-o", type=Path, required=True,
                         help="The path to save the exported model to.")
+    parser.add_argument("--quantize", "-q", action="store_true",
+                        help="Also export an INT8 quantized model (model_int8.onnx).")
+    parser.add_argument("--calibration_data_dir", "-c", type=Path, required=False,
+                        help="The dataset to calibrate the quantized conv layers on (required with --quantize).")
+    parser.add_argument("--calibration_samples", type=int, default=200, required=False,
+                        help="The number of randomly sampled images to calibrate on.")
+    parser.add_argument("--valid_data_dir", "-v", type=Path, required=False,
+                        help="The dataset to compare the accuracy and latency of the quantized model on.")
 
     # Parse command line args
     args = parser.parse_args()
+    if args.quantize and args.calibration_data_dir is None:
+        parser.error("--quantize requires --calibration_data_dir")
 
     # Create output directory for exported model
     args.out_dir.mkdir(parents=True, exist_ok=False)
@@ -33,14 +58,25 @@ if __name__ == '__main__':
     model = load_model(len(codec) + 1, args.model_dir / ("epoch_" + str(args.epoch) + ".pt"))
     model.eval()
 
+    # Fold batch norms into the convolutions
+    model = fuse_conv_batchnorm(model)
+
     # Export model
-    x = torch.ones((1, 1, 4, 32))
-    l = torch.tensor([[1, 4, 32]])
+    export_onnx(model, args.out_dir / "model.onnx")
 
-    torch.onnx.export(model, (x, l), args.out_dir / "model.onnx",
-                    input_names=["images", "sizes"],
-                    output_names=["predictions", "sizes_out"],
-                    dynamic_axes={
-                        "images": {0: "batch_size", 2: "img_width"},
-                        "sizes": {0: "batch_size"},
-                    }, opset_version=9)
+    if args.quantize:
+        from quantize import *
+
+        # Per channel quantization needs opset 13, so quantize a separate export
+        tmp_dir = tempfile.TemporaryDirectory()
+        fp32_path = Path(tmp_dir.name) / "model.onnx"
+        export_onnx(model, fp32_path, opset_version=13)
+
+        calibration_dataset = TextDataset(args.calibration_data_dir)
+        calibration_data = CalibrationBatches(calibration_dataset, args.calibration_samples)
+        quantize_onnx(fp32_path, args.out_dir / "model_int8.onnx", calibration_data)
+        tmp_dir.cleanup()
+
+        if not args.valid_data_dir is None:
+            valid_dataset = TextDataset(args.valid_data_dir)
+            report_quantization(args.out_dir / "model.onnx", args.out_dir / "model_int8.onnx", valid_dataset)
@@ -0,0 +1,129 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import sys
+import time
+import numpy as np
+import torch
+
+from data import *
+from decoders import *
+from inference import *
+from language_model import *
+from shards import *
+
+# Image paths given on the command line. Directories are expanded to the PNGs in them
+def collect_images(paths):
+    images = []
+    for path in paths:
+        if path.is_dir():
+            images.extend(sorted(path.glob("*.png")))
+        else:
+            images.append(path)
+    return images
+
+# OCRs line images with a trained or exported model. Images are sorted by width and cut into batches
+# that fit a padded pixel budget. A thread pool loads the images of the next few batches while the
+# current one runs, and every line is written out as soon as its batch is decoded.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", type=Path, nargs="+",
+                        help="Line images (already binarized) or directories of them.")
+    parser.add_argument("--model", "-m", type=Path, required=True,
+                        help="A checkpoint, weights or exported .onnx file, or a directory containing one.")
+    parser.add_argument("--codec", "-c", type=Path, required=False,
+                        help="The codec of the model (defaults to codec.json next to the model).")
+    parser.add_argument("--out_file", "-o", type=Path, required=False,
+                        help="The JSON lines file to write results to (defaults to stdout).")
+    parser.add_argument("--max_batch_pixels", type=int, default=262144, required=False,
+                        help="The padded number of pixels in a batch.")
+    parser.add_argument("--beam_width", type=int, default=0, required=False,
+                        help="The beam width of the beam search decoder (0 decodes greedily).")
+    parser.add_argument("--lm", type=Path, required=False,
+                        help="The language model (lm.json) to use during beam search.")
+    parser.add_argument("--lm_weight", type=float, default=0.25, required=False,
+                        help="The weight of language model scores during beam search.")
+    parser.add_argument("--decode_workers", type=int, required=False,
+                        help="The number of processes beam search runs on (default: number of cpus).")
+    parser.add_argument("--threads", type=int, required=False,
+                        help="The number of threads ONNX Runtime runs an exported model with (default: number of cpus).")
+    parser.add_argument("--io_binding", action="store_true",
+                        help="Bind reused input and output buffers when running an exported model.")
+    parser.add_argument("--chunk_width", type=int, required=False,
+                        help="Run the conv layers of images wider than this in chunks to bound memory use (checkpoints only).")
+    parser.add_argument("--sequence_overlap", type=int, required=False,
+                        help="With --chunk_width, also run the LSTM in windows with this many steps of overlap (bounds memory, approximate).")
+    parser.add_argument("--load_workers", type=int, default=4, required=False,
+                        help="The number of threads loading images.")
+    parser.add_argument("--prefetch", type=int, default=2, required=False,
+                        help="The number of batches loaded ahead of the running one.")
+
+    # Parse command line args
+    args = parser.parse_args()
+
+    model_path = find_model(args.model)
+    codec_path = args.codec
+    if codec_path is None:
+        codec_path = model_path.parent / "codec.json"
+    classes = load_classes(codec_path)
+
+    # Load model and decoder
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    engine = load_engine(model_path, len(classes), device, args.threads, args.io_binding, args.chunk_width, args.sequence_overlap)
+    if args.beam_width > 0:
+        language_model = None
+        if not args.lm is None:
+            language_model = LanguageModel(args.lm, codec_path, args.lm_weight)
+        beam_decoder = ParallelCTCBeamDecoder(args.decode_workers, language_model)
+        decoder = lambda probs, lens: beam_decoder(probs, lens, beam_width=args.beam_width)
+    else:
+        decoder = CTCGreedyDecoder()
+
+    # Plan width sorted batches (narrowest first, so the first results come out quickly)
+    paths = collect_images(args.images)
+    sampler = WidthBucketBatchSampler(image_widths(paths), max_batch_width=max(args.max_batch_pixels // IMAGE_HEIGHT, 1), shuffle=False)
+    batches = [batch[::-1] for batch in sampler] # Widest first within a batch, like padded_sorted_collate
+
+    out_file = sys.stdout if args.out_file is None else open(args.out_file, "w")
+    loader = ThreadPoolExecutor(args.load_workers)
+    load_image = lambda path: torch.from_numpy(load_alpha_image(path))
+
+    start = time.perf_counter()
+    latencies = []
+    pending = deque()
+    next_batch = 0
+    while next_batch < len(batches) or len(pending) > 0:
+        # Keep the loader a few batches ahead
+        while next_batch < len(batches) and len(pending) <= args.prefetch:
+            batch = batches[next_batch]
+            pending.append((batch, [loader.submit(load_image, paths[i]) for i in batch], time.perf_counter()))
+            next_batch += 1
+
+        batch, futures, submitted = pending.popleft()
+        images, sizes = collate_images([future.result() for future in futures])
+
+        probs, prob_lens = engine(images, sizes)
+        decoded, decoded_lens = decoder(probs, prob_lens)
+        texts = decode_text(classes, decoded, decoded_lens)
+
+        for i, text in zip(batch, texts):
+            out_file.write(json.dumps({"image": str(paths[i]), "text": text}) + "\n")
+        out_file.flush()
+
+        # Latency of a line is the time from queueing its batch until its text is written
+        latencies.extend([time.perf_counter() - submitted] * len(batch))
+
+    elapsed = time.perf_counter() - start
+    loader.shutdown()
+    if args.beam_width > 0:
+        beam_decoder.close()
+    if not args.out_file is None:
+        out_file.close()
+
+    latencies = np.array(latencies) * 1000.0
+    print("{} images in {:.2f}s ({:.1f} images/s), latency p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms".format(
+        len(paths), elapsed, len(paths) / elapsed,
+        *(np.percentile(latencies, [50, 90, 99]) if len(paths) > 0 else [0.0] * 3)), file=sys.stderr)
@@ -0,0 +1,163 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+import torch
+from torch import nn
+from PIL import Image
+
+from checkpoint import *
+from model import *
+from shards import *
+
+ONNX_OUTPUT_NAMES = ["predictions", "sizes_out"]
+
+# Network classes of a codec.json (the CTC blank comes first)
+def load_classes(codec_path):
+    f = open(codec_path, "r")
+    codec = json.load(f)
+    f.close()
+
+    classes = ['<BLNK>']
+    for char in codec:
+        classes.append(char["Char"])
+    return classes
+
+# Finds the model file to run: a file is used as is, an export directory gives its model.onnx and a
+# training output directory its latest checkpoint (or the latest epoch weights if it has none)
+def find_model(path):
+    path = Path(path)
+    if not path.is_dir():
+        return path
+    if (path / "model.onnx").exists():
+        return path / "model.onnx"
+    try:
+        return latest_checkpoint(path)
+    except FileNotFoundError:
+        weights = list(path.glob("epoch_*.pt"))
+        if len(weights) == 0:
+            raise FileNotFoundError("No model found in " + str(path))
+        return max(weights, key=lambda p: int(p.stem.split("_")[1]))
+
+# Runs a trained PyTorch model. Engines take a padded batch of images (batch, 1, width, height) and
+# their sizes (batch, 3) like the model does, and return the log probabilities (batch, length,
+# classes) and the output lengths (batch) on the cpu.
+#
+# With chunk_width, images wider than that are run in chunks (see ChunkedModel) to bound memory use.
+# sequence_overlap also runs the LSTM in overlapping windows.
+class TorchEngine():
+    def __init__(self, weights_path, num_classes, device=torch.device("cpu"), chunk_width=None, sequence_overlap=None):
+        self.device = device
+        self.model = load_model(num_classes, weights_path)
+        self.model.eval()
+        self.model = fuse_conv_batchnorm(self.model)
+        if not chunk_width is None:
+            self.model = ChunkedModel(self.model, chunk_width, sequence_overlap)
+        self.model.to(device)
+
+    def __call__(self, images, sizes):
+        with torch.inference_mode():
+            probs, prob_sizes = self.model(images.to(self.device), sizes) # Sizes stay on the cpu
+        return probs.float().cpu(), prob_sizes[:, 0].cpu()
+
+# Runs a model exported by export.py with ONNX Runtime, through the same interface as TorchEngine. The
+# session is created once with a fixed number of intra-op threads and sequential execution (a single
+# line of inference has no parallel branches for inter-op threads to use).
+#
+# Input widths are rounded up to a multiple of bucket_width and copied into zero padded buffers kept
+# per batch size and width bucket, so similar batches reuse the same memory (and ORT sees few
+# distinct shapes). Since the network tracks sizes, the extra padding doesn't change the results;
+# outputs are cut back to the longest output length. With io_binding the inputs and outputs are bound
+# to these buffers once and ORT writes its results straight into them instead of returning copies.
+# The returned tensors then share memory with the buffers, so they're overwritten by the next call
+# in the same bucket.
+class OnnxEngine():
+    def __init__(self, model_path, threads=None, io_binding=False, bucket_width=64, providers=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = os.cpu_count() if threads is None else threads
+        options.inter_op_num_threads = 1
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+        self.session = onnxruntime.InferenceSession(str(model_path), options, providers=providers)
+        self.io_binding = io_binding
+        self.bucket_width = bucket_width
+        self.buckets = {}
+
+    def _bucket(self, batch_size, width, height):
+        key = (batch_size, -(-width // self.bucket_width) * self.bucket_width, height)
+        if not key in self.buckets:
+            bucket = {
+                "images": np.zeros((key[0], 1, key[1], key[2]), dtype=np.float32),
+                "sizes": np.zeros((key[0], 3), dtype=np.int64),
+                "binding": None,
+            }
+            if self.io_binding:
+                binding = self.session.io_binding()
+                for name in ["images", "sizes"]:
+                    array = bucket[name]
+                    binding.bind_input(name, "cpu", 0, array.dtype, array.shape, array.ctypes.data)
+                bucket["binding"] = binding
+            self.buckets[key] = bucket
+        return self.buckets[key]
+
+    def _run_bound(self, bucket):
+        binding = bucket["binding"]
+        if not "outputs" in bucket:
+            # Output shapes aren't known until the first run, so let ORT allocate them once and then
+            # bind buffers of the same shape for every later run
+            for name in ONNX_OUTPUT_NAMES:
+                binding.bind_output(name, "cpu")
+            self.session.run_with_iobinding(binding)
+            bucket["outputs"] = [output.numpy() for output in binding.get_outputs()]
+            binding.clear_binding_outputs()
+            for name, array in zip(ONNX_OUTPUT_NAMES, bucket["outputs"]):
+                binding.bind_output(name, "cpu", 0, array.dtype, array.shape, array.ctypes.data)
+        else:
+            self.session.run_with_iobinding(binding)
+        return bucket["outputs"]
+
+    def __call__(self, images, sizes):
+        batch_size, _, width, height = images.shape
+        bucket = self._bucket(batch_size, width, height)
+
+        # The padding of the bucket has to be zero like the padding of the batch
+        bucket["images"][:, :, :width] = images.numpy()
+        bucket["images"][:, :, width:] = 0
+        bucket["sizes"][:] = sizes.numpy()
+
+        if self.io_binding:
+            probs, prob_sizes = self._run_bound(bucket)
+        else:
+            probs, prob_sizes = self.session.run(ONNX_OUTPUT_NAMES, {"images": bucket["images"], "sizes": bucket["sizes"]})
+
+        prob_lens = torch.from_numpy(prob_sizes[:, 0])
+        return torch.from_numpy(probs)[:, :int(prob_lens.max())], prob_lens
+
+def load_engine(model_path, num_classes, device=torch.device("cpu"), threads=None, io_binding=False, chunk_width=None, sequence_overlap=None):
+    if Path(model_path).suffix == ".onnx":
+        return OnnxEngine(model_path, threads, io_binding)
+    return TorchEngine(model_path, num_classes, device, chunk_width, sequence_overlap)
+
+# Widths of line images, read from their headers only
+def image_widths(paths):
+    widths = np.zeros(len(paths), dtype=np.int64)
+    for i, path in enumerate(paths):
+        img = Image.open(path, "r")
+        widths[i] = img.width
+        img.close()
+    return widths
+
+# Pads width first uint8 images (sorted by decreasing width) into a float batch and its sizes, the
+# same way padded_sorted_collate does
+def collate_images(images):
+    sizes = torch.tensor([[1, x.size(0), x.size(1)] for x in images], dtype=torch.long)
+    images = nn.utils.rnn.pad_sequence([x.float() / 255.0 for x in images], batch_first=True)
+    return images.unsqueeze(1), sizes
+
+def decode_text(classes, decoded, decoded_lengths):
+    decoded = decoded.tolist()
+    decoded_lengths = decoded_lengths.tolist()
+    return ["".join(classes[c] for c in seq[:length]) for seq, length in zip(decoded, decoded_lengths)]
@@ -0,0 +1,74 @@
+import contextlib
+import json
+import resource
+import time
+import torch
+
+# Low overhead timers for the stages of a training step (forward, backward, etc.). On the cpu a stage
+# is timed with the wall clock. On CUDA, where work runs asynchronously, a stage is bracketed by a
+# pair of timing events on the current stream instead, and the events are only read back when the
+# totals are collected (one sync), so timing never stalls the training loop.
+class StageTimers():
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.events = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.device.type == "cuda":
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.events.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self.add(name, time.perf_counter() - start)
+
+    # Adds time (in seconds) measured elsewhere, e.g. by DevicePrefetcher
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    # Reads back any pending events. Called every so often so they don't pile up
+    def collect(self):
+        if len(self.events) > 0:
+            self.events[-1][2].synchronize()
+            for name, start, end in self.events:
+                self.add(name, start.elapsed_time(end) / 1000.0)
+            self.events = []
+
+    def values(self):
+        self.collect()
+        return dict(self.totals)
+
+# Peak memory use of the training device in bytes (the process's peak resident memory on the cpu)
+def peak_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Writes scalars to Tensorboard and also appends them as one JSON object per line to a file, which is
+# easier to compare runs with outside of Tensorboard
+class MetricsLogger():
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.file = open(path, "a")
+
+    def log(self, step, scalars, step_name="epoch"):
+        for name, value in scalars.items():
+            self.writer.add_scalar(name, value, step)
+        self.writer.flush()
+
+        record = {step_name: step}
+        record.update(scalars)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
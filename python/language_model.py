@@ -0,0 +1,39 @@
+import json
+import numpy as np
+
+# The character bigram language model generated by the .NET generate-lm command (see
+# OCR/LanguageModel.cs). lm.json holds the probabilities of each codec character starting a line
+# (Item1) and the probabilities P(c2 | c1) of a character following another one (Item2).
+#
+# Both are turned into one dense table of weighted log probabilities indexed by network class
+# (which includes the CTC blank): scores[previous class, next class]. The row of the blank class holds
+# the first character scores (an empty prefix ends in blank), and the blank column is zero since a
+# blank never adds a character. Like the C# decoder, probabilities are clamped to at least 1e-6.
+class LanguageModel():
+    def __init__(self, lm_path, codec_path, weight=0.25, blank_index=0, min_probability=1e-6):
+        f = open(codec_path, "r")
+        codec = json.load(f)
+        f.close()
+
+        f = open(lm_path, "r")
+        lm = json.load(f)
+        f.close()
+
+        first_char_probs = np.array(lm["Item1"], dtype=np.float64)
+        second_char_probs = np.array(lm["Item2"], dtype=np.float64)
+
+        # Ensure size matches
+        if first_char_probs.shape != (len(codec),) or second_char_probs.shape != (len(codec), len(codec)):
+            raise ValueError("Loaded language model size doesn't match codec size")
+
+        # Map codec indices to network classes by inserting the blank
+        classes = np.delete(np.arange(len(codec) + 1), blank_index)
+        self.log_probs = np.zeros((len(codec) + 1, len(codec) + 1))
+        self.log_probs[blank_index, classes] = np.log(np.maximum(first_char_probs, min_probability))
+        self.log_probs[np.ix_(classes, classes)] = np.log(np.maximum(second_char_probs, min_probability))
+
+        self.set_weight(weight)
+
+    def set_weight(self, weight):
+        self.weight = weight
+        self.scores = weight * self.log_probs
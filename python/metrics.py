@@ -23,4 +23,142 @@ class SequenceAccuracy(nn.Module):
         # Count number of total characters in labels
         num_chars = torch.sum(label_lengths)
 
-        return num_equal.double() / num_chars.double()
\ No newline at end of file
+        return num_equal.double() / num_chars.double()
+
+# Levenshtein distance between each prediction and label row of a batch. Rows are padded and only
+# the first prediction_lengths/label_lengths elements of each count. The dynamic programming table
+# is filled one anti-diagonal at a time (every cell on an anti-diagonal only depends on the previous
+# two), so each step is a few whole batch tensor operations on the inputs' device, and the host never
+# has to wait on the device.
+class EditDistance(nn.Module):
+    def __init__(self):
+        super(EditDistance, self).__init__()
+
+    def forward(self, predictions, prediction_lengths, labels, label_lengths):
+        device = predictions.device
+        batch_size = predictions.size(0)
+        prediction_lengths = prediction_lengths.to(device)
+        label_lengths = label_lengths.to(device)
+
+        # Need at least one column to index into, padding doesn't affect the result
+        predictions = nn.functional.pad(predictions, (0, max(1 - predictions.size(1), 0)))
+        labels = nn.functional.pad(labels, (0, max(1 - labels.size(1), 0)))
+        n = predictions.size(1)
+        m = labels.size(1)
+        unreachable = n + m + 1
+
+        # Anti-diagonal k holds the cells D[i, k - i] for i in [0, n]
+        i = torch.arange(n + 1, device=device)
+        prediction_index = (i - 1).clamp(0, n - 1)
+        padding = torch.full((batch_size, 1), unreachable, dtype=torch.long, device=device)
+        before_previous = torch.full((batch_size, n + 1), unreachable, dtype=torch.long, device=device)
+        previous = before_previous.clone()
+        previous[:, 0] = 0
+
+        # D[n_b, m_b] is on anti-diagonal n_b + m_b
+        targets = prediction_lengths + label_lengths
+        distances = torch.zeros(batch_size, dtype=torch.long, device=device)
+        for k in range(1, n + m + 1):
+            j = k - i
+            cost = predictions[:, prediction_index] != labels[:, (j - 1).clamp(0, m - 1)]
+
+            # Deletion (D[i - 1, j]), insertion (D[i, j - 1]) and substitution (D[i - 1, j - 1])
+            deletion = torch.cat((padding, previous[:, :-1]), dim=1) + 1
+            insertion = previous + 1
+            substitution = torch.cat((padding, before_previous[:, :-1]), dim=1) + cost
+            current = torch.minimum(torch.minimum(deletion, insertion), substitution)
+
+            # First row and column of the table, and cells outside of it
+            current = torch.where(i == 0, j, current)
+            current = torch.where(j == 0, i, current)
+            current = torch.where((j < 0) | (j > m), unreachable, current)
+
+            distance = current.gather(1, prediction_lengths.unsqueeze(1)).squeeze(1)
+            distances = torch.where(targets == k, distance, distances)
+            before_previous, previous = previous, current
+
+        return distances
+
+# Character error rate: edit distance between predictions and labels over the number of characters
+# in the labels. counts returns the two sums separately so they can be accumulated over an epoch.
+class CharacterErrorRate(nn.Module):
+    def __init__(self):
+        super(CharacterErrorRate, self).__init__()
+        self.edit_distance = EditDistance()
+
+    def counts(self, predictions, prediction_lengths, labels, label_lengths):
+        errors = self.edit_distance(predictions, prediction_lengths, labels, label_lengths)
+        return torch.sum(errors), torch.sum(label_lengths)
+
+    def forward(self, predictions, prediction_lengths, labels, label_lengths):
+        errors, num_chars = self.counts(predictions, prediction_lengths, labels, label_lengths)
+        return errors.double() / num_chars.double()
+
+# Word error rate: edit distance between the word sequences of predictions and labels over the
+# number of words in the labels. Words are runs of non space classes, and each is hashed on the
+# device into a single integer so the word sequences can go through EditDistance.
+class WordErrorRate(nn.Module):
+    def __init__(self, space_index):
+        super(WordErrorRate, self).__init__()
+        self.space_index = space_index
+        self.edit_distance = EditDistance()
+
+    def words(self, sequences, lengths):
+        device = sequences.device
+        length = sequences.size(1)
+
+        # Pseudo random weight for each position within a word (splitmix64, wrapping int64 arithmetic)
+        weights = torch.arange(1, length + 1, device=device) * -7046029254386353131
+        weights = (weights ^ (weights >> 30)) * -4658895280553007687
+        weights = (weights ^ (weights >> 27)) * -7723592293110705685
+        weights = weights ^ (weights >> 31)
+
+        # Characters of words and where each word starts
+        steps = torch.arange(length, device=device)
+        in_word = (sequences != self.space_index) & (steps.unsqueeze(0) < lengths.to(device).unsqueeze(1))
+        starts = in_word.clone()
+        starts[:, 1:] &= ~in_word[:, :-1]
+        word_index = torch.cumsum(starts, dim=1) - 1
+        start_step = torch.cummax(torch.where(starts, steps, 0), dim=1)[0]
+
+        # Sum of each character times the weight of its position in the word
+        values = (sequences + 1) * weights[steps - start_step] * in_word
+        words = sequences.new_zeros(sequences.size(0), length + 1)
+        words.scatter_add_(1, torch.where(in_word, word_index, length), values)
+
+        return words[:, :length], starts.sum(dim=1)
+
+    def counts(self, predictions, prediction_lengths, labels, label_lengths):
+        prediction_words, prediction_word_lengths = self.words(predictions, prediction_lengths)
+        label_words, label_word_lengths = self.words(labels, label_lengths)
+        errors = self.edit_distance(prediction_words, prediction_word_lengths, label_words, label_word_lengths)
+        return torch.sum(errors), torch.sum(label_word_lengths)
+
+    def forward(self, predictions, prediction_lengths, labels, label_lengths):
+        errors, num_words = self.counts(predictions, prediction_lengths, labels, label_lengths)
+        return errors.double() / num_words.double()
+
+# Sums metrics over many steps on the device they're computed on, so the training loop never has to
+# wait for the device to read one back. values reads every total back at once (a single sync).
+class MetricAccumulator():
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, name, value):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self.totals[name] = self.totals.get(name, 0) + value
+
+    def values(self):
+        values = {}
+        tensor_names = [name for name, value in self.totals.items() if isinstance(value, torch.Tensor)]
+        if len(tensor_names) > 0:
+            tensors = torch.stack([self.totals[name].double().reshape(()) for name in tensor_names])
+            values.update(zip(tensor_names, tensors.tolist()))
+        for name, value in self.totals.items():
+            if not name in values:
+                values[name] = float(value)
+        return values
+
+    def reset(self):
+        self.totals = {}
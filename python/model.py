@@ -1,4 +1,6 @@
+import copy
 import torch
+from torch import nn
 
 from modules import *
 
@@ -42,6 +44,163 @@ def load_model(num_classes, weights_path=None):
     )
 
     if not weights_path is None:
-        model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
+        # Accept both plain weights (epoch_N.pt) and full training checkpoints (checkpoint_N.pt)
+        state = torch.load(weights_path, map_location=torch.device('cpu'), weights_only=True)
+        if "model" in state:
+            state = state["model"]
+        model.load_state_dict(state)
 
     return model
+
+# Folds every batch norm that directly follows a convolution into the convolution's weights and bias,
+# returning a new model for inference (the given model is left as is). In eval mode a batch norm is
+# just a per channel scale and shift, so conv(x) * scale + shift is a single conv with scaled weights
+# and a bias, saving a full pass over the activations per layer. Sizes are tracked as before.
+def fuse_conv_batchnorm(model):
+    assert not model.training # The running statistics are only used in eval mode
+
+    layers = list(model)
+    fused = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        if isinstance(layer, SizeTrackingConv2d) and i + 1 < len(layers) and isinstance(layers[i + 1], SizeTrackingBatchNorm2d):
+            conv = copy.deepcopy(layer)
+            conv.layer = torch.nn.utils.fusion.fuse_conv_bn_eval(layer.layer, layers[i + 1].layer)
+            fused.append(conv)
+            i += 2
+        else:
+            fused.append(copy.deepcopy(layer))
+            i += 1
+
+    fused = SequentialMultipleInput(*fused)
+    fused.eval()
+    return fused
+
+# Runs a load_model network on very wide images with bounded activation memory. The conv stack (up to
+# the last pooling layer), which needs by far the most memory per column, runs on chunks of
+# chunk_width columns. The convolutions only pad on the right, so a chunk's outputs depend on the
+# columns to its right alone: every chunk gets context extra columns (the combined receptive field)
+# so its kept outputs are exactly those of the full width image. Chunks start at multiples of the
+# pooling factor for the same reason. Images no wider than a chunk are run as a whole.
+#
+# By default the features of all chunks are stitched together and the LSTM runs over the whole
+# sequence, which gives exactly the same results as running the image whole but still needs memory
+# for the whole sequence. With sequence_overlap the LSTM (and everything after it) runs on windows of
+# chunk_width columns too, each seeing sequence_overlap extra steps on either side, and every step's
+# log probabilities are taken from the window it's in the middle of. Memory use is then bounded
+# regardless of width, but results differ slightly near window boundaries.
+class ChunkedModel(nn.Module):
+    def __init__(self, model, chunk_width=1024, sequence_overlap=None):
+        super(ChunkedModel, self).__init__()
+        layers = list(model)
+        split = max(i for i, layer in enumerate(layers) if isinstance(layer, (SizeTrackingConv2d, SizeTrackingMaxPool2d))) + 1
+        self.head = model[:split]
+        self.tail = model[split:]
+        self.sequence_overlap = sequence_overlap
+
+        # Columns of context on the right and the factor the width is reduced by
+        self.context = 0
+        self.scale = 1
+        for layer in self.head:
+            if isinstance(layer, SizeTrackingConv2d):
+                conv = layer.layer
+                if layer.padding != "same_right_bottom" or conv.stride[0] != 1:
+                    raise ValueError("Chunking needs convolutions that keep the width and only pad on the right")
+                self.context += conv.dilation[0] * (conv.kernel_size[0] - 1) * self.scale
+            elif isinstance(layer, SizeTrackingMaxPool2d):
+                if layer.kernel_size[0] != layer.stride[0] or layer.padding[0] != 0 or layer.dilation[0] != 1:
+                    raise ValueError("Chunking needs non overlapping pooling along the width")
+                self.scale *= layer.stride[0]
+        self.chunk_width = max(chunk_width // self.scale, 1) * self.scale
+
+    # Conv features of the image columns from start to end (a multiple of the scale or the width)
+    def _features(self, images, sizes, start, end):
+        features = []
+        for chunk_start in range(start, end, self.chunk_width):
+            chunk_end = min(chunk_start + self.chunk_width, end)
+            if (chunk_end - chunk_start) // self.scale == 0:
+                break
+            x, _ = self.head(images[:, :, chunk_start:min(chunk_end + self.context, images.size(2))], sizes)
+            features.append(x[:, :, :(chunk_end - chunk_start) // self.scale])
+        return torch.cat(features, dim=2)
+
+    def forward(self, images, sizes):
+        width = images.size(2)
+        if width <= self.chunk_width:
+            return self.tail(*self.head(images, sizes))
+
+        feature_sizes = self.head.output_sizes(sizes)
+        if self.sequence_overlap is None:
+            return self.tail(self._features(images, sizes, 0, width), feature_sizes)
+
+        # Sizes are (channels, width, height) here
+        lengths = feature_sizes[:, 1]
+        length = int(lengths.max())
+        window = self.chunk_width // self.scale
+        probs = []
+        for start in range(0, length, window):
+            end = min(start + window, length)
+            window_start = max(start - self.sequence_overlap, 0)
+            window_end = min(end + self.sequence_overlap, length)
+
+            # Rows that end before the window still need a length of at least one for packing
+            window_sizes = feature_sizes.clone()
+            window_sizes[:, 1] = (lengths - window_start).clamp(1, window_end - window_start)
+            features = self._features(images, sizes, window_start * self.scale, window_end * self.scale)
+            x, _ = self.tail(features, window_sizes)
+            probs.append(x[:, start - window_start:end - window_start])
+
+        return torch.cat(probs, dim=1), self.tail.output_sizes(feature_sizes)
+
+# The network of load_model with static signatures for TorchScript and torch.compile: it takes and
+# returns plain tensors, applies conv padding explicitly, runs the LSTM on a padded batch with masking
+# instead of packing, and computes the output sizes from the input widths directly (the convs keep the
+# width and the pool halves it). Batch norms are folded into the convolutions and dropout (a no-op in
+# eval mode) is left out. Outputs match the eval mode model, except that the output length is the
+# padded input width halved instead of the longest sequence.
+class InferenceModel(nn.Module):
+    def __init__(self, model):
+        super(InferenceModel, self).__init__()
+        model = fuse_conv_batchnorm(model)
+
+        convs = []
+        for layer in model:
+            if isinstance(layer, SizeTrackingConv2d):
+                padding = layer.padding_internal if not layer.padding_internal is None else (0, 0, 0, 0)
+                convs.append(PaddedConv2d(layer.layer, padding))
+            elif isinstance(layer, SizeTrackingMaxPool2d):
+                if layer.layer.ceil_mode:
+                    raise ValueError("InferenceModel doesn't support pooling with ceil_mode=True")
+                self.pool = layer.layer
+                # Output width = (width + width_offset) // width_stride + 1, like SizeTrackingMaxPool2d
+                self.width_offset = 2 * layer.padding[0] - layer.dilation[0] * (layer.kernel_size[0] - 1) - 1
+                self.width_stride = layer.stride[0]
+            elif isinstance(layer, SizeTrackingLSTM):
+                self.lstm = MaskedBidirectionalLSTM(layer.layer)
+            elif isinstance(layer, SizeTrackingLinear):
+                self.linear = layer.layer
+        self.convs = nn.ModuleList(convs)
+        self.num_classes = self.linear.out_features
+        self.eval()
+
+    def forward(self, images: torch.Tensor, sizes: torch.Tensor):
+        x = images
+        for conv in self.convs:
+            x = torch.relu(conv(x))
+        x = self.pool(x)
+
+        # (batch, channels, width, height) -> (batch, width, channels * height)
+        x = x.permute(0, 2, 1, 3).flatten(2)
+        lengths = torch.div(sizes[:, 1] + self.width_offset, self.width_stride, rounding_mode="floor") + 1
+
+        x = self.lstm(x, lengths)
+        x = torch.log_softmax(self.linear(x).float(), dim=2)
+
+        out_sizes = torch.stack((lengths, torch.full_like(lengths, self.num_classes)), dim=1)
+        return x, out_sizes
+
+def load_inference_model(num_classes, weights_path=None):
+    model = load_model(num_classes, weights_path)
+    model.eval()
+    return InferenceModel(model)
@@ -1,18 +1,96 @@
 import torch
 from torch import nn
 
+# Size formulas describe what a chain of layers does to the sizes tensor in closed form, so it can be
+# computed in one go instead of layer by layer. A formula has one term per output column, and a term
+# (column, a, b, d) stands for floor((a * sizes[:, column] + b) / d) (constants have a = 0). Every
+# size calculation in this file is a column selection, a constant, or adding a constant and floor
+# dividing, and floor((floor(y / d1) + b) / d2) = floor((y + b * d1) / (d1 * d2)) for integers, so
+# chains of them stay a single term per column. Layers without a closed form return None.
+def _identity_formula(num_columns):
+    return [(i, 1, 0, 1) for i in range(num_columns)]
+
+def _constant_term(value):
+    return (0, 0, value, 1)
+
+# The term for floor((term + b) / d)
+def _floor_div_term(term, b, d):
+    column, a1, b1, d1 = term
+    if a1 == 0:
+        return _constant_term((b1 // d1 + b) // d)
+    return (column, a1, b1 + b * d1, d1 * d)
+
+# The term for floor((x + 2 * padding - dilation * (kernel_size - 1) - 1) / stride) + 1
+def _window_term(term, kernel_size, stride, padding, dilation):
+    return _floor_div_term(term, 2 * padding - dilation * (kernel_size - 1) - 1 + stride, stride)
+
 class SequentialMultipleInput(nn.Sequential):
+    def __init__(self, *args):
+        super(SequentialMultipleInput, self).__init__(*args)
+        self.size_plans = {}
+        self.size_tensors = {}
+
+    # Composes the size formulas of all layers for sizes with num_columns columns. Returns the formula
+    # of the sizes each layer needs (None if it doesn't use them) and of the output sizes, or None if
+    # some layer has no closed form
+    def _size_plan(self, num_columns):
+        if not num_columns in self.size_plans:
+            formula = _identity_formula(num_columns)
+            layer_formulas = []
+            for module in self:
+                if not hasattr(module, "_size_formula"):
+                    formula = None
+                    break
+                layer_formulas.append(formula if getattr(module, "needs_sizes", False) else None)
+                formula = module._size_formula(formula)
+                if formula is None:
+                    break
+            self.size_plans[num_columns] = None if formula is None else (layer_formulas, formula)
+        return self.size_plans[num_columns]
+
+    def _evaluate_sizes(self, sizes, formula):
+        # The formula's tensors are cached per device, except when tracing (e.g. for ONNX export), where
+        # they must be created in the traced call to become constants of the graph
+        key = (sizes.device, tuple(formula))
+        if torch.jit.is_tracing():
+            columns, a, b, d = [torch.tensor(x, dtype=sizes.dtype, device=sizes.device) for x in zip(*formula)]
+        else:
+            if not key in self.size_tensors:
+                self.size_tensors[key] = [torch.tensor(x, dtype=sizes.dtype, device=sizes.device) for x in zip(*formula)]
+            columns, a, b, d = self.size_tensors[key]
+        return torch.div(sizes[:, columns] * a + b, d, rounding_mode="floor")
+
+    # The sizes the layers output for the given input sizes, without running them
+    def output_sizes(self, sizes):
+        plan = self._size_plan(sizes.size(1))
+        if plan is None:
+            raise ValueError("The output sizes of these layers have no closed form")
+        return self._evaluate_sizes(sizes, plan[1])
+
     def forward(self, *input):
-        for module in self:
-            input = module(*input)
-        return input
+        plan = self._size_plan(input[1].size(1)) if len(input) == 2 else None
+        if plan is None:
+            for module in self:
+                input = module(*input)
+            return input
+
+        # Run the layers on the data alone, computing sizes only where they're needed. Sizes on the
+        # cpu (as the batch collate function makes them) then never need to touch the device
+        x, sizes = input
+        layer_formulas, output_formula = plan
+        for module, formula in zip(self, layer_formulas):
+            x = module._forward_features(x, None if formula is None else self._evaluate_sizes(sizes, formula))
+        return x, self._evaluate_sizes(sizes, output_formula)
 
 class SizeTracking(nn.Module):
     def __init__(self):
         super(SizeTracking, self).__init__()
 
+    def _forward_features(self, x, sizes):
+        return self.layer(x)
+
     def forward(self, x, sizes):
-        return self.layer(x), self._calculate_sizes(sizes)
+        return self._forward_features(x, sizes), self._calculate_sizes(sizes)
 
 class SizeTrackingConv2d(nn.Module):
     def __init__(self, *args, **kwargs):
@@ -59,14 +137,24 @@ class SizeTrackingConv2d(nn.Module):
         widths = widths.reshape((batch_size, 1))
         return torch.cat((channels, heights, widths), dim=1)
 
+    def _size_formula(self, formula):
+        heights, widths = formula[1], formula[2]
+        if not (self.padding == "same" or self.padding == "same_right_bottom"):
+            heights = _window_term(heights, self.layer.kernel_size[0], self.layer.stride[0], self.layer.padding[0], self.layer.dilation[0])
+            widths = _window_term(widths, self.layer.kernel_size[1], self.layer.stride[1], self.layer.padding[1], self.layer.dilation[1])
+        return [_constant_term(self.layer.out_channels), heights, widths]
+
     def _padding(self, x):
         if not self.padding_internal is None:
             return torch.nn.functional.pad(x, self.padding_internal)
         else:
             return x
 
+    def _forward_features(self, x, sizes):
+        return self.layer(self._padding(x))
+
     def forward(self, x, sizes):
-        return self.layer(self._padding(x)), self._calculate_sizes(sizes)
+        return self._forward_features(x, sizes), self._calculate_sizes(sizes)
 
 class SizeTrackingMaxPool2d(SizeTracking):
     def __init__(self, *args, **kwargs):
@@ -89,6 +177,15 @@ class SizeTrackingMaxPool2d(SizeTracking):
         widths = widths.reshape((batch_size, 1))
         return torch.cat((channels, heights, widths), dim=1)
 
+    def _size_formula(self, formula):
+        if self.layer.ceil_mode:
+            return None
+        return [
+            formula[0],
+            _window_term(formula[1], self.kernel_size[0], self.stride[0], self.padding[0], self.dilation[0]),
+            _window_term(formula[2], self.kernel_size[1], self.stride[1], self.padding[1], self.dilation[1]),
+        ]
+
 class SizeTrackingFlatten(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingFlatten, self).__init__()
@@ -107,9 +204,15 @@ class SizeTrackingSqueeze(nn.Module):
         right = sizes[:, self.dim:]
         return torch.cat((left, right), dim=1)
 
-    def forward(self, x, sizes):
+    def _size_formula(self, formula):
+        return formula[:self.dim-1] + formula[self.dim:]
+
+    def _forward_features(self, x, sizes):
         assert x.size(self.dim) == 1
-        return x.squeeze(dim=self.dim), self._calculate_sizes(sizes)
+        return x.squeeze(dim=self.dim)
+
+    def forward(self, x, sizes):
+        return self._forward_features(x, sizes), self._calculate_sizes(sizes)
 
 class SizeTrackingPermute(nn.Module):
     def __init__(self, *permutation):
@@ -121,8 +224,14 @@ class SizeTrackingPermute(nn.Module):
     def _calculate_sizes(self, sizes):
         return sizes[:, self.inner_permutation]
 
+    def _size_formula(self, formula):
+        return [formula[i - 1] for i in self.permutation[1:]]
+
+    def _forward_features(self, x, sizes):
+        return x.permute(self.permutation)
+
     def forward(self, x, sizes):
-        return x.permute(self.permutation), self._calculate_sizes(sizes)
+        return self._forward_features(x, sizes), self._calculate_sizes(sizes)
 
 class SizeTrackingCombineDims(nn.Module):
     def __init__(self, start_dim, end_dim):
@@ -140,26 +249,47 @@ class SizeTrackingCombineDims(nn.Module):
         right = sizes[:, self.end_dim:]
         return torch.cat((left, middle, right), dim=1)
 
+    # Sizes are passed through unchanged (see forward)
+    def _size_formula(self, formula):
+        return formula
+
+    def _forward_features(self, x, sizes):
+        return x.flatten(start_dim=2, end_dim=3)
+
     def forward(self, x, sizes):
         #return x.flatten(start_dim=self.start_dim, end_dim=self.end_dim), self._calculate_sizes(sizes)
-        return x.flatten(start_dim=2, end_dim=3), sizes
+        return self._forward_features(x, sizes), sizes
 
 class SequencePacker(nn.Module):
+    needs_sizes = True
+
     def __init__(self):
         super(SequencePacker, self).__init__()
 
+    def _size_formula(self, formula):
+        return formula
+
+    def _forward_features(self, x, sizes):
+        # Note the lengths tensor has to be on the cpu (no sync if the sizes already are)
+        return torch.nn.utils.rnn.pack_padded_sequence(x, sizes[:, 0].to("cpu"), batch_first=True)
+
     def forward(self, x, sizes):
-        # Note the lengths tensor has to be on the cpu
-        return torch.nn.utils.rnn.pack_padded_sequence(x, sizes[:, 0].to("cpu"), batch_first=True), sizes
+        return self._forward_features(x, sizes), sizes
 
 class SequenceUnpacker(nn.Module):
     def __init__(self, padding_value=0):
         super(SequenceUnpacker, self).__init__()
         self.padding_value = padding_value
 
-    def forward(self, x, sizes):
+    def _size_formula(self, formula):
+        return formula
+
+    def _forward_features(self, x, sizes):
         out, _ = torch.nn.utils.rnn.pad_packed_sequence(x, padding_value=self.padding_value, batch_first=True)
-        return out, sizes
+        return out
+
+    def forward(self, x, sizes):
+        return self._forward_features(x, sizes), sizes
 
 class SizeTrackingLSTM(nn.Module):
     def __init__(self, *args, **kwargs):
@@ -176,9 +306,15 @@ class SizeTrackingLSTM(nn.Module):
         h_out = sizes.new_ones((batch_size, 1)) * self.h_out
         return torch.cat((seq_lens, h_out), dim=1)
 
-    def forward(self, x, sizes):
+    def _size_formula(self, formula):
+        return [formula[0], _constant_term(self.h_out)]
+
+    def _forward_features(self, x, sizes):
         out, _ = self.layer(x)
-        return out, self._calculate_sizes(sizes)
+        return out
+
+    def forward(self, x, sizes):
+        return self._forward_features(x, sizes), self._calculate_sizes(sizes)
 
 class SizeTrackingSoftmax(SizeTracking):
     def __init__(self, *args, **kwargs):
@@ -188,6 +324,9 @@ class SizeTrackingSoftmax(SizeTracking):
     def _calculate_sizes(self, sizes):
         return sizes
 
+    def _size_formula(self, formula):
+        return formula
+
 class SizeTrackingReLU(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingReLU, self).__init__()
@@ -196,14 +335,25 @@ class SizeTrackingReLU(SizeTracking):
     def _calculate_sizes(self, sizes):
         return sizes
 
+    def _size_formula(self, formula):
+        return formula
+
 class SizeTrackingLogSoftmax(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingLogSoftmax, self).__init__()
         self.layer = nn.LogSoftmax(*args, **kwargs)
 
+    # Always computed in fp32, even under autocast, since the CTC loss needs precise log probabilities
+    def _forward_features(self, x, sizes):
+        with torch.autocast(x.device.type, enabled=False):
+            return self.layer(x.float())
+
     def _calculate_sizes(self, sizes):
         return sizes
 
+    def _size_formula(self, formula):
+        return formula
+
 class SizeTrackingLinear(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingLinear, self).__init__()
@@ -215,6 +365,9 @@ class SizeTrackingLinear(SizeTracking):
         right = sizes.new_ones((batch_size, 1)) * self.layer.out_features
         return torch.cat((left, right), dim=1)
 
+    def _size_formula(self, formula):
+        return formula[:-1] + [_constant_term(self.layer.out_features)]
+
 class SizeTrackingBatchNorm2d(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingBatchNorm2d, self).__init__()
@@ -223,6 +376,9 @@ class SizeTrackingBatchNorm2d(SizeTracking):
     def _calculate_sizes(self, sizes):
         return sizes
 
+    def _size_formula(self, formula):
+        return formula
+
 class SizeTrackingDropout(SizeTracking):
     def __init__(self, *args, **kwargs):
         super(SizeTrackingDropout, self).__init__()
@@ -230,3 +386,49 @@ class SizeTrackingDropout(SizeTracking):
 
     def _calculate_sizes(self, sizes):
         return sizes
+
+    def _size_formula(self, formula):
+        return formula
+
+# Building blocks of InferenceModel (see model.py), which avoid everything TorchScript and
+# torch.compile can't handle in the layers above: variadic forwards, sizes computed layer by layer and
+# packed sequences.
+
+# A convolution with its padding applied explicitly (as fixed left, right, top, bottom amounts)
+class PaddedConv2d(nn.Module):
+    def __init__(self, conv, padding):
+        super(PaddedConv2d, self).__init__()
+        self.conv = conv
+        self.padding = list(padding)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.conv(torch.nn.functional.pad(x, self.padding))
+
+# A bidirectional LSTM over a padded batch that gives the same results as running it on a packed
+# sequence. The forward direction only ever looks back, so padding at the end of a row can't change
+# its valid outputs. For the backward direction each row is reversed within its length, run forward
+# and reversed back. Outputs past a row's length are zero, like pad_packed_sequence pads them.
+class MaskedBidirectionalLSTM(nn.Module):
+    def __init__(self, lstm):
+        super(MaskedBidirectionalLSTM, self).__init__()
+        assert lstm.bidirectional and lstm.batch_first and lstm.num_layers == 1 and lstm.proj_size == 0
+        self.forward_lstm = nn.LSTM(lstm.input_size, lstm.hidden_size, bias=lstm.bias, batch_first=True)
+        self.backward_lstm = nn.LSTM(lstm.input_size, lstm.hidden_size, bias=lstm.bias, batch_first=True)
+        for name, _ in self.forward_lstm.named_parameters():
+            getattr(self.forward_lstm, name).data.copy_(getattr(lstm, name))
+            getattr(self.backward_lstm, name).data.copy_(getattr(lstm, name + "_reverse"))
+
+    def _reverse(self, x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        # Reverses the first lengths[i] steps of every row, leaving the padding in place
+        steps = torch.arange(x.size(1), device=x.device).unsqueeze(0)
+        lengths = lengths.unsqueeze(1)
+        index = torch.where(steps < lengths, lengths - 1 - steps, steps)
+        return x.gather(1, index.unsqueeze(2).expand(-1, -1, x.size(2)))
+
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        lengths = lengths.to(x.device)
+        forward_out, _ = self.forward_lstm(x)
+        backward_out, _ = self.backward_lstm(self._reverse(x, lengths))
+        out = torch.cat((forward_out, self._reverse(backward_out, lengths)), dim=2)
+        mask = torch.arange(x.size(1), device=x.device).unsqueeze(0) < lengths.unsqueeze(1)
+        return out * mask.unsqueeze(2).to(out.dtype)
@@ -0,0 +1,25 @@
+import argparse
+from pathlib import Path
+import shutil
+
+from shards import *
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", "-d", type=Path, required=True,
+                        help="The directory containing the generated dataset (labels.json, codec.json and images)")
+    parser.add_argument("--out_dir", "-o", type=Path, required=True,
+                        help="The directory to save the packed dataset shards to.")
+    parser.add_argument("--shard_size", "-s", type=int, default=100000, required=False,
+                        help="The maximum number of samples per shard.")
+
+    # Parse command line args
+    args = parser.parse_args()
+
+    # Create output directory for packed dataset
+    args.out_dir.mkdir(parents=True, exist_ok=False)
+
+    # Copy dataset codec information to the output directory
+    shutil.copy(args.data_dir / "codec.json", args.out_dir / "codec.json")
+
+    pack_dataset(args.data_dir, args.out_dir, args.shard_size)
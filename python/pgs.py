@@ -0,0 +1,347 @@
+import argparse
+import mmap
+from pathlib import Path
+import struct
+import numpy as np
+from PIL import Image
+
+# Reads PGS (Blu-ray .sup) subtitles straight from a memory mapped file, like the C# PGSReader but
+# streaming: segments are parsed as frames are requested and objects are only decoded when a frame
+# shows them. All integers are big endian.
+#
+# A display set is a PCS (presentation composition), WDS (window definitions), PDS (palettes), ODS
+# (objects, run length encoded palette indices) and END segment, and every END yields a frame.
+SEGMENT_HEADER = struct.Struct(">HIIBH") # magic, presentation timestamp, decoding timestamp, type, size
+SEGMENT_MAGIC = 0x5047 # "PG"
+SEGMENT_PDS = 0x14
+SEGMENT_ODS = 0x15
+SEGMENT_PCS = 0x16
+SEGMENT_WDS = 0x17
+SEGMENT_END = 0x80
+
+PCS_HEADER = struct.Struct(">HHBHBBBB") # width, height, frame rate, composition number, state, palette update, palette id, objects
+COMPOSITION_OBJECT = struct.Struct(">HBBHH") # object id, window id, cropped flag, x, y
+COMPOSITION_CROP = struct.Struct(">HHHH") # x, y, width, height
+WINDOW_DEFINITION = struct.Struct(">BHHHH") # window id, x, y, width, height
+ODS_HEADER = struct.Struct(">HBB") # object id, version, sequence flag
+ODS_FIRST_HEADER = struct.Struct(">BHHH") # data length (3 bytes, split up), width, height
+
+COMPOSITION_EPOCH_START = 0x80
+ODS_FIRST_IN_SEQUENCE = 0x80
+
+# Decoded objects hold palette indices, pixels no run wrote to get this index (one past the largest
+# palette index), which every palette lookup table maps to transparent
+TRANSPARENT_INDEX = 256
+
+# Bytes in an RLE token starting with a zero byte, by the top two bits of the second byte
+_ESCAPE_LENGTHS = np.array([2, 3, 3, 4], dtype=np.uint8)
+
+# Maps of the 4 token states (below) packed into a byte, 2 bits per state, and the table composing two
+# of them: _COMPOSE[g, f] is g applied after f
+def _compose_table():
+    codes = np.arange(256)
+    maps = np.stack([(codes >> (2 * state)) & 3 for state in range(4)], axis=1)
+    composed = np.zeros((256, 256), dtype=np.uint8)
+    for state in range(4):
+        composed |= (maps[:, maps[:, state]] << (2 * state)).astype(np.uint8)
+    return composed
+_COMPOSE = _compose_table()
+
+# Position of every token in RLE data. Whether a byte starts a token depends on the tokens before it,
+# which makes this a prefix scan over a small state machine: the state at a byte is how many bytes of
+# the current token are left before it (0 if a token starts at it). Tokens longer than one byte start
+# with a zero byte, so the scan only needs to run over those. The transition from one zero byte to the
+# next takes the token that starts there (if one does) and then steps over the nonzero bytes up to the
+# next zero byte. These transitions are composed by doubling, which takes whole array lookups instead
+# of a loop over the tokens. Three nonzero bytes in a row always end in state 0, so only chains of zero
+# bytes closer together than that need composing.
+def _token_starts(data):
+    n = data.size
+    zeros = np.flatnonzero(data == 0)
+    if zeros.size == 0:
+        return np.arange(n)
+
+    following = np.zeros(zeros.size, dtype=np.uint8)
+    following[zeros < n - 1] = data[zeros[zeros < n - 1] + 1]
+    lengths = _ESCAPE_LENGTHS[following >> 6]
+    gaps = np.diff(np.append(zeros, n)) - 1
+
+    # Bytes left of the token after a zero byte in each state, then after the nonzero bytes that follow
+    left = np.stack((lengths - 1, np.zeros_like(lengths), np.ones_like(lengths), np.full_like(lengths, 2)), axis=1)
+    after = np.maximum(left.astype(np.int64) - gaps[:, np.newaxis], 0).astype(np.uint8)
+    transitions = after[:, 0] | (after[:, 1] << 2) | (after[:, 2] << 4) | (after[:, 3] << 6)
+
+    resets = np.flatnonzero(gaps >= 3)
+    longest_chain = int(np.diff(np.concatenate(([-1], resets, [zeros.size]))).max())
+    step = 1
+    while step < longest_chain:
+        transitions[step:] = _COMPOSE[transitions[step:], transitions[:-step]]
+        step *= 2
+
+    # The state at every zero byte (nothing is left before the first one) and the bytes of the token
+    # that are left after it
+    states = np.zeros(zeros.size, dtype=np.int64)
+    states[1:] = transitions[:-1] & 3
+    covered = np.where(states == 0, lengths.astype(np.int64) - 1, states - 1)
+
+    # A byte after a zero byte starts a token if it's past the covered bytes (or is the zero byte
+    # itself, in state 0), bytes before the first zero byte all do
+    segments = np.repeat(np.arange(zeros.size), gaps + 1)
+    offsets = np.arange(zeros[0], n) - zeros[segments]
+    starts = np.where(offsets == 0, states[segments] == 0, offsets > covered[segments])
+    return np.concatenate((np.arange(zeros[0]), zeros[0] + np.flatnonzero(starts)))
+
+# Decodes the RLE data of an object into a (height, width) array of palette indices. Every token is a
+# run of one palette index, so the runs are found and expanded with whole array operations. A
+# zero length token (0x00 0x00) ends a line, pixels past the width are dropped and pixels no run
+# wrote are TRANSPARENT_INDEX. Data without any end of line markers is written row by row instead.
+def decode_rle(data, width, height):
+    data = np.frombuffer(data, dtype=np.uint8)
+    indices = np.full(height * width, TRANSPARENT_INDEX, dtype=np.uint16)
+    if data.size == 0:
+        return indices.reshape((height, width))
+
+    n = data.size
+    padded = np.zeros(n + 3, dtype=np.uint8)
+    padded[:n] = data
+    starts = _token_starts(data)
+    if starts[-1] + (1 if data[starts[-1]] != 0 else _ESCAPE_LENGTHS[padded[starts[-1] + 1] >> 6]) > n:
+        raise ValueError("Object data ends in the middle of a run")
+
+    first = padded[starts]
+    second = padded[starts + 1]
+    third = padded[starts + 2].astype(np.int64)
+    escape = first == 0
+    mode = second >> 6
+
+    # Modes 0 and 1 are runs of index 0, 2 and 3 runs of an index that follows, 1 and 3 have 14 bit lengths
+    short_counts = (second & 0x3F).astype(np.int64)
+    long_counts = (short_counts << 8) | third
+    counts = np.where(escape, np.where((mode & 1) == 1, long_counts, short_counts), 1)
+    colors = np.where(escape, np.where(mode == 2, third, np.where(mode == 3, padded[starts + 3], 0)), first).astype(np.uint16)
+    end_of_line = escape & (second == 0)
+
+    total = int(counts.sum())
+    run_offsets = np.cumsum(counts) - counts
+    if not end_of_line.any():
+        total = min(total, indices.size)
+        indices[:total] = np.repeat(colors, counts)[:total]
+        return indices.reshape((height, width))
+
+    # Line of every run and where it starts within the line (end of line tokens have no pixels, so the
+    # offset of the one ending a line is where the next line starts)
+    lines = np.cumsum(end_of_line) - end_of_line
+    line_offsets = np.concatenate(([0], run_offsets[end_of_line]))
+    columns = run_offsets - line_offsets[lines]
+    if np.any((columns + counts > width) | ((lines >= height) & (counts > 0))):
+        # Some runs go past the object, clip them pixel by pixel
+        pixel_runs = np.repeat(np.arange(starts.size), counts)
+        pixel_columns = columns[pixel_runs] + np.arange(total) - run_offsets[pixel_runs]
+        pixel_rows = lines[pixel_runs]
+        valid = (pixel_columns < width) & (pixel_rows < height)
+        indices[pixel_rows[valid] * width + pixel_columns[valid]] = colors[pixel_runs[valid]]
+    else:
+        destinations = np.repeat(lines * width + columns - run_offsets, counts) + np.arange(total)
+        indices[destinations] = np.repeat(colors, counts)
+
+    return indices.reshape((height, width))
+
+# RGBA lookup table for a palette from its (entry id, Y, Cr, Cb, alpha) rows, with the same YCbCr to
+# RGB conversion as the C# PaletteEntry. Indices without an entry (and TRANSPARENT_INDEX) are
+# transparent, so applying a palette to an object is a single gather: table[indices].
+def palette_table(entries):
+    entries = entries.astype(np.float64)
+    y = entries[:, 1]
+    cr = entries[:, 2] - 128.0
+    cb = entries[:, 3] - 128.0
+    rgb = np.stack((y + 1.402525 * cr, y - 0.343730 * cb - 0.714401 * cr, y + 1.769905 * cb + 0.000013 * cr), axis=1)
+
+    table = np.zeros((TRANSPARENT_INDEX + 1, 4), dtype=np.uint8)
+    table[entries[:, 0].astype(np.int64), :3] = np.rint(np.clip(rgb, 0.0, 255.0)).astype(np.uint8)
+    table[entries[:, 0].astype(np.int64), 3] = entries[:, 4].astype(np.uint8)
+    return table
+
+class PGSImage():
+    def __init__(self, image, x, y):
+        self.image = image # RGBA, shape (height, width, 4)
+        self.x = x
+        self.y = y
+
+class PGSFrame():
+    def __init__(self, pts, images):
+        self.pts = pts # Presentation timestamp in 90kHz ticks
+        self.timestamp = pts // 90 # In milliseconds
+        self.images = sorted(images, key=lambda x: x.y) # One per window shown, top to bottom
+
+class _PGSObject():
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.fragments = []
+        self.indices = None
+
+    def decode(self):
+        # Objects split over several segments are decoded once, when a frame first shows them
+        if self.indices is None:
+            data = self.fragments[0] if len(self.fragments) == 1 else b"".join(bytes(x) for x in self.fragments)
+            self.indices = decode_rle(data, self.width, self.height)
+            self.fragments = []
+        return self.indices
+
+class PGSReader():
+    def __init__(self, path):
+        self.path = path
+        f = open(path, "rb")
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+    def close(self):
+        self.data.close()
+
+    def __iter__(self):
+        return self.frames()
+
+    # Yields the (type, presentation timestamp, body offset, body size) of every segment
+    def segments(self):
+        offset = 0
+        while offset < len(self.data):
+            if offset + SEGMENT_HEADER.size > len(self.data):
+                raise ValueError("Segment header cut off at byte " + str(offset))
+            magic, pts, _, segment_type, size = SEGMENT_HEADER.unpack_from(self.data, offset)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError("Segment header magic number is not correct at byte " + str(offset))
+            offset += SEGMENT_HEADER.size
+            if offset + size > len(self.data):
+                raise ValueError("Segment cut off at byte " + str(offset))
+            yield segment_type, pts, offset, size
+            offset += size
+
+    # Timestamps (in milliseconds) of all frames, without decoding anything
+    def timestamps(self):
+        timestamps = []
+        pts = 0
+        for segment_type, segment_pts, _, _ in self.segments():
+            if segment_type == SEGMENT_PCS:
+                pts = segment_pts
+            elif segment_type == SEGMENT_END:
+                timestamps.append(pts // 90)
+        return np.array(timestamps, dtype=np.int64)
+
+    # Yields a PGSFrame at every END segment, in file order. Frames without images clear the screen.
+    def frames(self):
+        objects = {}
+        palettes = {}
+        windows = {}
+        compositions = []
+        palette_id = 0
+        pts = 0
+
+        for segment_type, segment_pts, offset, size in self.segments():
+            if segment_type == SEGMENT_PCS:
+                _, _, _, _, state, _, palette_id, num_objects = PCS_HEADER.unpack_from(self.data, offset)
+                if state == COMPOSITION_EPOCH_START:
+                    objects = {}
+                    palettes = {}
+                    windows = {}
+                pts = segment_pts
+
+                compositions = []
+                position = offset + PCS_HEADER.size
+                for _ in range(num_objects):
+                    object_id, window_id, cropped, x, y = COMPOSITION_OBJECT.unpack_from(self.data, position)
+                    position += COMPOSITION_OBJECT.size
+                    crop = None
+                    if cropped & 0x80:
+                        crop = COMPOSITION_CROP.unpack_from(self.data, position)
+                        position += COMPOSITION_CROP.size
+                    compositions.append((object_id, window_id, x, y, crop))
+
+            elif segment_type == SEGMENT_WDS:
+                for i in range(self.data[offset]):
+                    window_id, x, y, width, height = WINDOW_DEFINITION.unpack_from(self.data, offset + 1 + i * WINDOW_DEFINITION.size)
+                    windows[window_id] = (x, y, width, height)
+
+            elif segment_type == SEGMENT_PDS:
+                entries = np.frombuffer(self.data, dtype=np.uint8, count=(size - 2) // 5 * 5, offset=offset + 2)
+                palettes[self.data[offset]] = palette_table(entries.reshape((-1, 5)))
+
+            elif segment_type == SEGMENT_ODS:
+                object_id, _, sequence = ODS_HEADER.unpack_from(self.data, offset)
+                position = offset + ODS_HEADER.size
+                if sequence & ODS_FIRST_IN_SEQUENCE:
+                    _, _, width, height = ODS_FIRST_HEADER.unpack_from(self.data, position)
+                    position += ODS_FIRST_HEADER.size
+                    objects[object_id] = _PGSObject(width, height)
+                elif not object_id in objects:
+                    raise ValueError("Object " + str(object_id) + " continued before it was started")
+                # Zero copy view of the run length encoded data
+                objects[object_id].fragments.append(memoryview(self.data)[position:offset + size])
+
+            elif segment_type == SEGMENT_END:
+                yield PGSFrame(pts, self._compose(compositions, objects, palettes.get(palette_id), windows))
+
+            else:
+                raise ValueError("Unknown segment type: " + str(segment_type))
+
+    # One RGBA image per window with objects in it, objects drawn over each other in order
+    def _compose(self, compositions, objects, palette, windows):
+        window_images = {}
+        drawn = set()
+        for object_id, window_id, x, y, crop in compositions:
+            if not object_id in objects:
+                raise ValueError("Composition object referenced object that does not exist")
+            if not window_id in windows:
+                raise ValueError("Composition object referenced window that does not exist")
+            if palette is None:
+                raise ValueError("Tried to show an object without a palette set")
+
+            window_x, window_y, window_width, window_height = windows[window_id]
+            if not window_id in window_images:
+                window_images[window_id] = np.zeros((window_height, window_width, 4), dtype=np.uint8)
+            canvas = window_images[window_id]
+
+            indices = objects[object_id].decode()
+            if not crop is None:
+                crop_x, crop_y, crop_width, crop_height = crop
+                indices = indices[crop_y:crop_y + crop_height, crop_x:crop_x + crop_width]
+
+            # Clip the object to the window
+            left = x - window_x
+            top = y - window_y
+            indices = indices[max(-top, 0):max(window_height - top, 0), max(-left, 0):max(window_width - left, 0)]
+            top = max(top, 0)
+            left = max(left, 0)
+            region = canvas[top:top + indices.shape[0], left:left + indices.shape[1]]
+
+            # The lookup is a gather of whole RGBA pixels, and only objects drawn over others need blending
+            pixels = palette.view(np.uint32)[:, 0][indices].view(np.uint8).reshape(indices.shape + (4,))
+            if window_id in drawn:
+                visible = pixels[:, :, 3] > 0
+                region[visible] = pixels[visible]
+            else:
+                region[...] = pixels
+                drawn.add(window_id)
+
+        return [PGSImage(image, windows[i][0], windows[i][1]) for i, image in window_images.items()]
+
+# Writes the images of every frame of a PGS file, like the parse-pgs command of the C# tool (without an
+# output directory only the timestamps are printed)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=Path,
+                        help="The PGS file to read.")
+    parser.add_argument("out_dir", type=Path, nargs="?",
+                        help="Where to write the images of every frame to.")
+
+    args = parser.parse_args()
+
+    reader = PGSReader(args.path)
+    if args.out_dir is None:
+        for frame_count, timestamp in enumerate(reader.timestamps()):
+            print("Frame {}: {}ms".format(frame_count, timestamp))
+    else:
+        for frame_count, frame in enumerate(reader.frames()):
+            for window_count, image in enumerate(frame.images):
+                Image.fromarray(image.image, "RGBA").save(args.out_dir / "frame_{}_window_{}.png".format(frame_count, window_count))
+        print("Done. Files written to " + str(args.out_dir))
+    reader.close()
@@ -0,0 +1,99 @@
+import os
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+import torch
+
+from data import *
+from decoders import *
+from inference import *
+from metrics import *
+
+# Batches of a random sample of a TextDataset, fed to ONNX Runtime's calibration (which only needs
+# get_next). Samples are sorted by width before batching so calibration sees little padding.
+class CalibrationBatches():
+    def __init__(self, dataset, num_samples=100, batch_size=8, seed=0):
+        self.dataset = dataset
+        indices = np.random.default_rng(seed).permutation(len(dataset))[:num_samples]
+        indices = indices[np.argsort(dataset.widths()[indices], kind="stable")]
+        self.batches = [indices[i:i + batch_size].tolist() for i in range(0, len(indices), batch_size)]
+        self.next_batch = 0
+
+    def get_next(self):
+        if self.next_batch >= len(self.batches):
+            return None
+        batch = self.batches[self.next_batch]
+        self.next_batch += 1
+
+        images, _, sizes, _ = padded_sorted_collate([self.dataset[i] for i in batch])
+        return {"images": images.numpy(), "sizes": sizes.numpy()}
+
+# Quantizes an exported fp32 model (opset 13 or later, for per channel weights) to INT8. The conv
+# stack is quantized statically, with activation ranges calibrated on calibration_data, and the LSTM
+# and linear layers dynamically (INT8 weights, activations quantized on the fly per batch).
+def quantize_onnx(model_path, out_path, calibration_data):
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    static_path = Path(tmp_dir.name) / "model_static.onnx"
+    quantize_static(model_path, static_path, calibration_data,
+                    quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=["Conv"],
+                    per_channel=True,
+                    weight_type=QuantType.QInt8,
+                    activation_type=QuantType.QInt8)
+    quantize_dynamic(static_path, out_path,
+                     op_types_to_quantize=["LSTM", "MatMul", "Gemm"],
+                     weight_type=QuantType.QInt8)
+    tmp_dir.cleanup()
+
+# Greedy decoded accuracy, CER and latency of an engine on a TextDataset, batched like validation
+def evaluate_engine(engine, dataset, batch_size=8):
+    sampler = WidthBucketBatchSampler(dataset.widths(), batch_size, shuffle=False)
+    decoder = CTCGreedyDecoder()
+    accuracy_metric = SequenceAccuracy()
+    cer_metric = CharacterErrorRate()
+
+    correct = 0.0
+    chars = 0
+    char_errors = 0
+    times = []
+    for batch in sampler:
+        imgs, lbls, img_lens, lbl_lens = padded_sorted_collate([dataset[i] for i in batch])
+
+        start = time.perf_counter()
+        probs, prob_lens = engine(imgs, img_lens)
+        times.append(time.perf_counter() - start)
+
+        decoded, decoded_lens = decoder(probs, prob_lens)
+        correct += float(accuracy_metric(decoded, lbls, lbl_lens)) * int(lbl_lens.sum())
+        errors, num_chars = cer_metric.counts(decoded, decoded_lens, lbls, lbl_lens)
+        char_errors += int(errors)
+        chars += int(num_chars)
+
+    times = np.array(times)
+    return {
+        "accuracy": correct / max(chars, 1),
+        "cer": char_errors / max(chars, 1),
+        "latency_p50": float(np.percentile(times, 50)) if len(times) > 0 else 0.0,
+        "images_per_second": len(dataset) / max(times.sum(), 1e-9),
+    }
+
+# Prints size, latency and accuracy of the fp32 and INT8 models side by side
+def report_quantization(fp32_path, int8_path, dataset, batch_size=8, threads=None):
+    results = []
+    for path in [fp32_path, int8_path]:
+        result = evaluate_engine(OnnxEngine(path, threads), dataset, batch_size)
+        result["size"] = os.path.getsize(path)
+        results.append(result)
+    fp32, int8 = results
+
+    print("Model size: {:.1f}MB -> {:.1f}MB ({:.2f}x smaller)".format(
+        fp32["size"] / 2**20, int8["size"] / 2**20, fp32["size"] / int8["size"]))
+    print("Batch latency p50: {:.1f}ms -> {:.1f}ms, throughput: {:.1f} -> {:.1f} images/s".format(
+        fp32["latency_p50"] * 1000.0, int8["latency_p50"] * 1000.0, fp32["images_per_second"], int8["images_per_second"]))
+    print("Accuracy: {:.4f} -> {:.4f} ({:+.4f}), CER: {:.4f} -> {:.4f} ({:+.4f})".format(
+        fp32["accuracy"], int8["accuracy"], int8["accuracy"] - fp32["accuracy"],
+        fp32["cer"], int8["cer"], int8["cer"] - fp32["cer"]))
+    return fp32, int8
@@ -0,0 +1,186 @@
+import json
+import numpy as np
+import torch
+from PIL import Image
+
+# Shard file layout (all integers little endian):
+#   magic (8 bytes) | header (uint64 x 6) | image bytes | labels (int64) | index (int64 x 4 per sample)
+#
+# The header holds the format version, number of samples, byte offset and element count of the
+# labels section and byte offset of the index section. Each index row is
+# (image offset, image width, label offset, label length), where the image offset is relative to
+# the start of the image section and the label offset counts label elements. Images are stored as
+# the raw alpha channel, transposed so that width comes first (the layout TextDataset works with).
+SHARD_MAGIC = b"TXTSHARD"
+SHARD_VERSION = 1
+SHARD_HEADER_FIELDS = 6
+SHARD_HEADER_SIZE = len(SHARD_MAGIC) + SHARD_HEADER_FIELDS * 8
+SHARD_MANIFEST = "shards.json"
+IMAGE_HEIGHT = 32
+
+def load_alpha_image(path):
+    img = Image.open(path, "r")
+    assert img.height == IMAGE_HEIGHT
+    img_data = np.asarray(img)
+    img_data = img_data[:, :, -1] # use only alpha channel
+    return np.ascontiguousarray(img_data.transpose()) # Make width come first
+
+class ShardWriter():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(bytes(SHARD_HEADER_SIZE)) # Placeholder until the header is known
+
+        self.index = []
+        self.labels = []
+        self.image_bytes = 0
+        self.label_elements = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, image, label):
+        # Image is a uint8 array of shape (width, height), label is a sequence of class indices
+        assert image.dtype == np.uint8 and image.shape[1] == IMAGE_HEIGHT
+        self.file.write(np.ascontiguousarray(image).tobytes())
+        self.index.append((self.image_bytes, image.shape[0], self.label_elements, len(label)))
+        self.labels.append(np.asarray(label, dtype=np.int64))
+        self.image_bytes += image.size
+        self.label_elements += len(label)
+
+    def close(self):
+        # Labels are int64, so align the label section for memory mapping
+        padding = (-(SHARD_HEADER_SIZE + self.image_bytes)) % 8
+        self.file.write(bytes(padding))
+        labels_offset = SHARD_HEADER_SIZE + self.image_bytes + padding
+
+        labels = np.concatenate(self.labels) if len(self.labels) > 0 else np.zeros(0, dtype=np.int64)
+        self.file.write(labels.astype("<i8").tobytes())
+        index_offset = labels_offset + labels.nbytes
+
+        index = np.array(self.index, dtype="<i8").reshape((-1, 4))
+        self.file.write(index.tobytes())
+
+        # Go back and fill in the header
+        header = np.array([SHARD_VERSION, len(self.index), labels_offset, self.label_elements, index_offset, 0], dtype="<u8")
+        self.file.seek(0)
+        self.file.write(SHARD_MAGIC)
+        self.file.write(header.tobytes())
+        self.file.close()
+
+class ShardReader():
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, "rb")
+        magic = f.read(len(SHARD_MAGIC))
+        header = np.frombuffer(f.read(SHARD_HEADER_FIELDS * 8), dtype="<u8")
+        f.close()
+
+        if magic != SHARD_MAGIC:
+            raise ValueError("Not a dataset shard: " + str(path))
+        if header[0] != SHARD_VERSION:
+            raise ValueError("Unsupported shard version " + str(header[0]) + ": " + str(path))
+
+        self.num_samples = int(header[1])
+        self.labels_offset = int(header[2])
+        self.label_elements = int(header[3])
+        self.index_offset = int(header[4])
+
+        self._open()
+
+    def _open(self):
+        # Copy-on-write mappings let torch.from_numpy create views without warnings about read-only
+        # memory, while the pages themselves stay shared between all processes reading the shard
+        self.images = np.memmap(self.path, dtype=np.uint8, mode="c", offset=SHARD_HEADER_SIZE,
+                                shape=(self.labels_offset - SHARD_HEADER_SIZE,))
+        self.labels = np.memmap(self.path, dtype="<i8", mode="c", offset=self.labels_offset,
+                                shape=(self.label_elements,))
+        self.index = np.memmap(self.path, dtype="<i8", mode="c", offset=self.index_offset,
+                               shape=(self.num_samples, 4))
+
+    # Don't pickle the mappings (that would copy the whole shard), reopen them instead
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["images"]
+        del state["labels"]
+        del state["index"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.num_samples
+
+    def widths(self):
+        return np.array(self.index[:, 1])
+
+    def __getitem__(self, idx):
+        image_offset, width, label_offset, label_length = self.index[idx]
+        image = self.images[image_offset:image_offset + width * IMAGE_HEIGHT].reshape((width, IMAGE_HEIGHT))
+        label = self.labels[label_offset:label_offset + label_length]
+        return torch.from_numpy(image), torch.from_numpy(label)
+
+class ShardedData():
+    def __init__(self, data_dir):
+        f = open(data_dir / SHARD_MANIFEST, "r")
+        manifest = json.load(f)
+        f.close()
+
+        assert manifest["ImageHeight"] == IMAGE_HEIGHT
+        self.shards = [ShardReader(data_dir / shard["Path"]) for shard in manifest["Shards"]]
+
+        # Global sample index -> (shard, index within shard)
+        self.shard_starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def widths(self):
+        return np.concatenate([shard.widths() for shard in self.shards])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.shard_starts, idx, side="right")) - 1
+        return self.shards[shard][idx - int(self.shard_starts[shard])]
+
+def pack_dataset(data_dir, out_dir, samples_per_shard=100000):
+    f = open(data_dir / "labels.json", "r")
+    data = json.load(f)
+    f.close()
+
+    f = open(data_dir / "codec.json", "r")
+    codec = json.load(f)
+    f.close()
+
+    # Class 0 is the CTC blank, matching TextDataset
+    class_map = {}
+    for char in codec:
+        class_map[char["Char"]] = len(class_map) + 1
+
+    image_extension = data["ImageExtension"]
+    lines = data["Lines"]
+
+    shards = []
+    writer = None
+    for i, annotation in enumerate(lines):
+        if writer is None:
+            name = "shard_" + str(len(shards)) + ".bin"
+            writer = ShardWriter(out_dir / name)
+            shards.append({"Path": name, "NumSamples": 0})
+
+        image = load_alpha_image(str(data_dir / str(annotation["Image"])) + image_extension)
+        label = [class_map[c] for c in annotation["Text"]]
+        writer.write(image, label)
+
+        if len(writer) == samples_per_shard or i == len(lines) - 1:
+            shards[-1]["NumSamples"] = len(writer)
+            writer.close()
+            writer = None
+
+    f = open(out_dir / SHARD_MANIFEST, "w")
+    json.dump({"ImageHeight": IMAGE_HEIGHT, "NumSamples": len(lines), "Shards": shards}, f)
+    f.close()
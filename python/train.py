@@ -1,54 +1,81 @@
 import argparse
+import contextlib
 from datetime import datetime
+import os
 from pathlib import Path
 import shutil
+import time
 import torch
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils import tensorboard
 from torch.profiler import profile, ProfilerActivity, schedule, tensorboard_trace_handler
 
+from augmentation import *
+from checkpoint import *
 from data import *
 from decoders import *
+from distributed import *
+from instrumentation import *
+from language_model import *
 from metrics import *
 from model import *
 
-if __name__ == '__main__':
-    now_str = Path(".") / "trained" / datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--train_data_dir", "-t", type=Path, required=True,
-                        help="The directory containing the training data")
-    parser.add_argument("--valid_data_dir", "-v", type=Path, required=True,
-                        help="The directory containing the validation data")
-    parser.add_argument("--out_dir", "-o", type=Path, default=now_str, required=False,
-                        help="The directory to save training logs and model checkpoints to. Defaults to current datetime in cwd/trained/.")
-    parser.add_argument("--batch_size", "-b", type=int, default=8, required=False,
-                        help="The training batch size.")
-    parser.add_argument("--learning_rate", "-l", type=float, default=0.0001, required=False,
-                        help="The training learning rate.")
-    parser.add_argument("--decay_rate", "-d", type=float, default=1.0, required=False,
-                        help="The learning rate decay rate.")
-    parser.add_argument("--save_interval", "-i", type=float, default=5, required=False,
-                        help="The interval (in epochs) to save network parameters at.")
-    parser.add_argument("--weights", "-w", type=Path, required=False,
-                        help="The saved weights to initialize the model with.")
+# Trains in one process. With --num_processes > 1 this runs in every process of a data parallel run
+# (rank is the process's index). Each process then trains on its own share of every epoch, gradients
+# are averaged across processes, and only rank 0 logs and saves checkpoints.
+def train(rank, args):
+    world_size = args.num_processes
+    main_process = rank == 0
 
-    # Parse command line args
-    args = parser.parse_args()
+    # Pick the device (GPU if available, one per process)
+    if torch.cuda.is_available():
+        device = torch.device("cuda:" + str(rank % torch.cuda.device_count()))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    if world_size > 1:
+        init_distributed(rank, world_size, args.master_port, device.type)
+        if device.type == "cpu":
+            # Split the cores between processes instead of every process using all of them
+            torch.set_num_threads(max(os.cpu_count() // world_size, 1))
 
-    # Load datasets
-    train_dataset = TextDataset(args.train_data_dir, augmentation=True)
-    train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=padded_sorted_collate, num_workers=4, pin_memory=True)
+    # Load datasets (the per dataset cache budget is split between processes too)
+    cache_size = args.cache_size * 1024 * 1024 // world_size
+    train_dataset = TextDataset(args.train_data_dir, augmentation=not args.batch_augmentation, cache_size=cache_size, cache_dir=args.cache_dir)
+    if args.bucket_size > 0:
+        train_sampler = WidthBucketBatchSampler(train_dataset.widths(), args.batch_size, args.max_batch_width, args.bucket_size,
+                                                num_replicas=world_size, rank=rank)
+        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=padded_sorted_collate, num_workers=4, pin_memory=True)
+    elif world_size > 1:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, world_size, rank, shuffle=True)
+        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, sampler=train_sampler, collate_fn=padded_sorted_collate, num_workers=4, pin_memory=True)
+    else:
+        train_sampler = None
+        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=padded_sorted_collate, num_workers=4, pin_memory=True)
 
-    valid_dataset = TextDataset(args.valid_data_dir, augmentation=False)
-    valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, collate_fn=padded_sorted_collate, num_workers=2, pin_memory=True)
+    # Every process validates a disjoint slice of the validation set. A device resident validation set
+    # is decoded once up front, so it doesn't need the cache or a DataLoader
+    valid_dataset = TextDataset(args.valid_data_dir, augmentation=False, cache_size=0 if args.resident_validation else cache_size, cache_dir=args.cache_dir)
+    valid_subset = valid_dataset
+    if world_size > 1:
+        valid_subset = torch.utils.data.Subset(valid_dataset, range(rank, len(valid_dataset), world_size))
+    if args.resident_validation:
+        valid_dataloader = None
+    elif args.bucket_size > 0:
+        valid_widths = valid_dataset.widths()[rank::world_size]
+        valid_sampler = WidthBucketBatchSampler(valid_widths, args.batch_size, args.max_batch_width, shuffle=False)
+        valid_dataloader = torch.utils.data.DataLoader(valid_subset, batch_sampler=valid_sampler, collate_fn=padded_sorted_collate, num_workers=2, pin_memory=True)
+    else:
+        valid_dataloader = torch.utils.data.DataLoader(valid_subset, batch_size=args.batch_size, collate_fn=padded_sorted_collate, num_workers=2, pin_memory=True)
 
-    # Create output directory for training logs and model checkpoints
-    args.out_dir.mkdir(parents=True, exist_ok=False)
-    writer = tensorboard.SummaryWriter(log_dir=args.out_dir)
+    if main_process:
+        # Create output directory for training logs and model checkpoints
+        args.out_dir.mkdir(parents=True, exist_ok=not args.resume is None)
+        writer = tensorboard.SummaryWriter(log_dir=args.out_dir)
 
-    # Copy dataset codec information to the output directory
-    shutil.copy(args.train_data_dir / "codec.json", args.out_dir / "codec.json")
+        # Copy dataset codec information to the output directory
+        shutil.copy(args.train_data_dir / "codec.json", args.out_dir / "codec.json")
 
     # Load model and setup optimzer, loss function, decoder, accuracy metric
     model = load_model(len(train_dataset.classes), args.weights)
@@ -56,130 +83,358 @@ if __name__ == '__main__':
     lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=args.decay_rate)
     ctc_loss = nn.CTCLoss(zero_infinity=False)
     decoder = CTCGreedyDecoder()
+    beam_decoder = None
+    if args.valid_beam_width > 0:
+        language_model = None
+        if not args.lm is None:
+            language_model = LanguageModel(args.lm, args.train_data_dir / "codec.json", args.lm_weight)
+        # The decode workers are split between processes, like the cpu cores
+        decode_workers = args.decode_workers if not args.decode_workers is None else os.cpu_count()
+        decode_workers = max(decode_workers // world_size, 1)
+        beam_decoder = ParallelCTCBeamDecoder(decode_workers, language_model)
+        valid_decoder = lambda probs, lens: beam_decoder(probs, lens, beam_width=args.valid_beam_width)
+    else:
+        valid_decoder = decoder
+    batch_augmentation = BatchAugmentation() if args.batch_augmentation else None
     accuracy_metric = SequenceAccuracy()
+    cer_metric = CharacterErrorRate()
+    wer_metric = WordErrorRate(train_dataset.class_map[" "]) if " " in train_dataset.class_map else None
 
-    # Send model to appropriate device (GPU if available)
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # Send model to the device
     model.to(device)
-    print("Running on device: " + str(device))
+    if main_process:
+        print("Running on device: " + str(device) + (" ({} processes)".format(world_size) if world_size > 1 else ""))
 
-    # Save model graph to Tensorboard
-    sizes = torch.tensor([[1, 32, 32]]).to(device)
-    imgs = torch.randn((1, sizes[0, 0], sizes[0, 1], sizes[0, 2])).to(device)
-    writer.add_graph(model, input_to_model=(imgs, sizes))
+    # Mixed precision setup. The CTC loss and log softmax always run in fp32
+    amp_dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp and device.type == "cuda")
 
-    # Begin training
+    # Restore training state, continuing with the epoch after the checkpointed one
     epoch = 0
-    with profile(
-        activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-        schedule=schedule(
-            skip_first=10,
-            wait=2,
-            warmup=2,
-            active=8,
-            repeat=2
-        ),
-        on_trace_ready=tensorboard_trace_handler(args.out_dir),
-        record_shapes=True,
-        profile_memory=True,
-        with_stack=False
-    ) as prof:
-        while True:
-            # Do training and calculate loss and accuracy
-            train_loss_avg = 0.0
-            train_accuracy_avg = 0.0
-            for imgs, lbls, img_lens, lbl_lens in train_dataloader:
-                # Send all tensors to correct device
-                imgs = imgs.to(device)
-                lbls = lbls.to(device)
-                img_lens = img_lens.to(device)
-                lbl_lens = lbl_lens.to(device)
-
-                # Feed forward and calculate loss
-                probs, prob_lens = model(imgs, img_lens)
-                probs = probs.transpose(0, 1) # Make batch size come second
-                prob_lens = prob_lens[:, 0]
-                loss = ctc_loss(probs, lbls, prob_lens, lbl_lens)
-
-                # Do gradient update step
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                # Accumulate loss for this epoch
-                train_loss_avg += loss.item() * imgs.size(0)
-
-                # Decode to get output strings
-                probs = probs.transpose(0, 1) # Put batch size back
-                decoded, decoded_lens = decoder(probs, prob_lens)
-
-                # Calculate accuracy
-                accuracy = accuracy_metric(decoded, lbls, lbl_lens)
-                train_accuracy_avg += accuracy.item() * imgs.size(0)
-
-                # Step profiler if after first epoch (use first epoch to load all data, warmup, etc.)
-                if epoch > 0:
-                    prof.step()
-
-            # Step lr scheduler after every epoch
-            lr_scheduler.step()
-
-            # Calculate average loss and accuracy
-            train_loss_avg /= len(train_dataloader.sampler)
-            train_accuracy_avg /= len(train_dataloader.sampler)
-
-            # Calculate loss and accuracy on validation dataset
-            valid_loss_avg = 0.0
-            valid_accuracy_avg = 0.0
-            with torch.no_grad():
-                model.train(False) # Put model in inference mode
-                for imgs, lbls, img_lens, lbl_lens in valid_dataloader:
-                    # Send all tensors to correct device
-                    imgs = imgs.to(device)
-                    lbls = lbls.to(device)
-                    img_lens = img_lens.to(device)
-                    lbl_lens = lbl_lens.to(device)
+    step = 0
+    if not args.resume is None:
+        epoch, step = load_checkpoint(args.resume, model, optimizer, lr_scheduler, scaler, rank)
+        epoch += 1
+        if main_process:
+            print("Resuming from epoch: " + str(epoch))
+
+    if main_process:
+        checkpoint_writer = CheckpointWriter(args.out_dir, args.keep_checkpoints if args.keep_checkpoints > 0 else None)
+
+        # Save model graph to Tensorboard
+        sizes = torch.tensor([[1, 32, 32]]).to(device)
+        imgs = torch.randn((1, sizes[0, 0], sizes[0, 1], sizes[0, 2])).to(device)
+        writer.add_graph(model, input_to_model=(imgs, sizes))
+
+    # Gradients are averaged across processes during the backward pass. Validation and checkpoints use
+    # the wrapped model directly. Without device_ids DDP leaves inputs where they are, so image sizes
+    # stay on the cpu
+    train_model = model
+    if world_size > 1:
+        train_model = DistributedDataParallel(model)
+
+    # Batches are moved to the device (and augmented) in the background
+    train_batches = DevicePrefetcher(train_dataloader, device, args.prefetch_depth, batch_augmentation)
+    if args.resident_validation:
+        valid_batches = DeviceResidentBatches(valid_dataset, device, args.batch_size, args.max_batch_width if args.bucket_size > 0 else None,
+                                              indices=range(rank, len(valid_dataset), world_size))
+    else:
+        valid_batches = DevicePrefetcher(valid_dataloader, device, args.prefetch_depth)
+
+    # Stage timers, and the full profiler if asked for
+    train_timers = StageTimers(device)
+    valid_timers = StageTimers(device)
+    profiler = contextlib.nullcontext()
+    if main_process:
+        logger = MetricsLogger(writer, args.out_dir / "metrics.jsonl")
+        if args.profile:
+            skip_first, wait, warmup, active, repeat = args.profile_schedule
+            profiler = profile(
+                activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
+                schedule=schedule(
+                    skip_first=skip_first,
+                    wait=wait,
+                    warmup=warmup,
+                    active=active,
+                    repeat=repeat
+                ),
+                on_trace_ready=tensorboard_trace_handler(args.out_dir),
+                record_shapes=True,
+                profile_memory=True,
+                with_stack=False
+            )
+
+    # Begin training (the metrics file is closed however it ends)
+    try:
+        with profiler as prof:
+            while True:
+                # Do training and calculate loss and accuracy (sampled every few steps)
+                train_metrics = MetricAccumulator()
+                interval_metrics = MetricAccumulator()
+                interval_start = time.perf_counter()
+                train_timers.reset()
+                valid_timers.reset()
+                if not train_sampler is None:
+                    train_sampler.set_epoch(epoch)
+                if device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(device)
+                train_start = time.perf_counter()
+                for imgs, lbls, img_lens, lbl_lens in train_batches:
+                    # Track how much of each batch is padding
+                    train_metrics.add("image_pixels", int(img_lens[:, 1].sum())) # Sizes are on the cpu
+                    train_metrics.add("padded_pixels", imgs.size(0) * imgs.size(2))
 
                     # Feed forward and calculate loss
-                    probs, prob_lens = model(imgs, img_lens)
-                    probs = probs.transpose(0, 1) # Make batch size come second
-                    prob_lens = prob_lens[:, 0]
-                    loss = ctc_loss(probs, lbls, prob_lens, lbl_lens)
+                    with train_timers.stage("forward"):
+                        with torch.autocast(device.type, dtype=amp_dtype, enabled=args.amp):
+                            probs, prob_lens = train_model(imgs, img_lens)
+                        probs = probs.transpose(0, 1) # Make batch size come second
+                        prob_lens = prob_lens[:, 0]
+                    with train_timers.stage("ctc_loss"):
+                        loss = ctc_loss(probs, lbls, prob_lens, lbl_lens)
+
+                    # Do gradient update step (the scaler does nothing unless training in fp16)
+                    with train_timers.stage("backward"):
+                        optimizer.zero_grad()
+                        scaler.scale(loss).backward()
+                    with train_timers.stage("optimizer"):
+                        scaler.step(optimizer)
+                        scaler.update()
+                    step += 1
 
                     # Accumulate loss for this epoch
-                    valid_loss_avg += loss.item() * imgs.size(0)
+                    with train_timers.stage("metric"):
+                        train_metrics.add("loss", loss * imgs.size(0))
+                        train_metrics.add("samples", imgs.size(0))
+                        interval_metrics.add("loss", loss * imgs.size(0))
+                        interval_metrics.add("samples", imgs.size(0))
+
+                    if step % args.train_accuracy_interval == 0:
+                        # Decode to get output strings
+                        with train_timers.stage("decode"):
+                            probs = probs.transpose(0, 1) # Put batch size back
+                            decoded, decoded_lens = decoder(probs, prob_lens, trim=False)
 
-                    # Decode to get output strings
-                    probs = probs.transpose(0, 1) # Put batch size back
-                    decoded, decoded_lens = decoder(probs, prob_lens)
+                        # Calculate accuracy (label lengths are on the cpu for the CTC loss)
+                        with train_timers.stage("metric"):
+                            accuracy = accuracy_metric(decoded, lbls, lbl_lens.to(device, non_blocking=True))
+                            train_metrics.add("accuracy", accuracy * imgs.size(0))
+                            train_metrics.add("accuracy_samples", imgs.size(0))
 
-                    # Calculate accuracy
-                    accuracy = accuracy_metric(decoded, lbls, lbl_lens)
-                    valid_accuracy_avg += accuracy.item() * imgs.size(0)
+                    # Log loss and throughput every few steps (reading the loss back waits for the device).
+                    # Every process reads back its stage timing events then, so they don't pile up
+                    if step % args.log_interval == 0:
+                        train_timers.collect()
+                    if main_process and step % args.log_interval == 0:
+                        interval = interval_metrics.values()
+                        interval_time = time.perf_counter() - interval_start
+                        logger.log(step, {
+                            "loss/train_step": interval["loss"] / interval["samples"],
+                            "throughput/train_step": interval["samples"] / interval_time,
+                        }, step_name="step")
+                        interval_metrics.reset()
+                        interval_start = time.perf_counter()
 
                     # Step profiler if after first epoch (use first epoch to load all data, warmup, etc.)
-                    if epoch > 0:
+                    if epoch > 0 and not prof is None:
                         prof.step()
-                model.train(True) # Put model back in training mode
 
-            # Calculate average loss and accuracy
-            valid_loss_avg /= len(valid_dataloader.sampler)
-            valid_accuracy_avg /= len(valid_dataloader.sampler)
+                train_time = time.perf_counter() - train_start
+                train_timers.add("data_wait", train_batches.wait_time)
+                train_timers.add("copy", train_batches.copy_time)
+
+                # Step lr scheduler after every epoch
+                lr_scheduler.step()
+
+                # Calculate loss and accuracy on validation dataset
+                valid_metrics = MetricAccumulator()
+                with torch.no_grad():
+                    model.train(False) # Put model in inference mode
+                    for imgs, lbls, img_lens, lbl_lens in valid_batches:
+                        # Feed forward and calculate loss
+                        with valid_timers.stage("forward"):
+                            with torch.autocast(device.type, dtype=amp_dtype, enabled=args.amp):
+                                probs, prob_lens = model(imgs, img_lens)
+                            probs = probs.transpose(0, 1) # Make batch size come second
+                            prob_lens = prob_lens[:, 0]
+                        with valid_timers.stage("ctc_loss"):
+                            loss = ctc_loss(probs, lbls, prob_lens, lbl_lens)
+
+                        # Decode to get output strings
+                        with valid_timers.stage("decode"):
+                            probs = probs.transpose(0, 1) # Put batch size back
+                            decoded, decoded_lens = valid_decoder(probs, prob_lens)
+
+                        with valid_timers.stage("metric"):
+                            # The metrics need the label lengths on the device, the CTC loss on the cpu
+                            metric_lbl_lens = lbl_lens.to(device, non_blocking=True)
 
-            # Write results for epoch to Tensorboard
-            writer.add_scalar("loss/train", train_loss_avg, epoch)
-            writer.add_scalar("loss/validation", valid_loss_avg, epoch)
-            writer.add_scalar("accuracy/train", train_accuracy_avg, epoch)
-            writer.add_scalar("accuracy/validation", valid_accuracy_avg, epoch)
-            writer.add_scalar("learning_rate", lr_scheduler.get_last_lr()[0], epoch)
-            writer.flush()
+                            # Accumulate loss for this epoch
+                            valid_metrics.add("loss", loss * imgs.size(0))
+                            valid_metrics.add("samples", imgs.size(0))
 
-            # Save snapshot of model parameters
-            if epoch % args.save_interval == 0:
-                torch.save(model.state_dict(), args.out_dir / ("epoch_" + str(epoch) + ".pt"))
+                            # Calculate accuracy
+                            accuracy = accuracy_metric(decoded, lbls, metric_lbl_lens)
+                            valid_metrics.add("accuracy", accuracy * imgs.size(0))
 
-            # Print results for epoch to console
-            print("Epoch: {}, training loss: {}, validation loss: {}, training accuracy: {}, validation accuracy: {}".format(
-                epoch, train_loss_avg, valid_loss_avg, train_accuracy_avg, valid_accuracy_avg))
+                            # Accumulate edit distances
+                            char_errors, chars = cer_metric.counts(decoded, decoded_lens, lbls, metric_lbl_lens)
+                            valid_metrics.add("char_errors", char_errors)
+                            valid_metrics.add("chars", chars)
+                            if not wer_metric is None:
+                                word_errors, words = wer_metric.counts(decoded, decoded_lens, lbls, metric_lbl_lens)
+                                valid_metrics.add("word_errors", word_errors)
+                                valid_metrics.add("words", words)
+
+                        # Step profiler if after first epoch (use first epoch to load all data, warmup, etc.)
+                        if epoch > 0 and not prof is None:
+                            prof.step()
+                    model.train(True) # Put model back in training mode
+                valid_timers.add("data_wait", valid_batches.wait_time)
+                valid_timers.add("copy", valid_batches.copy_time)
+
+                # Read the metrics back, sum them over all processes and calculate averages
+                train_values = train_metrics.values()
+                valid_values = valid_metrics.values()
+                totals = all_reduce_sum(
+                    [train_values.get(name, 0.0) for name in ["loss", "samples", "accuracy", "accuracy_samples", "image_pixels", "padded_pixels"]] +
+                    [valid_values.get(name, 0.0) for name in ["loss", "samples", "accuracy", "char_errors", "chars", "word_errors", "words"]], device)
+                train_loss_avg, train_samples, train_accuracy_avg, train_accuracy_samples, image_pixels, padded_pixels = totals[:6]
+                valid_loss_avg, valid_samples, valid_accuracy_avg, valid_char_errors, valid_chars, valid_word_errors, valid_words = totals[6:]
+                train_loss_avg /= max(train_samples, 1)
+                train_accuracy_avg /= max(train_accuracy_samples, 1)
+                valid_loss_avg /= max(valid_samples, 1)
+                valid_accuracy_avg /= max(valid_samples, 1)
+                valid_cer = valid_char_errors / max(valid_chars, 1.0)
+                valid_wer = valid_word_errors / max(valid_words, 1.0)
+
+                # Stage times are read on every process (CUDA events need collecting either way)
+                train_stage_times = train_timers.values()
+                valid_stage_times = valid_timers.values()
+
+                # Checkpoints hold the RNG state of every process, so they don't all draw the same
+                # augmentations after resuming
+                save_checkpoint = epoch % args.save_interval == 0
+                rng_states = all_gather_objects(rng_state()) if save_checkpoint else None
+
+                if not main_process:
+                    epoch += 1
+                    continue
+
+                # Write results for epoch to Tensorboard and the metrics file
+                scalars = {
+                    "loss/train": train_loss_avg,
+                    "loss/validation": valid_loss_avg,
+                    "accuracy/train": train_accuracy_avg,
+                    "accuracy/validation": valid_accuracy_avg,
+                    "character_error_rate/validation": valid_cer,
+                    "learning_rate": lr_scheduler.get_last_lr()[0],
+                    "padding_efficiency/train": image_pixels / max(padded_pixels, 1.0),
+                    "throughput/train": train_samples / train_time,
+                    "data_wait_fraction/train": train_batches.wait_time / train_time,
+                    "memory/peak": peak_memory(device),
+                }
+                if not wer_metric is None:
+                    scalars["word_error_rate/validation"] = valid_wer
+                for name, seconds in train_stage_times.items():
+                    scalars["time/train/" + name] = seconds
+                for name, seconds in valid_stage_times.items():
+                    scalars["time/validation/" + name] = seconds
+                if device.type == "cuda":
+                    scalars["memory/max_reserved"] = torch.cuda.max_memory_reserved(device)
+                if scaler.is_enabled():
+                    scalars["amp/loss_scale"] = scaler.get_scale()
+                for name, dataset in [("train", train_dataset), ("validation", valid_dataset)]:
+                    if not dataset.cache is None:
+                        stats = dataset.cache.stats()
+                        scalars["cache/" + name + "/hits"] = stats["hits"]
+                        scalars["cache/" + name + "/misses"] = stats["misses"]
+                        scalars["cache/" + name + "/evictions"] = stats["evictions"]
+                        scalars["cache/" + name + "/bytes_used"] = stats["bytes_used"]
+                logger.log(epoch, scalars)
+
+                # Save snapshot of training state (written in the background)
+                if save_checkpoint:
+                    checkpoint_writer.save(epoch, training_state(model, optimizer, lr_scheduler, scaler, epoch, step, rng_states))
+
+                # Print results for epoch to console
+                print("Epoch: {}, training loss: {}, validation loss: {}, training accuracy: {}, validation accuracy: {}, validation CER: {}".format(
+                    epoch, train_loss_avg, valid_loss_avg, train_accuracy_avg, valid_accuracy_avg, valid_cer))
+
+                epoch += 1
+    finally:
+        if main_process:
+            logger.close()
+        if not beam_decoder is None:
+            beam_decoder.close()
+
+
+if __name__ == '__main__':
+    now_str = Path(".") / "trained" / datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_data_dir", "-t", type=Path, required=True,
+                        help="The directory containing the training data")
+    parser.add_argument("--valid_data_dir", "-v", type=Path, required=True,
+                        help="The directory containing the validation data")
+    parser.add_argument("--out_dir", "-o", type=Path, default=now_str, required=False,
+                        help="The directory to save training logs and model checkpoints to. Defaults to current datetime in cwd/trained/.")
+    parser.add_argument("--batch_size", "-b", type=int, default=8, required=False,
+                        help="The training batch size.")
+    parser.add_argument("--learning_rate", "-l", type=float, default=0.0001, required=False,
+                        help="The training learning rate.")
+    parser.add_argument("--decay_rate", "-d", type=float, default=1.0, required=False,
+                        help="The learning rate decay rate.")
+    parser.add_argument("--save_interval", "-i", type=float, default=5, required=False,
+                        help="The interval (in epochs) to save network parameters at.")
+    parser.add_argument("--weights", "-w", type=Path, required=False,
+                        help="The saved weights to initialize the model with.")
+    parser.add_argument("--resume", "-r", type=Path, required=False,
+                        help="A checkpoint (or a training output directory to take the latest checkpoint from) to resume training from, restoring the optimizer, learning rate schedule, epoch and RNG state.")
+    parser.add_argument("--keep_checkpoints", type=int, default=3, required=False,
+                        help="The number of most recent full training checkpoints to keep. 0 keeps all of them.")
+    parser.add_argument("--bucket_size", type=int, default=0, required=False,
+                        help="Group training samples of similar width into batches, sorting pools of this many batches at a time. 0 disables bucketing.")
+    parser.add_argument("--max_batch_width", type=int, required=False,
+                        help="With bucketing, fill each batch up to this total padded width (batch size * widest image) instead of using a fixed batch size.")
+    parser.add_argument("--batch_augmentation", action="store_true",
+                        help="Augment whole padded batches on the training device instead of augmenting each sample in the data loading workers.")
+    parser.add_argument("--valid_beam_width", type=int, default=0, required=False,
+                        help="Decode validation predictions with a beam search of this width instead of greedy decoding. 0 uses greedy decoding.")
+    parser.add_argument("--decode_workers", type=int, required=False,
+                        help="The number of processes to run validation beam search on, split between --num_processes. Defaults to the number of cpus, 1 decodes serially.")
+    parser.add_argument("--lm", type=Path, required=False,
+                        help="A language model (lm.json) to fuse into the validation beam search. Must match the training data codec.")
+    parser.add_argument("--lm_weight", type=float, default=0.25, required=False,
+                        help="The weight of the language model log probabilities in the validation beam search.")
+    parser.add_argument("--amp", action="store_true",
+                        help="Train with automatic mixed precision (fp16 with loss scaling on CUDA, bf16 on the cpu).")
+    parser.add_argument("--prefetch_depth", type=int, default=2, required=False,
+                        help="The number of batches to move to the training device ahead of time.")
+    parser.add_argument("--resident_validation", action="store_true",
+                        help="Decode the validation set once and keep it on the training device as pre-collated, width sorted batches.")
+    parser.add_argument("--train_accuracy_interval", type=int, default=10, required=False,
+                        help="Decode and measure training accuracy every this many steps instead of every step.")
+    parser.add_argument("--log_interval", type=int, default=100, required=False,
+                        help="The interval (in steps) to log training loss and throughput at.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record traces with the PyTorch profiler (viewable in Tensorboard).")
+    parser.add_argument("--profile_schedule", type=int, nargs=5, default=[10, 2, 2, 8, 2], required=False,
+                        metavar=("SKIP_FIRST", "WAIT", "WARMUP", "ACTIVE", "REPEAT"),
+                        help="The profiler schedule in steps (counted from the second epoch on).")
+    parser.add_argument("--num_processes", "-n", type=int, default=1, required=False,
+                        help="The number of data parallel training processes. Each uses its own GPU if there are any, otherwise the cpu cores are split between them.")
+    parser.add_argument("--master_port", type=int, default=29500, required=False,
+                        help="The local port processes use to coordinate with --num_processes > 1.")
+    parser.add_argument("--cache_size", type=int, default=0, required=False,
+                        help="The size (in MiB) of a decoded image cache shared by data loading workers, per dataset, so PNGs are only decoded in the first epoch. 0 (the default) disables caching.")
+    parser.add_argument("--cache_dir", type=Path, required=False,
+                        help="The directory to keep the decoded image cache file in. Defaults to the system temp directory.")
+
+    # Parse command line args
+    args = parser.parse_args()
 
-            epoch += 1
+    if args.num_processes > 1:
+        torch.multiprocessing.spawn(train, args=(args,), nprocs=args.num_processes)
+    else:
+        train(0, args)